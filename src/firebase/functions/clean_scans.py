@@ -21,6 +21,7 @@ def clean_scans(request: https_fn.Request) -> https_fn.Response:
     db = firestore.client()
     SCANS_COLLECTION_REF = db.collection('scans')
     STATS_COLLECTION_REF = db.collection('stats')
+    FACE_STATS_COLLECTION_REF = db.collection('face_stats')
     USERS_COLLECTION_REF = db.collection('users')
 
     auth_header = request.headers.get('Authorization')
@@ -57,6 +58,7 @@ def clean_scans(request: https_fn.Request) -> https_fn.Response:
     deleted_files_count = 0
     deleted_scans_docs_count = 0
     deleted_stats_docs_count = 0
+    deleted_face_stats_docs_count = 0
 
     # Deleting files from Cloud Storage
     try:
@@ -99,13 +101,26 @@ def clean_scans(request: https_fn.Request) -> https_fn.Response:
         response_data = {'status': 'error', 'message': f"Internal Server Error: Failed to clean Firestore (stats): {e}"}
         return https_fn.Response(json.dumps(response_data), status=500, mimetype='application/json')
 
+    # Cleaning the 'face_stats' collection in Firestore
+    try:
+        docs = FACE_STATS_COLLECTION_REF.stream()
+        for doc in docs:
+            doc.reference.delete()
+            deleted_face_stats_docs_count += 1
+        print(f"Deleted {deleted_face_stats_docs_count} entries from the 'face_stats' collection.")
+    except Exception as e:
+        print(f"Error while cleaning 'face_stats' in Firestore: {e}")
+        response_data = {'status': 'error', 'message': f"Internal Server Error: Failed to clean Firestore (face_stats): {e}"}
+        return https_fn.Response(json.dumps(response_data), status=500, mimetype='application/json')
+
     response_data = {
         'status': 'success',
         'message': 'Successfully deleted all data!',
         'data': {
             'deleted_files': deleted_files_count,
             'deleted_scans_docs': deleted_scans_docs_count,
-            'deleted_stats_docs': deleted_stats_docs_count
+            'deleted_stats_docs': deleted_stats_docs_count,
+            'deleted_face_stats_docs': deleted_face_stats_docs_count
         }
     }
     return https_fn.Response(json.dumps(response_data), status=200, mimetype='application/json')
\ No newline at end of file
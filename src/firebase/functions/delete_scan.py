@@ -16,6 +16,7 @@ def delete_scan(event: storage_fn.CloudEvent):
     # Firestore collection references
     SCANS_COLLECTION_REF = db.collection('scans')
     STATS_COLLECTION_REF = db.collection('stats')
+    FACE_STATS_COLLECTION_REF = db.collection('face_stats')
 
     bucket_name = event.data.bucket
     file_path = event.data.name
@@ -39,16 +40,25 @@ def delete_scan(event: storage_fn.CloudEvent):
     deleted_stats_file = False
     deleted_scan_doc = False
     deleted_stat_doc = False
+    deleted_face_stats_doc = False
 
     try:
         bucket = storage.bucket(bucket_name)
 
-        # Retrieve and delete the associated stat file (the stat ID is the same as the scan)
-        stats_blob = bucket.blob(f'comparisons/{doc_id}.ply')
-        if stats_blob.exists():
-            stats_blob.delete()
-            print(f"Deleted the stat file '{stats_blob.name}'.")
-            deleted_stats_file = True
+        # Retrieve and delete the associated stat files, PLY and compact heatmap (the stat ID is the same as the scan)
+        for extension in ('ply', 'hmap'):
+            stats_blob = bucket.blob(f'comparisons/{doc_id}.{extension}')
+            if stats_blob.exists():
+                stats_blob.delete()
+                print(f"Deleted the stat file '{stats_blob.name}'.")
+                deleted_stats_file = True
+
+        # Delete the level-of-detail tiles of the heatmap, if any
+        lod_blobs = list(bucket.list_blobs(prefix=f'comparisons/{doc_id}/lod/'))
+        for lod_blob in lod_blobs:
+            lod_blob.delete()
+        if lod_blobs:
+            print(f"Deleted {len(lod_blobs)} level-of-detail files of the scan '{doc_id}'.")
 
         # Delete the main scan document from Firestore
         scan_doc_ref = SCANS_COLLECTION_REF.document(doc_id)
@@ -68,10 +78,17 @@ def delete_scan(event: storage_fn.CloudEvent):
         else:
             print(f"Stat document with ID '{doc_id}' does not exist. Skipping deletion.")
 
+        # Delete the per-face stats document from Firestore (only written for some analysis settings)
+        face_stats_doc_ref = FACE_STATS_COLLECTION_REF.document(doc_id)
+        if face_stats_doc_ref.get().exists:
+            face_stats_doc_ref.delete()
+            print(f"Deleted the face stats document with ID '{doc_id}'.")
+            deleted_face_stats_doc = True
+
     except Exception as e:
         print(f"Critical error during cleanup for ID {doc_id}: {e}")
         return
 
     # Final success message
     print(f"Cleanup for scan {doc_id} completed.")
-    print(f"Summary: Stat file deleted: {deleted_stats_file}, Scan doc deleted: {deleted_scan_doc}, Stat doc deleted: {deleted_stat_doc}")
\ No newline at end of file
+    print(f"Summary: Stat file deleted: {deleted_stats_file}, Scan doc deleted: {deleted_scan_doc}, Stat doc deleted: {deleted_stat_doc}, Face stats doc deleted: {deleted_face_stats_doc}")
\ No newline at end of file
@@ -27,6 +27,7 @@ def delete_user(request: https_fn.Request) -> https_fn.Response:
     USERS_COLLECTION_REF = db.collection('users')
     SCANS_COLLECTION_REF = db.collection('scans')
     STATS_COLLECTION_REF = db.collection('stats')
+    FACE_STATS_COLLECTION_REF = db.collection('face_stats')
     STEPS_COLLECTION_REF = db.collection('steps')
 
     bucket = storage.bucket(BUCKET_NAME)
@@ -128,14 +129,22 @@ def delete_user(request: https_fn.Request) -> https_fn.Response:
             except Exception as e:
                 print(f"Error deleting file {scan_id} from Cloud Storage: {e}")
                 
-            # Delete associated stats file from Cloud Storage
+            # Delete associated stats files (PLY and compact heatmap) from Cloud Storage
             try:
-                blob = bucket.blob(f'comparisons/{scan_id}.ply')
-                if blob.exists():
-                    blob.delete()
+                for extension in ('ply', 'hmap'):
+                    blob = bucket.blob(f'comparisons/{scan_id}.{extension}')
+                    if blob.exists():
+                        blob.delete()
             except Exception as e:
                 print(f"Error deleting stats for scan {scan_id}: {e}")
 
+            # Delete the level-of-detail tiles of the heatmap from Cloud Storage
+            try:
+                for blob in bucket.list_blobs(prefix=f'comparisons/{scan_id}/lod/'):
+                    blob.delete()
+            except Exception as e:
+                print(f"Error deleting the level-of-detail files of scan {scan_id}: {e}")
+
             # Delete associated stats from Firestore
             try:
                 stats_docs_to_delete = STATS_COLLECTION_REF.where(field_path='scan', op_string='==', value=scan_id).stream()
@@ -144,6 +153,12 @@ def delete_user(request: https_fn.Request) -> https_fn.Response:
             except Exception as e:
                 print(f"Error deleting stats for scan {scan_id} from Firestore: {e}")
 
+            # Delete the per-face stats from Firestore
+            try:
+                FACE_STATS_COLLECTION_REF.document(scan_id).delete()
+            except Exception as e:
+                print(f"Error deleting face stats for scan {scan_id} from Firestore: {e}")
+
             # Delete the scan document itself from Firestore
             doc.reference.delete()
             deleted_scans_count += 1
@@ -123,6 +123,8 @@ def get_all_pending(request: https_fn.Request) -> https_fn.Response:
         response_data['data'].append({
             'scan_id': doc_id,
             'step_id': step_id,
+            # Used by the backend to share the workers fairly between the users
+            'user': doc.get('user'),
             'scan_url': scan_signed_url,
             'step_url': step_signed_url
         })
@@ -16,6 +16,8 @@ def test_delete_scan_trigger_deletes_firestore_and_output_files(create_user_in_e
     # Percorsi dei file in Storage
     scan_file_path = f"scans/{scan_id}.ply"
     output_file_path = f"comparisons/{scan_id}.ply"
+    compact_file_path = f"comparisons/{scan_id}.hmap"
+    lod_file_path = f"comparisons/{scan_id}/lod/L0_root.hmap"
 
     # Creare il file di scansione principale in Storage
     scan_blob = bucket.blob(scan_file_path)
@@ -25,6 +27,13 @@ def test_delete_scan_trigger_deletes_firestore_and_output_files(create_user_in_e
     output_blob = bucket.blob(output_file_path)
     output_blob.upload_from_string("dummy output data")
 
+    # Creare la heatmap compatta in Storage
+    bucket.blob(compact_file_path).upload_from_string("dummy compact data")
+
+    # Creare un tile LOD della heatmap in Storage
+    lod_blob = bucket.blob(lod_file_path)
+    lod_blob.upload_from_string("dummy lod data")
+
     # Creare il documento nella collezione 'scans'
     scan_doc_ref = db.collection('scans').document(scan_id)
     scan_doc_ref.set({
@@ -38,6 +47,10 @@ def test_delete_scan_trigger_deletes_firestore_and_output_files(create_user_in_e
     stat_doc_ref = db.collection('stats').document(scan_id)
     stat_doc_ref.set({"accuracy": 100})
 
+    # Creare il documento nella collezione 'face_stats'
+    face_stats_doc_ref = db.collection('face_stats').document(scan_id)
+    face_stats_doc_ref.set({"faces": []})
+
     # Verifica iniziale: assicurarsi che tutto esista prima dell'azione
     assert scan_blob.exists(), "Il file di scansione deve esistere prima del test"
     assert output_blob.exists(), "Il file di output deve esistere prima del test"
@@ -53,5 +66,8 @@ def test_delete_scan_trigger_deletes_firestore_and_output_files(create_user_in_e
     # 4. Verifica: Controllare che la pulizia a cascata sia avvenuta
     assert not bucket.blob(scan_file_path).exists(), "Il file di scansione dovrebbe essere stato eliminato (azione)"
     assert not bucket.blob(output_file_path).exists(), "Il file di output sarebbe dovuto essere eliminato dalla funzione"
+    assert not bucket.blob(compact_file_path).exists(), "La heatmap compatta sarebbe dovuta essere eliminata dalla funzione"
+    assert not bucket.blob(lod_file_path).exists(), "Il tile LOD sarebbe dovuto essere eliminato dalla funzione"
     assert not db.collection('scans').document(scan_id).get().exists, "Il documento 'scans' sarebbe dovuto essere eliminato dalla funzione"
-    assert not db.collection('stats').document(scan_id).get().exists, "Il documento 'stats' sarebbe dovuto essere eliminato dalla funzione"
\ No newline at end of file
+    assert not db.collection('stats').document(scan_id).get().exists, "Il documento 'stats' sarebbe dovuto essere eliminato dalla funzione"
+    assert not db.collection('face_stats').document(scan_id).get().exists, "Il documento 'face_stats' sarebbe dovuto essere eliminato dalla funzione"
\ No newline at end of file
@@ -1,16 +1,24 @@
+import os
+# The process pools fork the server, which has open Firestore channels: gRPC must know before it is imported
+os.environ.setdefault("GRPC_ENABLE_FORK_SUPPORT", "true")
+os.environ.setdefault("GRPC_POLL_STRATEGY", "poll")
+
 from flask import Flask
 import firebase_admin
 from firebase_admin import credentials
 import json
 from app.config import Config
 import logging
-import os
-from logging.handlers import RotatingFileHandler
+import multiprocessing
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
 # --- LOGGER CONFIGURATION ---
+# Records of the forked pool workers, written to the log file by this process (see init_worker_logging)
+log_queue = None
+
 if not app.debug:
     # Ensure the log directory exists
     if not os.path.exists('logs'):
@@ -29,39 +37,63 @@ if not app.debug:
     app.logger.addHandler(file_handler)
     
     app.logger.setLevel(logging.INFO)
+
+    # The process pools fork the server, with its file handler: their workers send their records here instead,
+    # so that a single process writes and rotates logs/app.log
+    log_queue = multiprocessing.get_context('fork').Queue()
+    QueueListener(log_queue, file_handler, respect_handler_level=True).start()
     app.logger.info('App startup')
+
+def init_worker_logging():
+    """Initializer of the forked pool workers: logs through the queue of the server instead of the log file"""
+    if log_queue is None:
+        return
+    for handler in list(app.logger.handlers):
+        if isinstance(handler, RotatingFileHandler):
+            app.logger.removeHandler(handler)
+    app.logger.addHandler(QueueHandler(log_queue))
 # --- LOGGER CONFIGURATION END ---
 
 
 try:
     service_account_str = app.config.get("FIREBASE_SERVICE_ACCOUNT_KEY")
+    # Default bucket of app.services.get_bucket()
+    firebase_options = {'storageBucket': app.config["FIREBASE_STORAGE_BUCKET"]} if app.config.get("FIREBASE_STORAGE_BUCKET") else None
     
     if service_account_str:
         service_account_info = json.loads(service_account_str)
         cred = credentials.Certificate(service_account_info)
-        firebase_admin.initialize_app(cred)
+        firebase_admin.initialize_app(cred, firebase_options)
         print("Firebase Admin SDK inizializzato con Service Account")
     else:
         # Se la chiave non è fornita, prova con Application Default Credentials (account locale).
-        firebase_admin.initialize_app()
+        firebase_admin.initialize_app(options=firebase_options)
         print("Firebase Admin SDK inizializzato con ADC")
         
-    # Call the cloud function to get all pending scans
+    # Resume the scans that were queued or in-flight before the restart from the local journal
     import requests
     from app.queue_manager import queue_manager
-    
+
+    resumed_scans = queue_manager.resume_from_journal()
+    print(f"Resumed {len(resumed_scans)} scans from the local journal")
+
+    # Call the cloud function to get the scans uploaded while the server was down
     link = 'https://get-all-pending-5ja5umnfkq-ey.a.run.app'
     try:
         response = requests.get(link)
         response.raise_for_status()
         pending_scans = response.json()
+        # The cloud function wraps the scans in {'status': ..., 'data': [...]}
+        if isinstance(pending_scans, dict):
+            pending_scans = pending_scans.get('data')
         print(f"Retrieved {len(pending_scans) if isinstance(pending_scans, list) else 'N/A'} pending scans")
         
-        # Add all pending scans to the queue
+        # Add all pending scans to the queue: add_scan is idempotent, it merges the ones already resumed
+        # from the journal (their URLs are signed again by the cloud function) and skips the processed ones
         if isinstance(pending_scans, list):
             for scan in pending_scans:
                 queue_manager.add_scan(scan)
-            print(f"Added {len(pending_scans)} scans to the processing queue")
+            print(f"Submitted {len(pending_scans)} pending scans to the processing queue")
         
     except requests.exceptions.RequestException as req_error:
         print(f"Errore durante la chiamata alla Cloud Function: {req_error}")
@@ -1,6 +1,10 @@
 import os
 import json
-from flask import current_app as app
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# The config is loaded before the Flask app exists, so it can't log through current_app
+logger = logging.getLogger(__name__)
 
 _secret_manager_client = None
 
@@ -12,14 +16,16 @@ def _get_secret_manager_client():
             from google.cloud import secretmanager
             _secret_manager_client = secretmanager.SecretManagerServiceClient()
         except Exception as e:
-            app.logger.error(f"Unable to initialize Secret Manager client: {e}")
+            logger.error(f"Unable to initialize Secret Manager client: {e}")
             return None
     return _secret_manager_client
 
+def _use_secret_manager() -> bool:
+    return os.getenv("USE_SECRET_MANAGER", "false").lower() in ("true", "1", "yes")
+
 def _read_secret(secret_id: str) -> str | None:
     """Reads a secret from Secret Manager."""
-    use_sm = os.getenv("USE_SECRET_MANAGER", "false").lower() in ("true", "1", "yes")
-    if not use_sm:
+    if not _use_secret_manager():
         return None
 
     project_id = os.getenv("GCP_PROJECT_ID")
@@ -32,23 +38,86 @@ def _read_secret(secret_id: str) -> str | None:
         response = client.access_secret_version(name=name)
         return response.payload.data.decode("UTF-8")
     except Exception as e:
-        app.logger.error(f"Error reading secret '{secret_id}': {e}")
+        logger.error(f"Error reading secret '{secret_id}': {e}")
         return None
 
+def _read_secrets(secrets: dict) -> dict:
+    """
+    Reads the secrets (environment variable -> secret id) whose environment variable is not set,
+    concurrently so the startup waits for one Secret Manager round-trip instead of one per secret.
+    """
+    global _secret_manager_client
+    missing = [secret_id for variable, secret_id in secrets.items() if not os.getenv(variable)]
+    if not missing or not _use_secret_manager():
+        return {}
+
+    # Created before the threads, so they share one client
+    client = _get_secret_manager_client()
+    with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+        values = dict(zip(missing, executor.map(_read_secret, missing)))
+
+    # The secrets are only read at startup: close the gRPC channel, so no connection is open
+    # when the process pools fork the server
+    if client:
+        client.transport.close()
+        _secret_manager_client = None
+    return values
+
+_secrets = _read_secrets({
+    "SECRET_KEY": "flask-secret-key",
+    "API_KEY_BACKEND": "api-key-backend",
+    "FIREBASE_SERVICE_ACCOUNT_KEY": "backend-service-account-key",
+})
+
 class Config:
     """Application configuration"""
     SECRET_KEY = (
         os.getenv("SECRET_KEY")
-        or _read_secret("flask-secret-key")
+        or _secrets.get("flask-secret-key")
         or "valore-segreto-sviluppo" 
     )
     API_KEY_BACKEND = (
         os.getenv("API_KEY_BACKEND")
-        or _read_secret("api-key-backend")
+        or _secrets.get("api-key-backend")
         or ""
     )
     FIREBASE_SERVICE_ACCOUNT_KEY = (
         os.getenv("FIREBASE_SERVICE_ACCOUNT_KEY")
-        or _read_secret("backend-service-account-key")
+        or _secrets.get("backend-service-account-key")
         or ""
-    )
\ No newline at end of file
+    )
+    # Bucket of the heatmaps, e.g. "<project>.appspot.com"
+    FIREBASE_STORAGE_BUCKET = os.getenv("FIREBASE_STORAGE_BUCKET", "")
+    # Number of scans processed in parallel, each one in its own process
+    PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "0")) or os.cpu_count() or 1
+    # CPU threads of Open3D in each worker process, 0 to share the cores between the workers (cores / workers).
+    # Open3D parallelizes a scan over all the cores by itself: without the limit, N workers run N x cores threads.
+    # More workers with fewer threads each process more scans per hour on a long queue, fewer workers with more
+    # threads each process a single scan faster and hold fewer scans in memory. Open3D builds older than
+    # utility.set_max_threads use OpenMP: set OMP_NUM_THREADS in the environment of the server instead
+    PIPELINE_WORKER_THREADS = int(os.getenv("PIPELINE_WORKER_THREADS", "0"))
+    # Threads downloading the next scans (and processes converting their STEP files) during the processing
+    PIPELINE_FETCH_WORKERS = int(os.getenv("PIPELINE_FETCH_WORKERS", "2"))
+    # Threads uploading the results of the processed scans
+    PIPELINE_PUBLISH_WORKERS = int(os.getenv("PIPELINE_PUBLISH_WORKERS", "2"))
+    # Fetched scans that can wait for a free worker, the fetch threads block beyond that
+    PIPELINE_PREFETCH = int(os.getenv("PIPELINE_PREFETCH", "2"))
+    # A scan in flight when a pool worker dies is queued again, until it was in this many broken pools:
+    # then it is failed, as the likely cause of the crashes
+    PIPELINE_MAX_POOL_CRASHES = int(os.getenv("PIPELINE_MAX_POOL_CRASHES", "2"))
+    # Local journal used to resume the queue after a restart
+    SCAN_JOURNAL_PATH = os.getenv("SCAN_JOURNAL_PATH", "data/scan_journal.sqlite3")
+    # Times the processing of a scan is started (across restarts) before it is failed instead of resumed
+    SCAN_MAX_ATTEMPTS = int(os.getenv("SCAN_MAX_ATTEMPTS", "3"))
+    # Minimum interval (seconds) between two batched writes of the scan progress to Firestore
+    STATUS_FLUSH_INTERVAL = float(os.getenv("STATUS_FLUSH_INTERVAL", "1.0"))
+    # JSON lines file with the per-stage profile of every processed scan
+    PIPELINE_METRICS_PATH = os.getenv("PIPELINE_METRICS_PATH", "logs/pipeline_metrics.jsonl")
+    # Seconds of waiting after which a queued scan counts as half its size for the scheduler, so big scans
+    # are not starved by smaller ones of the same user
+    SCHEDULER_AGING_SECONDS = float(os.getenv("SCHEDULER_AGING_SECONDS", "300"))
+    # A signed URL expiring within this many seconds is signed again before the download, so long queues
+    # don't outlive the 15 minutes URLs sent by the cloud functions
+    SIGNED_URL_REFRESH_MARGIN = float(os.getenv("SIGNED_URL_REFRESH_MARGIN", "120"))
+    # Validity (seconds) of the URLs signed by the server
+    SIGNED_URL_EXPIRATION = int(os.getenv("SIGNED_URL_EXPIRATION", "900"))
\ No newline at end of file
@@ -0,0 +1,199 @@
+import base64
+import calendar
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs, unquote
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import google_crc32c
+except ImportError:  # Installed with google-cloud-storage, only needed when the server sends no md5
+    google_crc32c = None
+
+logger = logging.getLogger(__name__)
+
+# Size of the network reads and of the file write buffer
+CHUNK_SIZE = 1024 * 1024
+
+_session = None
+_session_pid = None
+
+class DownloadError(Exception):
+    """Raised when a download can't be completed or fails the checksum verification"""
+
+def get_session():
+    """
+    Returns the pooled HTTP session of the process, so consecutive downloads reuse the connections.
+    A new session is created after a fork, sockets can't be shared with the parent.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+def _parse_goog_hash(header):
+    """Parses an 'x-goog-hash: crc32c=...,md5=...' header (sent by Cloud Storage) into a dict"""
+    hashes = {}
+    for part in (header or '').split(','):
+        name, _, value = part.strip().partition('=')
+        if name and value:
+            hashes[name] = value
+    return hashes
+
+def _file_checksum(path, algorithm):
+    """Returns the base64 checksum of a file, in the same format as x-goog-hash"""
+    if algorithm == 'md5':
+        digest = hashlib.md5()
+    else:
+        digest = google_crc32c.Checksum()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode('ascii')
+
+def _verify(path, expected_size, expected_hashes):
+    """Checks the size and the checksum (md5, or crc32c if available) of a completed download"""
+    size = os.path.getsize(path)
+    if expected_size is not None and size != expected_size:
+        raise DownloadError(f"Downloaded {size} bytes instead of {expected_size}")
+
+    if 'md5' in expected_hashes:
+        algorithm = 'md5'
+    elif 'crc32c' in expected_hashes and google_crc32c is not None:
+        algorithm = 'crc32c'
+    else:
+        return
+    if _file_checksum(path, algorithm) != expected_hashes[algorithm]:
+        raise DownloadError(f"{algorithm} checksum mismatch")
+
+def download_file(url, destination_path, session=None, retries=3, timeout=60, chunk_size=CHUNK_SIZE):
+    """
+    Downloads a URL to a file with large buffered writes.
+    After a dropped connection the download resumes from the bytes already written with an
+    HTTP Range request (or restarts if the server ignores it). The result is verified against
+    the size and the x-goog-hash checksum sent by the server.
+    """
+    session = session or get_session()
+    expected_size = None
+    expected_hashes = {}
+    offset = 0
+
+    for attempt in range(retries + 1):
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with session.get(url, stream=True, headers=headers, timeout=timeout) as response:
+                if offset and response.status_code == 416:
+                    # Nothing left to download
+                    break
+                response.raise_for_status()
+
+                if offset and response.status_code == 206:
+                    mode = 'ab'
+                    # The first request may have failed before sending its headers
+                    expected_hashes = expected_hashes or _parse_goog_hash(response.headers.get('x-goog-hash'))
+                    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                    if expected_size is None and total.isdigit():
+                        expected_size = int(total)
+                else:
+                    # First request, or the server ignored the range: start from scratch
+                    offset = 0
+                    mode = 'wb'
+                    expected_hashes = _parse_goog_hash(response.headers.get('x-goog-hash'))
+                    length = response.headers.get('Content-Length')
+                    expected_size = int(length) if length and 'Content-Encoding' not in response.headers else None
+
+                with open(destination_path, mode, buffering=chunk_size) as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+            break
+
+        except requests.HTTPError as e:
+            # Client errors (e.g. an expired signed URL) won't be fixed by retrying
+            if (e.response is not None and e.response.status_code < 500) or attempt == retries:
+                raise
+            offset = os.path.getsize(destination_path) if os.path.exists(destination_path) else 0
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == retries:
+                raise
+            offset = os.path.getsize(destination_path) if os.path.exists(destination_path) else 0
+            logger.warning(f"Download interrupted at {offset} bytes ({e}), resuming")
+
+        time.sleep(min(2 ** attempt, 10))
+
+    _verify(destination_path, expected_size, expected_hashes)
+
+def download_files(downloads, session=None, **options):
+    """
+    Downloads several (url, destination_path) pairs concurrently over the pooled session.
+    Raises the first error, after all the downloads have finished.
+    """
+    session = session or get_session()
+    with ThreadPoolExecutor(max_workers=max(len(downloads), 1)) as executor:
+        futures = [executor.submit(download_file, url, path, session, **options) for url, path in downloads]
+        for future in futures:
+            future.result()
+
+def probe_scan(url, session=None, header_bytes=65536, timeout=10):
+    """
+    Returns (size in bytes, number of points) of a PLY scan without downloading it: the first bytes are
+    requested with a Range request, the size comes from Content-Range (or Content-Length) and the points
+    from the 'element vertex' line of the header. Either value is None if it can't be read.
+    """
+    session = session or get_session()
+    with session.get(url, stream=True, headers={'Range': f'bytes=0-{header_bytes - 1}'}, timeout=timeout) as response:
+        response.raise_for_status()
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        length = response.headers.get('Content-Length')
+        if response.status_code == 206:
+            size = int(total) if total.isdigit() else None
+        else:
+            size = int(length) if length and 'Content-Encoding' not in response.headers else None
+        # A server ignoring the range sends the whole file: only the beginning is read
+        head = b''
+        for chunk in response.iter_content(chunk_size=header_bytes):
+            head += chunk
+            if len(head) >= header_bytes:
+                break
+
+    points = None
+    header, _, _ = head.partition(b'end_header')
+    for line in header.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[:2] == [b'element', b'vertex'] and fields[2].isdigit():
+            points = int(fields[2])
+    return size, points
+
+def signed_url_expiry(url):
+    """
+    Returns the time (seconds since the epoch) at which a Cloud Storage signed URL expires, from its
+    X-Goog-Date and X-Goog-Expires (V4) or Expires (V2) parameters, or None if the URL is not signed.
+    """
+    query = {name.lower(): values[0] for name, values in parse_qs(urlsplit(url).query).items()}
+    try:
+        if 'x-goog-date' in query and 'x-goog-expires' in query:
+            signed_at = calendar.timegm(time.strptime(query['x-goog-date'], '%Y%m%dT%H%M%SZ'))
+            return signed_at + int(query['x-goog-expires'])
+        if 'expires' in query:
+            return int(query['expires'])
+    except ValueError:
+        pass
+    return None
+
+def signed_url_blob(url):
+    """Returns the (bucket, object name) of a Cloud Storage URL, or None for another host"""
+    parts = urlsplit(url)
+    path = unquote(parts.path).lstrip('/')
+    if parts.hostname == 'storage.googleapis.com':
+        bucket, _, name = path.partition('/')
+        return (bucket, name) if bucket and name else None
+    if parts.hostname and parts.hostname.endswith('.storage.googleapis.com') and path:
+        return parts.hostname[:-len('.storage.googleapis.com')], path
+    return None
@@ -0,0 +1,145 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the wall time histogram buckets, the last bucket is unbounded
+HISTOGRAM_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+def _reset_peak_rss():
+    """Resets the peak RSS of the process (Linux only), so each stage reports its own peak"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    """Returns the peak RSS of the process in MB"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _cpu_time():
+    """CPU time of the process and of its terminated children (e.g. the ICP hypothesis pool)"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+class ScanProfile:
+    """
+    Per-stage wall time, CPU time, peak RSS and sizes of one scan, filled by the worker.
+    The stages run in a pool process measure the whole process. The ones run in a thread of the server
+    (thread=True), next to the other scans, measure the CPU time of their thread only and have no peak RSS,
+    which is shared by the whole server.
+    """
+
+    def __init__(self, scan_id):
+        self.scan_id = scan_id
+        self.started_at = time.time()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, thread=False):
+        """
+        Measures the enclosed block. The yielded dict can be used to add details,
+        e.g. record['points'] = len(pcd.points). thread is True for the stages run in a thread
+        of the server, concurrently with other stages.
+        """
+        record = {'stage': name}
+        cpu_time = time.thread_time if thread else _cpu_time
+        if not thread:
+            _reset_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        try:
+            yield record
+        except Exception:
+            record['failed'] = True
+            raise
+        finally:
+            record['wall_time'] = time.perf_counter() - wall_start
+            record['cpu_time'] = cpu_time() - cpu_start
+            record['peak_rss_mb'] = None if thread else _peak_rss_mb()
+            self.stages.append(record)
+
+    def to_dict(self, failed=False):
+        return {
+            'scan_id': self.scan_id,
+            'pid': os.getpid(),
+            'started_at': self.started_at,
+            'total_wall_time': sum(stage['wall_time'] for stage in self.stages),
+            'failed': failed,
+            'stages': self.stages,
+        }
+
+class StageMetrics:
+    """
+    Aggregates the scan profiles received from the workers into per-stage histograms,
+    and appends every profile as a JSON line to a file. The failed scans are included,
+    with the stages they went through.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.scans = 0
+        self.failed_scans = 0
+
+    def add(self, profile):
+        """Adds the profile (ScanProfile.to_dict()) of a processed or failed scan"""
+        with self.lock:
+            self.scans += 1
+            self.failed_scans += int(profile.get('failed', False))
+            for record in profile['stages']:
+                stage = self.stages.setdefault(record['stage'], {
+                    'count': 0,
+                    'failed': 0,
+                    'wall_time_sum': 0.0,
+                    'cpu_time_sum': 0.0,
+                    'wall_time_max': 0.0,
+                    'peak_rss_mb_max': 0.0,
+                    'wall_time_buckets': [0] * (len(HISTOGRAM_BUCKETS) + 1),
+                })
+                stage['count'] += 1
+                stage['failed'] += int(record.get('failed', False))
+                stage['wall_time_sum'] += record['wall_time']
+                stage['cpu_time_sum'] += record['cpu_time']
+                stage['wall_time_max'] = max(stage['wall_time_max'], record['wall_time'])
+                if record['peak_rss_mb'] is not None:
+                    stage['peak_rss_mb_max'] = max(stage['peak_rss_mb_max'], record['peak_rss_mb'])
+                bucket = next(
+                    (i for i, bound in enumerate(HISTOGRAM_BUCKETS) if record['wall_time'] <= bound),
+                    len(HISTOGRAM_BUCKETS))
+                stage['wall_time_buckets'][bucket] += 1
+
+            if self.path:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(profile) + "\n")
+
+    def summary(self):
+        """Returns the aggregated histograms, with the stages sorted by total wall time"""
+        with self.lock:
+            stages = {}
+            for name, stage in sorted(self.stages.items(), key=lambda item: -item[1]['wall_time_sum']):
+                stages[name] = dict(
+                    stage,
+                    wall_time_avg=stage['wall_time_sum'] / stage['count'],
+                    cpu_time_avg=stage['cpu_time_sum'] / stage['count'],
+                    wall_time_buckets=dict(zip(
+                        [str(bound) for bound in HISTOGRAM_BUCKETS] + ['+Inf'],
+                        stage['wall_time_buckets'])),
+                )
+            return {'scans': self.scans, 'failed_scans': self.failed_scans, 'stages': stages}
@@ -0,0 +1,136 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Scan states recorded in the journal
+QUEUED = 'queued'
+STARTED = 'started'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+class ScanJournal:
+    """
+    Crash-safe on-disk journal of the scans handled by the queue manager.
+    Every scan has one row with its last state, so after a restart the queued and
+    in-flight scans can be resumed locally and the completed ones are never reprocessed.
+    """
+
+    def __init__(self, path, retention_days=30):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        # The connection is shared by the Flask threads and the pool callbacks
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL is still crash-safe for the application (only the last commits can be lost on power loss)
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS scans (
+                scan_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                scan_data TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                enqueued_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS scans_state ON scans (state, enqueued_at)")
+        self._prune(retention_days)
+
+    def _execute(self, query, params=()):
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def _prune(self, retention_days):
+        """Delete the finished and failed scans older than the retention period"""
+        cutoff = time.time() - retention_days * 86400
+        self._execute(
+            "DELETE FROM scans WHERE state IN (?, ?) AND updated_at < ?",
+            (FINISHED, FAILED, cutoff)
+        )
+
+    def record_enqueued(self, scan_data):
+        """
+        Record that a scan entered the queue. A queued or in-flight scan (e.g. re-queued after a crash) keeps
+        its enqueue time and attempts, a finished or failed one submitted again starts over.
+        """
+        now = time.time()
+        self._execute("""
+            INSERT INTO scans (scan_id, state, scan_data, enqueued_at, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(scan_id) DO UPDATE SET
+                attempts = CASE WHEN scans.state IN (?, ?) THEN 0 ELSE scans.attempts END,
+                enqueued_at = CASE WHEN scans.state IN (?, ?) THEN excluded.enqueued_at ELSE scans.enqueued_at END,
+                state = excluded.state,
+                scan_data = excluded.scan_data,
+                error = NULL,
+                updated_at = excluded.updated_at
+        """, (scan_data['scan_id'], QUEUED, json.dumps(scan_data), now, now, FINISHED, FAILED, FINISHED, FAILED))
+
+    def update_scan_data(self, scan_id, scan_data):
+        """Replace the data of a known scan (e.g. its refreshed signed URLs) without changing its state"""
+        self._execute(
+            "UPDATE scans SET scan_data = ?, updated_at = ? WHERE scan_id = ?",
+            (json.dumps(scan_data), time.time(), scan_id)
+        )
+
+    def record_started(self, scan_id):
+        """Record that a worker started processing a scan"""
+        self._execute(
+            "UPDATE scans SET state = ?, attempts = attempts + 1, updated_at = ? WHERE scan_id = ?",
+            (STARTED, time.time(), scan_id)
+        )
+
+    def record_finished(self, scan_id):
+        """Record that a scan was processed successfully"""
+        self._execute(
+            "UPDATE scans SET state = ?, error = NULL, updated_at = ? WHERE scan_id = ?",
+            (FINISHED, time.time(), scan_id)
+        )
+
+    def record_failed(self, scan_id, error):
+        """Record that the processing of a scan failed"""
+        self._execute(
+            "UPDATE scans SET state = ?, error = ?, updated_at = ? WHERE scan_id = ?",
+            (FAILED, str(error), time.time(), scan_id)
+        )
+
+    def get_state(self, scan_id):
+        """Returns the last recorded state of a scan, or None if the scan is unknown"""
+        rows = self._execute("SELECT state FROM scans WHERE scan_id = ?", (scan_id,))
+        return rows[0][0] if rows else None
+
+    def get_attempts(self, scan_id):
+        """Returns the number of times the processing of a scan was started, 0 if the scan is unknown"""
+        rows = self._execute("SELECT attempts FROM scans WHERE scan_id = ?", (scan_id,))
+        return rows[0][0] if rows else 0
+
+    def pending_scans(self, max_attempts=None):
+        """
+        Returns the data of the queued and in-flight scans, in enqueue order.
+        The ones already started max_attempts times (e.g. a scan that crashes the whole server)
+        are not returned, see fail_exhausted.
+        """
+        rows = self._execute(
+            "SELECT scan_data FROM scans WHERE state IN (?, ?) AND (? IS NULL OR attempts < ?) ORDER BY enqueued_at",
+            (QUEUED, STARTED, max_attempts, max_attempts)
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def fail_exhausted(self, max_attempts):
+        """Records as failed the queued and in-flight scans started max_attempts times, returns their ids"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT scan_id FROM scans WHERE state IN (?, ?) AND attempts >= ?",
+                (QUEUED, STARTED, max_attempts)
+            ).fetchall()
+            self.conn.execute(
+                "UPDATE scans SET state = ?, error = ?, updated_at = ? WHERE state IN (?, ?) AND attempts >= ?",
+                (FAILED, f"Gave up after {max_attempts} attempts", time.time(), QUEUED, STARTED, max_attempts)
+            )
+        return [row[0] for row in rows]
@@ -1,42 +1,370 @@
 import open3d as o3d
 import numpy as np
-import copy
+from . import heatmap_io
+from . import lod
 
-def calculate_metrics(source_cleaned, target, final_transformation, tolerance_for_percentage):
+class StreamingStats:
     """
-    Computes various metrics between the aligned source point cloud and the target point cloud.
+    Single-pass statistics of the deviations, updated chunk by chunk.
+    Mean and variance use Welford's algorithm, with Chan's formula to merge a whole chunk at once.
     """
-    source_aligned = copy.deepcopy(source_cleaned).transform(final_transformation)
 
-    # Compute point-to-point distances
-    distances = source_aligned.compute_point_cloud_distance(target)
-    distances_np = np.asarray(distances)
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.within_tolerance = 0
 
-    # Calculate the percentage of points within the specified tolerance
-    total_points = len(distances_np)
-    if total_points > 0:
-        points_within_tolerance = np.sum(distances_np <= tolerance_for_percentage)
-        percentage_within_tolerance = (points_within_tolerance / total_points) * 100
+    def update(self, values):
+        """Adds a chunk of (absolute) deviations"""
+        n = len(values)
+        if n == 0:
+            return
+
+        chunk_mean = float(np.mean(values, dtype=np.float64))
+        chunk_m2 = float(np.sum(np.square(values - chunk_mean, dtype=np.float64)))
+
+        total = self.count + n
+        delta = chunk_mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += chunk_m2 + delta * delta * self.count * n / total
+        self.count = total
+
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+        self.within_tolerance += int(np.count_nonzero(values <= self.tolerance))
+
+    def metrics(self):
+        """Returns the metrics in the format stored in Firestore"""
+        if self.count == 0:
+            return {
+                'std_deviation': 0.0,
+                'min_deviation': 0.0,
+                'max_deviation': 0.0,
+                'avg_deviation': 0.0,
+                'accuracy_rmse': 0.0,
+                'percentage_of_points_within_tolerance': 0
+            }
+
+        variance = self.m2 / self.count
+        return {
+            'std_deviation': np.sqrt(variance),
+            'min_deviation': self.min,
+            'max_deviation': self.max,
+            'avg_deviation': self.mean,
+            # mean of the squares = variance + square of the mean
+            'accuracy_rmse': np.sqrt(variance + self.mean * self.mean),
+            'percentage_of_points_within_tolerance': self.within_tolerance / self.count * 100
+        }
+
+class DeviationHistogram:
+    """
+    Fixed-bin histogram of the deviations over [-extent, extent] (signed) or [0, extent], updated chunk by
+    chunk, with the counts below and above the range. The counts are kept on a grid `oversampling` times
+    finer than the exported bins, so the percentiles can be interpolated from it in the same pass.
+    """
+
+    def __init__(self, extent, bins=50, signed=True, oversampling=64):
+        self.low = -float(extent) if signed else 0.0
+        self.high = float(extent)
+        self.bins = bins
+        # Even, so that 0 is a fine bin edge and a signed histogram can be folded into absolute deviations
+        self.fine_bins = 2 * ((bins * oversampling + 1) // 2)
+        self.counts = np.zeros(self.fine_bins + 2, dtype=np.int64)  # [below, fine bins..., above]
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        """Adds a chunk of deviations"""
+        if len(values) == 0:
+            return
+        scaled = (np.asarray(values, dtype=np.float64) - self.low) * (self.fine_bins / (self.high - self.low))
+        index = np.clip(np.floor(scaled), -1, self.fine_bins).astype(np.int64) + 1
+        self.counts += np.bincount(index, minlength=self.fine_bins + 2)
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+
+    def histogram(self):
+        """Returns the exported histogram, in the format stored in Firestore"""
+        fine = self.counts[1:-1]
+        edges = np.linspace(0, self.fine_bins, self.bins + 1).round().astype(np.int64)
+        return {
+            'low': self.low,
+            'high': self.high,
+            'counts': [int(fine[a:b].sum()) for a, b in zip(edges[:-1], edges[1:])],
+            'below': int(self.counts[0]),
+            'above': int(self.counts[-1]),
+        }
+
+    def percentiles(self, qs, absolute=False):
+        """
+        Returns the percentiles of the deviations (or of their absolute values), interpolated within
+        the fine bins. Outside the range, they are interpolated up to the minimum or maximum deviation.
+        """
+        total = int(self.counts.sum())
+        if total == 0:
+            return [0.0 for _ in qs]
+        step = (self.high - self.low) / self.fine_bins
+        if absolute and self.low < 0:
+            # Fold the negative half onto the positive one
+            half = self.fine_bins // 2
+            counts = np.concatenate([[0], self.counts[1 + half:-1] + self.counts[half:0:-1],
+                                     [self.counts[0] + self.counts[-1]]])
+            low, fine_bins = 0.0, half
+            lowest, highest = 0.0, max(abs(self.min), abs(self.max), self.high)
+        else:
+            counts, low, fine_bins = self.counts, self.low, self.fine_bins
+            lowest, highest = min(self.min, self.low), max(self.max, self.high)
+        # edges[i] and edges[i + 1] bound the values counted in counts[i]
+        edges = np.concatenate([[lowest], low + np.arange(fine_bins + 1) * step, [highest]])
+        cumulative = np.concatenate([[0], np.cumsum(counts)])
+        return [float(np.interp(q / 100 * total, cumulative, edges)) for q in qs]
+
+class FaceStats:
+    """
+    Deviation statistics of each B-rep face of the CAD part, accumulated chunk by chunk.
+    Every point is attributed to the face of its closest triangle, and the statistics are group-by sums
+    over the face ids (np.bincount), so the cost does not depend on the number of faces.
+    """
+
+    def __init__(self, face_count, tolerance):
+        self.tolerance = tolerance
+        self.face_count = face_count
+        self.count = np.zeros(face_count, dtype=np.int64)
+        self.sum = np.zeros(face_count)
+        self.sum_abs = np.zeros(face_count)
+        self.sum_squares = np.zeros(face_count)
+        self.min = np.full(face_count, np.inf)
+        self.max = np.full(face_count, -np.inf)
+        self.within_tolerance = np.zeros(face_count, dtype=np.int64)
+
+    def update(self, faces, deviations):
+        """Adds a chunk of (signed) deviations, with the face of each point"""
+        deviations = np.asarray(deviations, dtype=np.float64)
+        absolute = np.abs(deviations)
+        self.count += np.bincount(faces, minlength=self.face_count)
+        self.sum += np.bincount(faces, deviations, self.face_count)
+        self.sum_abs += np.bincount(faces, absolute, self.face_count)
+        self.sum_squares += np.bincount(faces, deviations * deviations, self.face_count)
+        np.minimum.at(self.min, faces, deviations)
+        np.maximum.at(self.max, faces, deviations)
+        self.within_tolerance += np.bincount(faces[absolute <= self.tolerance], minlength=self.face_count)
+
+    def metrics(self, face_types=None):
+        """
+        Returns the statistics of the faces hit by at least one point, as columns (one list per metric,
+        one entry per face) in the format stored in Firestore.
+        """
+        faces = np.flatnonzero(self.count)
+        count = self.count[faces]
+        columns = {
+            'face': faces.tolist(),
+            'points': count.tolist(),
+            'avg_deviation': (self.sum_abs[faces] / count).tolist(),
+            'avg_signed_deviation': (self.sum[faces] / count).tolist(),
+            'accuracy_rmse': np.sqrt(self.sum_squares[faces] / count).tolist(),
+            'min_deviation': self.min[faces].tolist(),
+            'max_deviation': self.max[faces].tolist(),
+            'percentage_of_points_within_tolerance': (self.within_tolerance[faces] / count * 100).tolist(),
+        }
+        if face_types is not None:
+            columns['type'] = [str(face_types[face]) for face in faces]
+        return columns
+
+class Heatmap:
+    """
+    Aligned scan points with their deviation from the CAD and the heatmap colors.
+    The arrays are preallocated once and filled chunk by chunk.
+    """
+
+    def __init__(self, points, deviations, colors, color_range=(0.0, 1.0)):
+        self.points = points  # (N, 3) float32
+        self.deviations = deviations  # (N,) float32, signed when measured to the CAD surface
+        self.colors = colors  # (N, 3) uint8
+        self.color_range = color_range  # deviations at the blue and red ends of the colormap
+
+    def write_ply(self, ply_path, chunk_size=1000000):
+        """Writes the heatmap as a binary little-endian PLY with float positions and uchar colors"""
+        vertex = np.dtype([
+            ('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+            ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')
+        ])
+        header = "\n".join([
+            "ply",
+            "format binary_little_endian 1.0",
+            f"element vertex {len(self.points)}",
+            "property float x",
+            "property float y",
+            "property float z",
+            "property uchar red",
+            "property uchar green",
+            "property uchar blue",
+            "end_header",
+        ]) + "\n"
+
+        with open(ply_path, 'wb') as f:
+            f.write(header.encode('ascii'))
+            for start in range(0, len(self.points), chunk_size):
+                end = start + chunk_size
+                records = np.empty(len(self.points[start:end]), dtype=vertex)
+                records['x'], records['y'], records['z'] = self.points[start:end].T
+                records['red'], records['green'], records['blue'] = self.colors[start:end].T
+                f.write(records.tobytes())
+
+    def write_compact(self, path, precision=0.0001, codec='zstd'):
+        """Writes the heatmap in the compact format of heatmap_io (quantized positions and raw deviations)"""
+        heatmap_io.write_heatmap(path, self.points, self.deviations, self.color_range, precision, codec)
+
+    def write_lod(self, directory, levels=4, base_resolution=64, tile_depth=1, precision=0.0001, codec='zstd'):
+        """Writes the level-of-detail tiles and their index (see lod), returns their paths relative to directory"""
+        return lod.write_lod(directory, self.points, self.deviations, self.color_range, levels, base_resolution,
+                             tile_depth, precision, codec)
+
+def _jet_lut(size=256):
+    """Jet colormap sampled at size levels, blue (0) -> green (0.5) -> red (1)"""
+    values = np.linspace(0.0, 1.0, size)[:, None]
+    centers = np.array([3.0, 2.0, 1.0])
+    return (np.clip(1.5 - np.abs(4.0 * values - centers), 0.0, 1.0) * 255 + 0.5).astype(np.uint8)
+
+JET_LUT = _jet_lut()
+
+def apply_jet_colormap(values, out):
+    """
+    Writes the jet colors of values in [0, 1] into the uint8 (N, 3) out array, with a lookup table,
+    blue (0) -> green (0.5) -> red (1). Values outside [0, 1] get the color of the nearest end.
+    """
+    index = np.clip(values, 0.0, 1.0) * (len(JET_LUT) - 1) + 0.5
+    np.take(JET_LUT, index.astype(np.intp), axis=0, out=out)
+
+def compute_mesh_distances(points, mesh, scene=None, with_triangles=False):
+    """
+    Computes the signed point-to-surface distance of each point from a triangle mesh,
+    using a BVH raycasting scene. Positive distances are outside the surface (excess material),
+    negative ones inside (missing material), according to the triangle normals.
+    A scene already built on the mesh can be passed to query it chunk by chunk.
+    With with_triangles, also returns the index of the closest triangle of each point.
+    """
+    if scene is None:
+        scene = build_raycasting_scene(mesh)
+
+    query = o3d.core.Tensor(np.asarray(points, dtype=np.float32))
+    closest = scene.compute_closest_points(query)
+    offsets = np.asarray(points) - closest['points'].numpy()
+    normals = closest['primitive_normals'].numpy()
+
+    distances = np.linalg.norm(offsets, axis=1)
+    signed = np.where(np.einsum('ij,ij->i', offsets, normals) < 0, -distances, distances)
+    if with_triangles:
+        return signed, closest['primitive_ids'].numpy()
+    return signed
+
+def build_raycasting_scene(mesh):
+    """Builds the raycasting scene (BVH) of a triangle mesh"""
+    scene = o3d.t.geometry.RaycastingScene()
+    scene.add_triangles(o3d.t.geometry.TriangleMesh.from_legacy(mesh))
+    return scene
+
+def calculate_metrics(source_cleaned, target, final_transformation, tolerance_for_percentage, target_mesh=None,
+                      chunk_size=1000000, color_range=None, color_percentile=100.0, histogram_bins=50,
+                      histogram_extent=None, percentiles=(1, 5, 25, 50, 75, 95, 99), scene=None, face_ids=None,
+                      face_types=None):
+    """
+    Computes various metrics between the aligned source point cloud and the target.
+    If target_mesh is given, distances are measured to the CAD surface (signed), otherwise to the target points.
+    The points are processed in chunks with streaming statistics and preallocated outputs,
+    so the peak memory does not grow with copies of the whole scan.
+    The same pass fills a histogram of the deviations over [-histogram_extent, histogram_extent]
+    ([0, histogram_extent] if unsigned, 5 tolerances by default), the metrics include it with the given
+    percentiles.
+    The colormap saturates at color_range, by default at the color_percentile of the absolute deviations
+    (100 is the maximum deviation, which a single outlier can push far away from all the others).
+    A raycasting scene already built on target_mesh can be passed (see CadReference.raycasting_scene).
+    With face_ids (the B-rep face of each triangle of target_mesh), the metrics also have the statistics
+    of each face in 'faces' (see FaceStats).
+    Returns the Heatmap and the metrics.
+    """
+    source_points = np.asarray(source_cleaned.points)  # view on the Open3D buffer, no copy
+    total_points = len(source_points)
+    rotation = np.asarray(final_transformation)[:3, :3]
+    translation = np.asarray(final_transformation)[:3, 3]
+
+    if target_mesh is not None:
+        if scene is None:
+            scene = build_raycasting_scene(target_mesh)
     else:
-        percentage_within_tolerance = 0
+        # KD-tree on the target points, built once for all the chunks
+        nns = o3d.core.nns.NearestNeighborSearch(o3d.core.Tensor(np.asarray(target.points, dtype=np.float32)))
+        nns.knn_index()
+
+    heatmap = Heatmap(
+        np.empty((total_points, 3), dtype=np.float32),
+        np.empty(total_points, dtype=np.float32),
+        np.empty((total_points, 3), dtype=np.uint8)
+    )
+    stats = StreamingStats(tolerance_for_percentage)
+    histogram = DeviationHistogram(histogram_extent or 5 * tolerance_for_percentage, histogram_bins,
+                                   signed=target_mesh is not None)
+    face_stats = None
+    if target_mesh is not None and face_ids is not None:
+        face_ids = np.asarray(face_ids)
+        face_stats = FaceStats(int(face_ids.max()) + 1 if len(face_ids) else 0, tolerance_for_percentage)
+    signed_sum = 0.0
+
+    for start in range(0, total_points, chunk_size):
+        end = min(start + chunk_size, total_points)
+        aligned = source_points[start:end] @ rotation.T + translation
+        heatmap.points[start:end] = aligned
+
+        if target_mesh is not None:
+            # Compute signed point-to-surface distances
+            deviations, triangles = compute_mesh_distances(aligned, target_mesh, scene, with_triangles=True)
+            if face_stats is not None:
+                face_stats.update(face_ids[triangles], deviations)
+            signed_sum += float(np.sum(deviations))
+            distances = np.abs(deviations)
+        else:
+            # Compute point-to-point distances
+            _, squared = nns.knn_search(o3d.core.Tensor(heatmap.points[start:end]), 1)
+            deviations = distances = np.sqrt(squared.numpy()[:, 0].astype(np.float64))
+
+        heatmap.deviations[start:end] = deviations
+        stats.update(distances)
+        histogram.update(deviations)
 
     # Calculate metrics
-    metrics = {
-        'std_deviation': np.std(distances_np),
-        'min_deviation': np.min(distances_np),
-        'max_deviation': np.max(distances_np),
-        'avg_deviation': np.mean(distances_np),
-        'accuracy_rmse': np.sqrt(np.mean(np.square(distances_np))),
-        'percentage_of_points_within_tolerance': percentage_within_tolerance
-    }
-
-    # Create the heatmap point cloud for visualization
-    heatmap_pcd = copy.deepcopy(source_aligned)
-    cmap = o3d.visualization.utility.ColorMapJet()
-    
-    max_dist_for_color = metrics["max_deviation"]
+    metrics = stats.metrics()
+    if target_mesh is not None and total_points > 0:
+        metrics['avg_signed_deviation'] = signed_sum / total_points
+
+    if face_stats is not None:
+        metrics['faces'] = face_stats.metrics(face_types)
+    metrics['histogram'] = histogram.histogram()
+    metrics['percentiles'] = dict(zip((f"p{q:g}" for q in percentiles), histogram.percentiles(percentiles)))
+
+    # Fill the heatmap colors
+    if color_range is not None:
+        max_dist_for_color = color_range
+    elif color_percentile >= 100:
+        max_dist_for_color = metrics["max_deviation"]
+    else:
+        max_dist_for_color = histogram.percentiles([color_percentile], absolute=True)[0]
     if max_dist_for_color == 0: max_dist_for_color = 1.0 # Avoid division by zero
 
-    heatmap_pcd.colors = cmap.get_color(distances_np / max_dist_for_color)
+    if target_mesh is not None:
+        # Signed heatmap: green on the surface, red for excess and blue for missing material
+        heatmap.color_range = (-max_dist_for_color, max_dist_for_color)
+    else:
+        heatmap.color_range = (0.0, max_dist_for_color)
+
+    metrics['color_range'] = [float(value) for value in heatmap.color_range]
+
+    low, high = heatmap.color_range
+    for start in range(0, total_points, chunk_size):
+        end = start + chunk_size
+        normalized = (heatmap.deviations[start:end] - low) / (high - low)
+        apply_jet_colormap(normalized, heatmap.colors[start:end])
 
-    return heatmap_pcd, metrics
\ No newline at end of file
+    return heatmap, metrics
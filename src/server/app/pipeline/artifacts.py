@@ -0,0 +1,98 @@
+"""
+Intermediate results of the scans, stored in the pipeline cache so that re-running a scan only redoes what
+its inputs and settings invalidate. Each artifact is keyed by the keys of what it was computed from:
+
+    cleaned       scan content hash + preprocessing settings            the cleaned cloud
+    registration  cleaned key + CAD reference key + registration settings  the global and ICP transforms
+    result        registration key + analysis and heatmap settings      the metrics and the heatmap files
+
+A scan re-run with another analysis tolerance reuses its cleaned cloud and transforms, a scan retried after
+an upload failure finds its heatmap files. The manifest of a scan records the keys of its last run, so its
+artifacts can be found from the scan_id alone, e.g. to re-score it without its files (see worker.reanalyze_scan).
+"""
+import json
+import os
+import tempfile
+import numpy as np
+import open3d as o3d
+from . import cache
+
+# Bump when the content of the artifacts changes, to invalidate the old entries
+# (2: float32 cleaned clouds, tolerance stored in the metrics of the results, 3: RANSAC budget split across
+# the hypotheses)
+ARTIFACTS_VERSION = 3
+
+def artifact_keys(scan_hash, reference_key, preprocessing, registration, analysis):
+    """Returns the keys of the artifacts of a scan, from its content hash and the settings of each step"""
+    cleaned = cache.make_key('cleaned', ARTIFACTS_VERSION, scan_hash, preprocessing)
+    registration = cache.make_key('registration', ARTIFACTS_VERSION, cleaned, reference_key, registration)
+    return {'cleaned': cleaned, 'registration': registration, 'result': result_key(registration, analysis)}
+
+def result_key(registration_key, analysis):
+    """Returns the key of the result of a registration with other analysis settings, e.g. another tolerance"""
+    return cache.make_key('result', ARTIFACTS_VERSION, registration_key, analysis)
+
+def load_cleaned(cache_dir, key):
+    """Returns the cleaned point cloud, or None"""
+    arrays = cache.load_arrays(cache_dir, 'cleaned', key)
+    if arrays is None:
+        return None
+    return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(arrays['points'].astype(np.float64)))
+
+def save_cleaned(cache_dir, key, pcd):
+    """Stores the cleaned point cloud in float32 (well below the scanner noise) and compressed, the largest artifact"""
+    cache.save_arrays(cache_dir, 'cleaned', key, compressed=True,
+                      points=np.asarray(pcd.points, dtype=np.float32))
+
+def load_registration(cache_dir, key):
+    """Returns the (global, final) transformations, or None"""
+    arrays = cache.load_arrays(cache_dir, 'registrations', key)
+    if arrays is None:
+        return None
+    return arrays['initial_transform'], arrays['final_transform']
+
+def save_registration(cache_dir, key, initial_transform, final_transform):
+    cache.save_arrays(cache_dir, 'registrations', key, initial_transform=np.asarray(initial_transform),
+                      final_transform=np.asarray(final_transform))
+
+def load_result(cache_dir, key, directory):
+    """
+    Copies the heatmap files of the result into the directory.
+    Returns (files, metrics), files being [relative path, storage path suffix] pairs, or None.
+    """
+    metadata = cache.load_files(cache_dir, 'results', key, directory)
+    if metadata is None:
+        return None
+    return metadata['outputs'], metadata['metrics']
+
+def save_result(cache_dir, key, directory, outputs, metrics):
+    """Stores the heatmap files of the directory, outputs being [relative path, storage path suffix] pairs"""
+    # Through JSON, with the numpy scalars converted to Python numbers
+    metrics = json.loads(json.dumps(metrics, default=lambda value: value.item()))
+    cache.save_files(cache_dir, 'results', key, directory, [name for name, _ in outputs], outputs=outputs,
+                     metrics=metrics)
+
+def _manifest_path(cache_dir, scan_id):
+    return os.path.join(cache_dir, 'manifests', f"{scan_id}.json")
+
+def read_manifest(cache_dir, scan_id):
+    """
+    Returns the manifest of the last run of the scan, or None. The manifests are evicted like the artifacts
+    (see cache.evict), a read marks the manifest as used.
+    """
+    path = _manifest_path(cache_dir, scan_id)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return manifest
+
+def write_manifest(cache_dir, scan_id, manifest):
+    """Replaces the manifest of the scan"""
+    path = _manifest_path(cache_dir, scan_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+        json.dump(manifest, f)
+    os.replace(f.name, path)
@@ -0,0 +1,129 @@
+"""
+Scale-aware pipeline parameters, derived from the size of the part and the density of the scan
+instead of fixed lengths that only suit parts of one size.
+"""
+import numpy as np
+import open3d as o3d
+
+# Numpy types of the PLY property types
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+def sample_ply_points(path, sample_size=50000, seed=0):
+    """
+    Returns (sample of the points, total number of points) of a binary PLY file, reading only the sampled
+    vertices instead of parsing the whole scan. Returns None for the files it can't sample this way
+    (ASCII, vertices not first or with list properties), which must be read entirely.
+    """
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            return None
+        endianness, count, fields, element = None, None, [], None
+        for line in iter(f.readline, b''):
+            words = line.decode('ascii', 'replace').split()
+            if not words or words[0] in ('comment', 'obj_info'):
+                continue
+            if words[0] == 'end_header':
+                break
+            if words[0] == 'format':
+                endianness = {'binary_little_endian': '<', 'binary_big_endian': '>'}.get(words[1])
+            elif words[0] == 'element':
+                if element is not None:
+                    # The vertices are followed by other elements (e.g. faces), which don't matter
+                    element = 'other'
+                    continue
+                if words[1] != 'vertex':
+                    return None
+                element, count = 'vertex', int(words[2])
+            elif words[0] == 'property' and element == 'vertex':
+                if words[1] == 'list' or words[1] not in PLY_TYPES:
+                    return None
+                fields.append((words[2], endianness + PLY_TYPES[words[1]] if endianness else None))
+        else:
+            return None
+        offset = f.tell()
+
+    names = [name for name, _ in fields]
+    if endianness is None or count is None or not {'x', 'y', 'z'} <= set(names):
+        return None
+    vertices = np.memmap(path, dtype=np.dtype(fields), mode='r', offset=offset, shape=(count,))
+    if count > sample_size:
+        vertices = vertices[np.sort(np.random.default_rng(seed).choice(count, sample_size, replace=False))]
+    return np.column_stack([vertices['x'], vertices['y'], vertices['z']]).astype(np.float64), count
+
+def estimate_spacing(points, sample_size=50000, neighbors=8, seed=0, total=None):
+    """
+    Estimates the spacing of a scan, the side of the surface area per point (1 / sqrt(density)).
+    The density is measured on a random sample of the points from the distance to their k-th
+    nearest neighbour: a disc of that radius holds about k - 1/3 sample points (median of the
+    Poisson case). The sample keeps a fraction f of the points, so its spacing is scaled by sqrt(f).
+    points can already be a random sample of a scan of `total` points (see sample_ply_points).
+    """
+    points = np.asarray(points)
+    total = total or len(points)
+    if len(points) <= neighbors:
+        return 0.0
+    if len(points) > sample_size:
+        rng = np.random.default_rng(seed)
+        points = points[rng.choice(len(points), sample_size, replace=False)]
+
+    sample = o3d.core.Tensor(np.ascontiguousarray(points, dtype=np.float32))
+    nns = o3d.core.nns.NearestNeighborSearch(sample)
+    nns.knn_index()
+    # The first neighbour of each point is itself
+    _, squared = nns.knn_search(sample, neighbors + 1)
+    area_per_point = np.pi * float(np.median(squared.numpy()[:, neighbors])) / (neighbors - 1 / 3)
+    return float(np.sqrt(area_per_point * len(points) / total))
+
+def bounding_box_diagonal(points):
+    """Length of the diagonal of the axis-aligned bounding box of the points"""
+    points = np.asarray(points)
+    if len(points) == 0:
+        return 0.0
+    return float(np.linalg.norm(points.max(axis=0) - points.min(axis=0)))
+
+def snap_log2(value):
+    """
+    Rounds a length to the nearest power of two. Parts of similar size get the same voxel size,
+    which keeps the cached CAD features valid across scans.
+    """
+    return float(2.0 ** np.round(np.log2(value)))
+
+def derive_parameters(spacing, diagonal, feature_cells=40, min_spacing_factor=2.0, icp_spacing_factor=5.0,
+                      plane_spacing_factor=3.0, outlier_spacing_factor=3.0,
+                      cluster_spacing_factor=5.0, fallback=None):
+    """
+    Derives the length parameters of the pipeline from the scan spacing and the part diagonal:
+      voxel_size                 about diagonal / feature_cells, snapped to a power of two, and at least
+                                 min_spacing_factor * spacing so every voxel holds some points
+      normal_radius, fpfh_radius the radii used with that voxel size (see registration.compute_features)
+      icp_threshold              a few spacings, enough for the noise and the residual of the voxel pyramid
+      plane_distance_threshold   a few spacings, much less than the height of any part
+      outlier_voxel_size         a few spacings, so the voxels around a surface point hold dozens of points
+      cluster_eps                a few spacings, to bridge the holes of the scan but not the gaps between objects
+    When the spacing or the diagonal is 0 (e.g. a scan of duplicated points, or too few of them), the lengths
+    would be 0 too, and divide the voxel filters: the fallback parameters (the fixed ones) are returned instead.
+    """
+    if not (spacing > 0 and diagonal > 0):
+        if fallback is None:
+            raise ValueError(f"Cannot derive the parameters from a spacing of {spacing} and a diagonal of {diagonal}")
+        return dict(fallback)
+    voxel_size = snap_log2(max(diagonal / feature_cells, spacing * min_spacing_factor))
+    if voxel_size < spacing * min_spacing_factor:
+        # Rounded down below the minimum
+        voxel_size *= 2
+    return {
+        'spacing': spacing,
+        'diagonal': diagonal,
+        'voxel_size': voxel_size,
+        'normal_radius': voxel_size * 2,
+        'fpfh_radius': voxel_size * 5,
+        'icp_threshold': max(spacing * icp_spacing_factor, voxel_size * 0.5),
+        'plane_distance_threshold': spacing * plane_spacing_factor,
+        'outlier_voxel_size': spacing * outlier_spacing_factor,
+        'cluster_eps': spacing * cluster_spacing_factor,
+    }
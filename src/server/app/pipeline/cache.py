@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """Returns the SHA-256 hex digest of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def make_key(*parts):
+    """Builds a cache key from content hashes and parameters (anything JSON serializable)"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _entry_path(cache_dir, kind, key):
+    return os.path.join(cache_dir, kind, key[:2], f"{key}.npz")
+
+def _touch(path):
+    """Marks an entry as used, evict() removes the least recently used entries first"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def load_arrays(cache_dir, kind, key):
+    """Returns the arrays stored under the key as a dict, or None on a cache miss"""
+    path = _entry_path(cache_dir, kind, key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {name: data[name] for name in data.files}
+    except Exception:
+        # Unreadable entry (e.g. truncated by a crash before the rename): treat it as a miss
+        return None
+    _touch(path)
+    return arrays
+
+def save_arrays(cache_dir, kind, key, compressed=False, **arrays):
+    """
+    Stores the arrays under the key, zip-compressed if compressed (smaller, but slower to read and write).
+    The entry is written to a temporary file and renamed, so concurrent workers never see a partial entry.
+    """
+    path = _entry_path(cache_dir, kind, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+        temp_path = f.name
+        try:
+            (np.savez_compressed if compressed else np.savez)(f, **arrays)
+        except Exception:
+            f.close()
+            os.remove(temp_path)
+            raise
+    os.replace(temp_path, path)
+
+def _directory_path(cache_dir, kind, key):
+    return os.path.join(cache_dir, kind, key[:2], key)
+
+def load_files(cache_dir, kind, key, directory):
+    """
+    Copies the files stored under the key into the directory, keeping their relative paths.
+    Returns the metadata stored with them, or None on a cache miss.
+    """
+    path = _directory_path(cache_dir, kind, key)
+    try:
+        with open(os.path.join(path, 'metadata.json')) as f:
+            metadata = json.load(f)
+        for name in metadata['files']:
+            destination = os.path.join(directory, name)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copyfile(os.path.join(path, 'files', name), destination)
+    except (OSError, ValueError, KeyError):
+        return None
+    _touch(path)
+    return metadata
+
+def save_files(cache_dir, kind, key, directory, names, **metadata):
+    """
+    Stores copies of the files of the directory (paths relative to it) under the key, with JSON metadata.
+    The entry is assembled in a temporary directory and renamed, like save_arrays. If another worker
+    stored the same key in the meantime, its entry is kept.
+    """
+    path = _directory_path(cache_dir, kind, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temp_path = tempfile.mkdtemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        for name in names:
+            destination = os.path.join(temp_path, 'files', name)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copyfile(os.path.join(directory, name), destination)
+        with open(os.path.join(temp_path, 'metadata.json'), 'w') as f:
+            json.dump({**metadata, 'files': list(names)}, f)
+        os.rename(temp_path, path)
+    except OSError:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+def _entry_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def evict(cache_dir, max_bytes=None, max_age=None):
+    """
+    Removes the entries not used for more than max_age seconds, then the least recently used ones
+    until the cache takes at most max_bytes (None for no limit). The last use of an entry is its
+    modification time, updated by the loads. The files directly under a kind directory (the manifests
+    of artifacts.py) are entries too, evicted with the same policy. Returns (removed entries, removed bytes).
+    Another process may remove or use the same entries concurrently: an entry used again while it is
+    being evicted is simply a miss for its next load.
+    """
+    items = []
+    for entry in os.scandir(cache_dir) if os.path.isdir(cache_dir) else ():
+        if not entry.is_dir():
+            continue
+        for prefix in os.scandir(entry.path):
+            if prefix.is_dir():
+                items.extend(os.scandir(prefix.path))
+            else:
+                items.append(prefix)
+
+    entries = []
+    for item in items:
+        # The temporary entries of the saves in progress are left alone
+        if item.name.endswith('.tmp'):
+            continue
+        try:
+            entries.append((item.stat().st_mtime, _entry_size(item.path), item.path))
+        except OSError:
+            continue
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    now = time.time()
+    removed, removed_bytes = 0, 0
+    for mtime, size, path in entries:
+        expired = max_age is not None and now - mtime > max_age
+        if not expired and (max_bytes is None or total <= max_bytes):
+            break
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+        removed_bytes += size
+    return removed, removed_bytes
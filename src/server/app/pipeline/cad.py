@@ -0,0 +1,78 @@
+import cadquery as cq
+import numpy as np
+import open3d as o3d
+from OCP.BRep import BRep_Tool
+from OCP.TopLoc import TopLoc_Location
+
+def tessellate_step(step_path, tolerance, with_faces=False):
+    """
+    Imports a STEP file with CadQuery and tessellates it.
+    Returns the vertices as a (N, 3) float64 array and the triangles as a (M, 3) int32 array.
+    With with_faces, also returns the B-rep face of each triangle as a (M,) int32 array of indices
+    into shape.Faces(), and the geometry type of each face ("PLANE", "CYLINDER", ...).
+    """
+    result = cq.importers.importStep(step_path)
+    shape = result.val()
+
+    # The tolerance controls mesh density (smaller = more detailed)
+    vertices, faces = shape.tessellate(tolerance)
+
+    vertices_np = np.array([v.toTuple() for v in vertices], dtype=np.float64).reshape(-1, 3)
+    triangles_np = np.array(faces, dtype=np.int32).reshape(-1, 3)
+    if not with_faces:
+        return vertices_np, triangles_np
+
+    # tessellate() appends the triangles face by face, in the order of Faces()
+    counts, types = [], []
+    for face in shape.Faces():
+        triangulation = BRep_Tool.Triangulation_s(face.wrapped, TopLoc_Location())
+        counts.append(triangulation.NbTriangles() if triangulation is not None else 0)
+        types.append(face.geomType())
+    face_ids = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+    if len(face_ids) != len(triangles_np):
+        raise ValueError(f"Face triangles ({len(face_ids)}) don't match the tessellation ({len(triangles_np)})")
+    return vertices_np, triangles_np, face_ids, np.array(types, dtype=str)
+
+def write_ply(ply_path, vertices, triangles=None):
+    """
+    Writes vertices (and optionally triangles) as a binary little-endian PLY file.
+    The arrays are written in a single block each, without any per-element Python loop.
+    """
+    vertices = np.ascontiguousarray(vertices, dtype='<f4')
+
+    header = [
+        "ply",
+        "format binary_little_endian 1.0",
+        f"element vertex {len(vertices)}",
+        "property float x",
+        "property float y",
+        "property float z",
+    ]
+    faces = None
+    if triangles is not None:
+        # Packed record: uchar vertex count followed by three int indices (13 bytes per face)
+        faces = np.empty(len(triangles), dtype=[('count', 'u1'), ('indices', '<i4', (3,))])
+        faces['count'] = 3
+        faces['indices'] = triangles
+        header += [
+            f"element face {len(faces)}",
+            "property list uchar int vertex_indices",
+        ]
+    header.append("end_header")
+
+    with open(ply_path, 'wb') as f:
+        f.write(("\n".join(header) + "\n").encode('ascii'))
+        f.write(vertices.tobytes())
+        if faces is not None:
+            f.write(faces.tobytes())
+
+def to_point_cloud(vertices):
+    """Builds an Open3D point cloud from the tessellation vertices, without going through a file"""
+    return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(vertices))
+
+def to_triangle_mesh(vertices, triangles):
+    """Builds an Open3D triangle mesh from the tessellation arrays, without going through a file"""
+    return o3d.geometry.TriangleMesh(
+        o3d.utility.Vector3dVector(vertices),
+        o3d.utility.Vector3iVector(triangles)
+    )
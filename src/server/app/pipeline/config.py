@@ -1,16 +1,136 @@
+import os
+
+# --- CAD Parameters ---
+# STEP tessellation tolerance (smaller = more detailed mesh)
+TOLERANCE = 0.01
+# Persistent cache of the CAD references (tessellation, normals and features), keyed by STEP content hash
+CACHE_DIR = os.getenv("PIPELINE_CACHE_DIR", "data/cache")
+# Also cache the cleaned scans, the registrations and the results in CACHE_DIR (see artifacts.py), so a scan
+# run again only redoes the steps whose inputs or settings changed
+ARTIFACT_CACHE = True
+# Size limit of CACHE_DIR, and age (days since the last use) after which an entry is removed. The least
+# recently used entries are evicted first, at most every CACHE_EVICTION_INTERVAL seconds (see cache.evict)
+CACHE_MAX_BYTES = int(os.getenv("PIPELINE_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+CACHE_MAX_AGE_DAYS = 30
+CACHE_EVICTION_INTERVAL = 600
+
+# --- Auto-tuning Parameters ---
+# Derive the voxel size, the ICP threshold and the plane distance from the part size and the scan spacing
+# (see autotune.py). When disabled, the fixed VOXEL_SIZE_FEATURES, ICP_THRESHOLD and PLANE_DISTANCE_THRESHOLD are used.
+# Off by default: it changes the registration and cleaning parameters of every scan
+AUTOTUNE = False
+# Scan points sampled to estimate the spacing
+AUTOTUNE_SAMPLE_SIZE = 50000
+# Voxels along the diagonal of the part for the features (the voxel size is then snapped to a power of two)
+AUTOTUNE_FEATURE_CELLS = 40
+# Minimum voxel size, in scan spacings
+AUTOTUNE_MIN_SPACING_FACTOR = 2.0
+# ICP threshold and plane distance threshold, in scan spacings
+AUTOTUNE_ICP_SPACING_FACTOR = 5.0
+AUTOTUNE_PLANE_SPACING_FACTOR = 3.0
+# Voxel size of the outlier filters, in scan spacings
+AUTOTUNE_OUTLIER_SPACING_FACTOR = 3.0
+# Clustering distance of the object isolation, in scan spacings
+AUTOTUNE_CLUSTER_SPACING_FACTOR = 5.0
+# Spacing of the CAD target cloud sampled on the surface, in voxel sizes (0 keeps the tessellation vertices).
+# 0.25 suits the voxel sizes of AUTOTUNE, the fixed VOXEL_SIZE_FEATURES is too coarse for it
+CAD_SAMPLE_SPACING_FACTOR = 0
+
 # --- Preprocessing Parameters ---
 # RANSAC plane segmentation: Max distance from a point to be considered in the plane.
 PLANE_DISTANCE_THRESHOLD = 0.02
+# Outlier filter (see preprocess.segment_and_clean): "statistical" (k-NN of every point), "voxel_statistical"
+# (k-NN of the voxel centroids) or "radius_voxel" (points counted in the neighbouring voxels, the fastest,
+# but it removes sparse regions the statistical filter keeps)
+OUTLIER_METHOD = "statistical"
 # Statistical outlier removal
 OUTLIER_NB_NEIGHBORS = 20
 OUTLIER_STD_RATIO = 2.0
+# Voxel size of the voxel filters when AUTOTUNE is disabled
+OUTLIER_VOXEL_SIZE = 0.002
+# radius_voxel: minimum number of points in the 3 x 3 x 3 voxels around a point
+OUTLIER_MIN_POINTS = 8
+# Object isolation: removes the walls and fixtures around the part, not only the main plane, then keeps
+# the largest cluster of what is left (see preprocess.remove_planes and preprocess.largest_cluster).
+# Off by default: a scan of the part alone keeps the previous single-plane cleaning
+ISOLATION = False
+# Planes removed at most, the first one (floor or table) included
+ISOLATION_MAX_PLANES = 3
+# Minimum size of the planes after the first one, as a fraction of the scan points
+# (they must also be wider than the part, so its own faces are never removed)
+ISOLATION_MIN_PLANE_RATIO = 0.05
+# Clustering backend: "voxel" (connected components of a voxel grid, fast) or "dbscan" (Open3D DBSCAN)
+CLUSTER_METHOD = "voxel"
+# Clustering distance when AUTOTUNE is disabled
+CLUSTER_EPS = 0.02
+# Minimum number of neighbouring points of a cluster point
+CLUSTER_MIN_POINTS = 10
 
 # --- Registration Parameters ---
 # Voxel size for feature computation (key parameter for global registration)
 VOXEL_SIZE_FEATURES = 0.05
+# Global registration backend: "ransac" (RANSAC on FPFH matches) or "fgr" (Fast Global Registration)
+GLOBAL_REGISTRATION_BACKEND = "ransac"
+# Backend used when the selected one fails (e.g. FGR finds no correspondence), None to fail the scan
+GLOBAL_REGISTRATION_FALLBACK = "ransac"
+# RANSAC convergence criteria
+RANSAC_MAX_ITERATION = 100000
+RANSAC_CONFIDENCE = 0.999
 # ICP refinement distance threshold
 ICP_THRESHOLD = 0.02
+# Maximum ICP iterations at full resolution
+ICP_MAX_ITERATION = 2000
+# "multiscale": FPFH + RANSAC on the coarsest voxel level, then ICP from coarse to fine and at full resolution
+# "full": FPFH + RANSAC and ICP on the full resolution clouds
+REGISTRATION_MODE = "multiscale"
+# Voxel sizes of the pyramid as multiples of VOXEL_SIZE_FEATURES, from coarse to fine
+VOXEL_PYRAMID_FACTORS = [1.0, 0.5, 0.25]
+# ICP iterations at each level of the pyramid
+ICP_PYRAMID_ITERATIONS = [50, 30, 20]
+# ICP variant: "point_to_point" or "point_to_plane" (uses the CAD normals)
+ICP_METHOD = "point_to_point"
+# Multi-hypothesis ICP: global registration runs, sharing the RANSAC iteration budget, refined before keeping
+# the best one (1 disables it)
+ICP_HYPOTHESES = 4
+# ICP iterations per successive-halving round of the hypotheses
+ICP_HYPOTHESIS_ITERATIONS = 10
+# Processes used to refine the hypotheses (per scan). The scans already run in a pool of PIPELINE_WORKERS
+# processes, more than 1 nests a pool in each of them: only worth it with a single pipeline worker
+ICP_HYPOTHESIS_WORKERS = 1
 
 # --- Analysis Parameters ---
 # Tolerance for percentage of points within this distance to be considered "good"
-ANALYSIS_TOLERANCE_METERS = 0.01 # Units in meters
\ No newline at end of file
+ANALYSIS_TOLERANCE_METERS = 0.01 # Units in meters
+# Deviations measured to the CAD surface ("mesh", signed and exact with any tessellation) or to its vertices ("points")
+ANALYSIS_DISTANCE_METHOD = "mesh"
+# Deviation statistics of each B-rep face of the part, written to face_stats/{scan_id} (needs the "mesh" method)
+ANALYSIS_PER_FACE = True
+# Points per chunk in the metrics computation (bounds the temporary memory of each step)
+ANALYSIS_CHUNK_SIZE = 1000000
+# Deviation histogram of the stats: bins over [-range, range] (signed deviations) or [0, range],
+# the range being a multiple of ANALYSIS_TOLERANCE_METERS
+HISTOGRAM_BINS = 50
+HISTOGRAM_RANGE_TOLERANCES = 5.0
+# Percentiles of the deviations stored in the stats
+STATS_PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+# --- Heatmap Output Parameters ---
+# Deviation at the ends of the colormap (red, and blue when signed), None to use HEATMAP_COLOR_PERCENTILE
+HEATMAP_COLOR_RANGE = None # Units in meters
+# Percentile of the absolute deviations used as the end of the colormap when HEATMAP_COLOR_RANGE is None
+# (100 is the maximum deviation, a single outlier then squeezes all the other points into the green)
+HEATMAP_COLOR_PERCENTILE = 99.0
+# "ply" (colored binary PLY, read by the apps), "compact" (heatmap_io format with the raw deviations) or "both"
+HEATMAP_FORMAT = "ply"
+# Compression of the compact format ("zstd", falls back to "zlib" if zstandard is not installed)
+HEATMAP_CODEC = "zstd"
+# Quantization step of the positions in the compact format
+HEATMAP_POSITION_PRECISION = 0.0001 # Units in meters
+# Also write a level-of-detail pyramid of compact tiles, under comparisons/{scan_id}/lod/ (see lod.py).
+# Off by default: the apps only read the PLY heatmap, the tiles would be uploaded for no reader
+HEATMAP_LOD = False
+# Levels of the pyramid, the last one has all the remaining points
+LOD_LEVELS = 4
+# Grid cells across the largest side of the bounding box at level 0 (one point per cell)
+LOD_BASE_RESOLUTION = 64
+# Octree depth of the tiles of the levels after the first one (1 = 8 tiles per level)
+LOD_TILE_DEPTH = 1
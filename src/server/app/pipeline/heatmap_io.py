@@ -0,0 +1,131 @@
+"""
+Compact heatmap format (.hmap), about an order of magnitude smaller than the binary PLY.
+
+The colors are not stored: they are derived from the deviation of each point, which is kept
+(the PLY only has the colors). Layout, little endian:
+
+  header   magic b'HMAP', version (uint8), codec (uint8: 0 none, 1 zlib, 2 zstd), reserved (uint16),
+           point count (uint32), bounding box min and max (3 + 3 float32),
+           color range (2 float32: the deviations mapped to the two ends of the jet colormap)
+  payload  compressed with the codec: x, y, z quantized to uint16 in the bounding box, then the
+           deviations as float16. Each array is byte-shuffled (all the low bytes, then all the high bytes),
+           which groups the slowly changing high bytes and helps the compression.
+
+The points are stored in Morton (Z-order) order, so consecutive points are close in space.
+"""
+import struct
+import warnings
+import zlib
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # In the requirements, zlib is used (with a warning) when it is not installed
+    zstandard = None
+
+MAGIC = b'HMAP'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHI3f3f2f')
+CODECS = {'none': 0, 'zlib': 1, 'zstd': 2}
+QUANTIZATION_LEVELS = 65535
+
+def _shuffle(array):
+    """Splits a 2-byte array into its low bytes followed by its high bytes"""
+    return np.ascontiguousarray(array.view(np.uint8).reshape(-1, 2).T).tobytes()
+
+def _unshuffle(buffer, dtype, count):
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(2, count).T.copy().view(dtype).reshape(count)
+
+def _morton_order(quantized):
+    """Returns the permutation sorting the quantized points along the Z-order curve"""
+    codes = np.zeros(len(quantized), dtype=np.uint64)
+    for axis in range(3):
+        spread = quantized[:, axis].astype(np.uint64)
+        # Spreads the 16 bits of the coordinate to every third bit
+        spread = (spread | (spread << np.uint64(16))) & np.uint64(0x0000FF0000FF)
+        spread = (spread | (spread << np.uint64(8))) & np.uint64(0x00F00F00F00F)
+        spread = (spread | (spread << np.uint64(4))) & np.uint64(0x0C30C30C30C3)
+        spread = (spread | (spread << np.uint64(2))) & np.uint64(0x249249249249)
+        codes |= spread << np.uint64(axis)
+    return np.argsort(codes, kind='stable')
+
+def _compress(payload, codec, level):
+    if codec == 'zstd':
+        if zstandard is None:
+            warnings.warn("The zstandard module is not installed, the heatmaps are compressed with zlib",
+                          RuntimeWarning)
+            codec = 'zlib'
+        else:
+            return CODECS[codec], zstandard.ZstdCompressor(level=level or 10).compress(payload)
+    if codec == 'zlib':
+        return CODECS[codec], zlib.compress(payload, level or 6)
+    if codec == 'none':
+        return CODECS[codec], payload
+    raise ValueError(f"Unknown heatmap codec '{codec}', expected one of {list(CODECS)}")
+
+def _decompress(payload, codec_id):
+    if codec_id == CODECS['zstd']:
+        if zstandard is None:
+            raise ValueError("The heatmap is compressed with zstd, but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if codec_id == CODECS['zlib']:
+        return zlib.decompress(payload)
+    return payload
+
+def encode_heatmap(points, deviations, color_range, precision=0.0001, codec='zstd', level=None):
+    """
+    Encodes the heatmap points and deviations in the compact format, returns the bytes.
+    The positions are quantized with a step of `precision` (meters), or coarser where the bounding box
+    spans more than 65535 steps of it. With codec 'zstd', zlib is used (with a RuntimeWarning) if the
+    zstandard module is not installed.
+    """
+    points = np.asarray(points, dtype=np.float32)
+    count = len(points)
+    low = points.min(axis=0) if count else np.zeros(3, dtype=np.float32)
+    high = points.max(axis=0) if count else np.zeros(3, dtype=np.float32)
+    step = np.maximum((high - low) / QUANTIZATION_LEVELS, precision).astype(np.float32)
+
+    quantized = np.clip(np.rint((points - low) / step), 0, QUANTIZATION_LEVELS).astype(np.uint16)
+    order = _morton_order(quantized)
+    quantized = quantized[order]
+    deviations = np.asarray(deviations, dtype=np.float16)[order]
+
+    # Neighbours along the curve have close coordinates, their differences are small and compress well
+    deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, 3), dtype=np.uint16))
+    payload = b''.join([_shuffle(np.ascontiguousarray(deltas[:, axis])) for axis in range(3)]
+                       + [_shuffle(deviations)])
+    codec_id, payload = _compress(payload, codec, level)
+    header = HEADER.pack(MAGIC, VERSION, codec_id, 0, count, *low, *step, *color_range)
+    return header + payload
+
+def decode_heatmap(data):
+    """
+    Decodes a compact heatmap, returns (points (N, 3) float32, deviations (N,) float32, color range).
+    Positions are exact to 1/65535 of the bounding box, deviations to 3 significant digits.
+    """
+    magic, version, codec_id, _, count, *values = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a compact heatmap, or an unsupported version")
+    low, step = np.array(values[0:3], dtype=np.float32), np.array(values[3:6], dtype=np.float32)
+    color_range = tuple(values[6:8])
+
+    payload = _decompress(data[HEADER.size:], codec_id)
+    stride = count * 2
+    deltas = np.stack(
+        [_unshuffle(payload[axis * stride:(axis + 1) * stride], np.uint16, count) for axis in range(3)], axis=1)
+    # uint16 arithmetic wraps around like the encoder's differences
+    quantized = np.cumsum(deltas, axis=0, dtype=np.uint16)
+    deviations = _unshuffle(payload[3 * stride:4 * stride], np.float16, count).astype(np.float32)
+
+    points = quantized.astype(np.float32) * step + low
+    return points, deviations, color_range
+
+def write_heatmap(path, points, deviations, color_range, precision=0.0001, codec='zstd', level=None):
+    """Writes the heatmap in the compact format"""
+    with open(path, 'wb') as f:
+        f.write(encode_heatmap(points, deviations, color_range, precision, codec, level))
+
+def read_heatmap(path):
+    """Reads a compact heatmap file, see decode_heatmap"""
+    with open(path, 'rb') as f:
+        return decode_heatmap(f.read())
@@ -0,0 +1,121 @@
+"""
+Level-of-detail pyramid of the heatmap, for viewers that stream the points progressively.
+
+Level 0 is a coarse preview with one point per cell of a grid over the bounding box. Each next level adds
+the points of a grid twice as fine that are not already in the previous levels, and the last level
+adds all the remaining points, so the union of the levels is the whole heatmap without duplicates.
+Level 0 is a single tile; the other levels are split into the cells of an octree over the bounding box,
+so a viewer can fetch the detail of the visible regions only.
+
+Every tile is a compact heatmap (see heatmap_io). index.json lists the levels and their tiles,
+with paths relative to the index.
+"""
+import json
+import os
+import numpy as np
+from . import heatmap_io
+
+INDEX_VERSION = 1
+
+def _grid_keys(points, low, cell_size):
+    """Returns one integer key per point, identifying its cell in a grid of the given cell size"""
+    cells = np.floor((points - low) / cell_size).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    return (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+
+def _octree_cells(points, low, size, depth):
+    """Returns the octree cell id of each point at the given depth, as an octal path ('' for the root)"""
+    if depth == 0:
+        return np.full(len(points), '', dtype=object), {'': (low, low + size)}
+    resolution = 2 ** depth
+    cells = np.clip(np.floor((points - low) / size * resolution), 0, resolution - 1).astype(np.int64)
+    codes = np.zeros(len(points), dtype=np.int64)
+    for bit in range(depth - 1, -1, -1):
+        codes = codes * 8 + ((cells[:, 0] >> bit) & 1) * 4 + ((cells[:, 1] >> bit) & 1) * 2 + ((cells[:, 2] >> bit) & 1)
+
+    ids = np.empty(len(points), dtype=object)
+    bounds = {}
+    for code in np.unique(codes):
+        cell_id = np.base_repr(int(code), 8).zfill(depth)
+        ids[codes == code] = cell_id
+        cell = cells[np.argmax(codes == code)]
+        bounds[cell_id] = (low + cell * size / resolution, low + (cell + 1) * size / resolution)
+    return ids, bounds
+
+def build_levels(points, levels=4, base_resolution=64):
+    """
+    Splits the points into LOD levels, returns one index array per level (possibly fewer if
+    the points run out). Level l keeps one point per cell of size extent / (base_resolution * 2^l).
+    """
+    points = np.asarray(points)
+    if len(points) == 0:
+        return []
+    low = points.min(axis=0)
+    extent = float(np.max(points.max(axis=0) - low)) or 1.0
+
+    remaining = np.arange(len(points))
+    result = []
+    for level in range(levels):
+        if len(remaining) == 0:
+            break
+        if level == levels - 1:
+            result.append(remaining)
+            break
+        cell_size = extent / (base_resolution * 2 ** level)
+        _, first = np.unique(_grid_keys(points[remaining], low, cell_size), return_index=True)
+        selected = np.zeros(len(remaining), dtype=bool)
+        selected[first] = True
+        result.append(remaining[selected])
+        remaining = remaining[~selected]
+    return result
+
+def write_lod(directory, points, deviations, color_range, levels=4, base_resolution=64, tile_depth=1,
+              precision=0.0001, codec='zstd'):
+    """
+    Writes the LOD tiles and their index.json into the directory.
+    Returns the paths of the written files relative to the directory, index.json last,
+    so it can be uploaded after the tiles it references.
+    """
+    points = np.asarray(points, dtype=np.float32)
+    deviations = np.asarray(deviations, dtype=np.float32)
+    os.makedirs(directory, exist_ok=True)
+
+    low = points.min(axis=0) if len(points) else np.zeros(3, dtype=np.float32)
+    high = points.max(axis=0) if len(points) else np.zeros(3, dtype=np.float32)
+    size = np.maximum(high - low, 1e-9)
+
+    files = []
+    index_levels = []
+    for level, indices in enumerate(build_levels(points, levels, base_resolution)):
+        depth = 0 if level == 0 else tile_depth
+        cell_ids, bounds = _octree_cells(points[indices], low, size, depth)
+        tiles = []
+        for cell_id in sorted(bounds):
+            tile = indices[cell_ids == cell_id]
+            name = f"L{level}_{cell_id or 'root'}.hmap"
+            heatmap_io.write_heatmap(os.path.join(directory, name), points[tile], deviations[tile], color_range,
+                                     precision, codec)
+            files.append(name)
+            cell_low, cell_high = bounds[cell_id]
+            tiles.append({
+                'id': cell_id,
+                'path': name,
+                'points': int(len(tile)),
+                'bytes': os.path.getsize(os.path.join(directory, name)),
+                'bbox': {'min': [float(v) for v in cell_low], 'max': [float(v) for v in cell_high]},
+            })
+        spacing = float(np.max(size)) / (base_resolution * 2 ** level) if level < levels - 1 else None
+        index_levels.append({'level': level, 'spacing': spacing, 'points': int(len(indices)), 'tiles': tiles})
+
+    index = {
+        'version': INDEX_VERSION,
+        'format': 'hmap',
+        'points': int(len(points)),
+        'bbox': {'min': [float(v) for v in low], 'max': [float(v) for v in high]},
+        'color_range': [float(v) for v in color_range],
+        'levels': index_levels,
+    }
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    files.append('index.json')
+    return files
@@ -1,21 +1,118 @@
+import numpy as np
 import open3d as o3d
+from . import voxels
 
-def segment_and_clean(pcd, plane_dist, outlier_neighbors, outlier_std):
+def segment_and_clean(pcd, plane_dist, outlier_neighbors, outlier_std, outlier_method="statistical",
+                      outlier_voxel_size=None, outlier_min_points=8):
     """
-    Removes the main plane using RANSAC and cleans the point cloud using statistical outlier removal.
+    Removes the main plane using RANSAC and cleans the point cloud with one of the outlier filters
+    (see remove_outliers).
     """
-    plane_model, inliers = pcd.segment_plane(
-        distance_threshold=plane_dist,
-        ransac_n=3,
-        num_iterations=1000
-    )
-    # Extract everything that is NOT the plane
-    pcd_segmented = pcd.select_by_index(inliers, invert=True)
+    pcd_segmented, _ = remove_planes(pcd, plane_dist)
+    return remove_outliers(pcd_segmented, outlier_method, outlier_neighbors, outlier_std, outlier_voxel_size,
+                           outlier_min_points)
 
+def remove_planes(pcd, plane_dist, max_planes=1, min_ratio=0.0, min_extent=None):
+    """
+    Removes up to max_planes planes found by RANSAC, largest first: the floor or the table, then walls.
+    The first plane is always removed; the next ones only if they hold at least min_ratio of the points
+    of the input and, with min_extent, if their largest connected patch spans more than min_extent (e.g. the
+    diagonal of the part, which none of its own faces can exceed). Only the patch counts: the slab of a face
+    of the part also cuts through the other objects and the outliers. The patches are connected at the scale of
+    plane_dist, which must exceed the scan spacing. Returns (cloud, number of planes removed).
+    """
+    total = len(pcd.points)
+    for removed in range(max_planes):
+        if len(pcd.points) < 3:
+            return pcd, removed
+        plane_model, inliers = pcd.segment_plane(
+            distance_threshold=plane_dist,
+            ransac_n=3,
+            num_iterations=1000
+        )
+        if removed > 0:
+            if len(inliers) < min_ratio * total:
+                return pcd, removed
+            if min_extent is not None:
+                if _largest_patch_extent(np.asarray(pcd.points)[inliers], plane_dist) <= min_extent:
+                    return pcd, removed
+        # Extract everything that is NOT the plane
+        pcd = pcd.select_by_index(inliers, invert=True)
+    return pcd, max_planes
+
+def _largest_patch_extent(points, voxel_size):
+    """Diagonal of the bounding box of the largest connected component of the points, on a voxel grid"""
+    keys, inverse, _ = voxels.voxelize(points, voxel_size)
+    labels = voxels.connected_components(keys)[inverse]
+    patch = points[labels == np.bincount(labels).argmax()]
+    return float(np.linalg.norm(patch.max(axis=0) - patch.min(axis=0)))
+
+def remove_outliers(pcd, method="statistical", nb_neighbors=20, std_ratio=2.0, voxel_size=None, min_points=8):
+    """
+    Cleans the point cloud with one of the outlier filters:
+      "statistical"        Open3D's statistical outlier removal on every point
+      "voxel_statistical"  the same statistics on the voxel centroids, points are kept with their voxel
+      "radius_voxel"       removes the points with fewer than min_points in the voxels around theirs
+    The voxel filters need voxel_size.
+    """
+    if method == "statistical":
+        pcd_cleaned, _ = pcd.remove_statistical_outlier(
+            nb_neighbors=nb_neighbors,
+            std_ratio=std_ratio
+        )
+        return pcd_cleaned
+    if method == "voxel_statistical":
+        kept = voxel_statistical_inliers(np.asarray(pcd.points), voxel_size, nb_neighbors, std_ratio)
+    elif method == "radius_voxel":
+        kept = radius_voxel_inliers(np.asarray(pcd.points), voxel_size, min_points)
+    else:
+        raise ValueError(f"Unknown outlier filter: {method}")
+    return pcd.select_by_index(np.flatnonzero(kept))
 
-    pcd_cleaned, _ = pcd_segmented.remove_statistical_outlier(
-        nb_neighbors=outlier_neighbors,
-        std_ratio=outlier_std
-    )
-    
-    return pcd_cleaned
\ No newline at end of file
+def largest_cluster(pcd, method="voxel", eps=0.02, min_points=10):
+    """
+    Keeps the largest cluster of the cloud, i.e. the object once the planes are removed:
+      "voxel"   connected components of the voxels of size eps holding, with their neighbours, at least
+                min_points points (points closer than about eps end up in the same cluster)
+      "dbscan"  Open3D's DBSCAN with the same eps and min_points, exact but much slower on dense clouds
+    Returns the cloud unchanged if no cluster is found.
+    """
+    points = np.asarray(pcd.points)
+    if len(points) == 0:
+        return pcd
+    if method == "voxel":
+        keys, inverse, counts = voxels.voxelize(points, eps)
+        labels = voxels.connected_components(keys, voxels.neighborhood_counts(keys, counts) >= min_points)[inverse]
+    elif method == "dbscan":
+        labels = np.asarray(pcd.cluster_dbscan(eps=eps, min_points=min_points, print_progress=False))
+    else:
+        raise ValueError(f"Unknown clustering method: {method}")
+
+    clustered = labels[labels >= 0]
+    if len(clustered) == 0:
+        return pcd
+    unique_labels, counts = np.unique(clustered, return_counts=True)
+    return pcd.select_by_index(np.flatnonzero(labels == unique_labels[counts.argmax()]))
+
+def voxel_statistical_inliers(points, voxel_size, nb_neighbors, std_ratio):
+    """
+    Statistical outlier removal on a downsampled proxy: the mean distance of every voxel centroid to its
+    nb_neighbors nearest centroids is compared to the mean + std_ratio * std over all the centroids, and the
+    points get the verdict of their voxel. Returns a boolean mask of the points to keep.
+    """
+    keys, inverse, _ = voxels.voxelize(points, voxel_size)
+    if len(keys) <= nb_neighbors:
+        return np.ones(len(points), dtype=bool)
+    proxy = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(voxels.centroids(points, inverse, len(keys))))
+    _, kept_voxels = proxy.remove_statistical_outlier(nb_neighbors=nb_neighbors, std_ratio=std_ratio)
+    kept = np.zeros(len(keys), dtype=bool)
+    kept[kept_voxels] = True
+    return kept[inverse]
+
+def radius_voxel_inliers(points, voxel_size, min_points):
+    """
+    Radius-count filter on a voxel hash: keeps the points with at least min_points points (themselves
+    included) in the 3 x 3 x 3 voxels around theirs, i.e. within about voxel_size. Returns a boolean mask.
+    """
+    keys, inverse, counts = voxels.voxelize(points, voxel_size)
+    return voxels.neighborhood_counts(keys, counts)[inverse] >= min_points
@@ -0,0 +1,154 @@
+import numpy as np
+import open3d as o3d
+from . import cad
+from . import cache
+from . import registration
+
+# Bump when the content of the cached references changes, to invalidate the old entries
+CACHE_VERSION = 4
+# Raycasting scenes kept by each process, for the CAD parts seen last
+SCENE_CACHE_SIZE = 4
+
+class CadReference:
+    """
+    Tessellated and preprocessed CAD part, shared by all the scans checked against the same STEP file.
+    """
+
+    def __init__(self, key, vertices, triangles, points, normals, feature_points, feature_normals, fpfh, mesh_key=None,
+                 face_ids=None, face_types=None):
+        self.key = key
+        # Key of the tessellation in the cache (see load_mesh)
+        self.mesh_key = mesh_key
+        self.vertices = vertices
+        self.triangles = triangles
+        # B-rep face of each triangle, and geometry type of each face (see cad.tessellate_step)
+        self.face_ids = face_ids
+        self.face_types = face_types
+        # Contiguous float64 (N, 3) array, ready to build a KD-tree on
+        self.points = np.ascontiguousarray(points, dtype=np.float64)
+        self.normals = normals
+        # Cloud the FPFH features were computed on (voxel-downsampled in multiscale mode)
+        self.feature_points = feature_points
+        self.feature_normals = feature_normals
+        self.fpfh = fpfh
+        # True when the tessellation and the features were loaded from the cache instead of being built
+        self.from_cache = False
+
+    def point_cloud(self):
+        """Returns the target point cloud, with normals"""
+        pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(self.points))
+        pcd.normals = o3d.utility.Vector3dVector(self.normals)
+        return pcd
+
+    def feature_point_cloud(self):
+        """Returns the target point cloud used for global registration, with normals"""
+        pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(self.feature_points))
+        pcd.normals = o3d.utility.Vector3dVector(self.feature_normals)
+        return pcd
+
+    def fpfh_feature(self):
+        """Returns the FPFH features of the feature point cloud"""
+        feature = o3d.pipelines.registration.Feature()
+        feature.data = self.fpfh
+        return feature
+
+    def triangle_mesh(self):
+        """Returns the tessellated CAD mesh"""
+        return cad.to_triangle_mesh(self.vertices, self.triangles)
+
+    def raycasting_scene(self):
+        """
+        Returns the raycasting scene (BVH) of the mesh. The scene is built once per process and part,
+        then reused by the next scans of the same part.
+        """
+        scene = _scenes.pop(self.mesh_key, None)
+        if scene is None:
+            scene = o3d.t.geometry.RaycastingScene()
+            scene.add_triangles(o3d.t.geometry.TriangleMesh.from_legacy(self.triangle_mesh()))
+        # Most recently used last
+        _scenes[self.mesh_key] = scene
+        while len(_scenes) > SCENE_CACHE_SIZE:
+            _scenes.pop(next(iter(_scenes)))
+        return scene
+
+# mesh_key -> RaycastingScene, in the order of use
+_scenes = {}
+
+def load_mesh(step_path, tolerance, cache_dir):
+    """
+    Returns (key, arrays, from_cache) of the tessellated STEP file, tessellating it only if it is not
+    in the cache. arrays has the vertices, the triangles, their face_ids and the face_types.
+    The mesh does not depend on the registration parameters, so it can be loaded first to derive
+    them from the size of the part (see autotune).
+    """
+    key = cache.make_key('cad-mesh', CACHE_VERSION, cache.file_hash(step_path), tolerance)
+    arrays = cache.load_arrays(cache_dir, 'meshes', key)
+    if arrays is not None:
+        return key, arrays, True
+
+    vertices, triangles, face_ids, face_types = cad.tessellate_step(step_path, tolerance, with_faces=True)
+    arrays = {'vertices': vertices, 'triangles': triangles, 'face_ids': face_ids, 'face_types': face_types}
+    cache.save_arrays(cache_dir, 'meshes', key, **arrays)
+    return key, arrays, False
+
+def sample_surface(vertices, triangles, spacing, max_points=2000000, seed=0):
+    """
+    Samples the surface of the mesh uniformly, about one point per spacing x spacing of area.
+    Unlike the tessellation vertices, which crowd on the fillets and leave the flat faces empty,
+    the samples cover every face with the same density as a scan.
+    """
+    mesh = cad.to_triangle_mesh(vertices, triangles)
+    count = int(min(max(mesh.get_surface_area() / spacing ** 2, 1), max_points))
+    o3d.utility.random.seed(seed)
+    return np.asarray(mesh.sample_points_uniformly(count).points)
+
+def load_reference(step_path, tolerance, voxel_size, cache_dir, downsample=True, mesh=None, sample_spacing=None):
+    """
+    Returns the CadReference of a STEP file, building it only if it is not in the cache.
+    The key is the STEP content hash plus the parameters, so the signed URL or step_id do not matter.
+    With downsample, the features are computed on the cloud voxel-downsampled at voxel_size.
+    With sample_spacing, the target cloud is sampled on the surface (see sample_surface), otherwise
+    it is made of the tessellation vertices.
+    A mesh already returned by load_mesh can be passed to avoid loading it again.
+    """
+    mesh_key, mesh_arrays, mesh_from_cache = mesh or load_mesh(step_path, tolerance, cache_dir)
+    vertices, triangles = mesh_arrays['vertices'], mesh_arrays['triangles']
+    faces = {'face_ids': mesh_arrays['face_ids'], 'face_types': mesh_arrays['face_types']}
+    key = cache.make_key('cad-features', CACHE_VERSION, mesh_key, voxel_size, downsample, sample_spacing)
+
+    arrays = cache.load_arrays(cache_dir, 'references', key)
+    if arrays is not None:
+        reference = CadReference(key, vertices, triangles, mesh_key=mesh_key, **faces, **arrays)
+        reference.from_cache = mesh_from_cache
+        return reference
+
+    pcd = cad.to_point_cloud(vertices if sample_spacing is None else sample_surface(vertices, triangles, sample_spacing))
+    if downsample:
+        pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30))
+        feature_pcd = pcd.voxel_down_sample(voxel_size)
+    else:
+        feature_pcd = pcd
+    fpfh = registration.compute_features(feature_pcd, voxel_size)
+
+    arrays = {
+        'points': np.asarray(pcd.points),
+        'normals': np.asarray(pcd.normals),
+        'feature_points': np.asarray(feature_pcd.points),
+        'feature_normals': np.asarray(feature_pcd.normals),
+        'fpfh': np.asarray(fpfh.data),
+    }
+    cache.save_arrays(cache_dir, 'references', key, **arrays)
+    return CadReference(key, vertices, triangles, mesh_key=mesh_key, **faces, **arrays)
+
+def load_cached_reference(cache_dir, mesh_key, key):
+    """
+    Returns the CadReference with the keys of a previous load_reference, without the STEP file, or None
+    if the mesh or the features are no longer in the cache.
+    """
+    mesh_arrays = cache.load_arrays(cache_dir, 'meshes', mesh_key)
+    arrays = cache.load_arrays(cache_dir, 'references', key)
+    if mesh_arrays is None or arrays is None:
+        return None
+    reference = CadReference(key, mesh_key=mesh_key, **mesh_arrays, **arrays)
+    reference.from_cache = True
+    return reference
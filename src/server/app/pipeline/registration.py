@@ -1,36 +1,214 @@
+import multiprocessing
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import open3d as o3d
 
-def run_global_registration(source, target, voxel_size):
+def compute_features(pcd, voxel_size):
     """
-    Executes global registration using RANSAC based on FPFH features.
+    Estimates the normals of the point cloud (in place) and returns its FPFH features.
     """
-    
-    source.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30))
-    target.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30))
+    pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30))
+    return o3d.pipelines.registration.compute_fpfh_feature(
+        pcd, o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 5, max_nn=100))
 
-    source_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
-        source, o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 5, max_nn=100))
-    target_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
-        target, o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 5, max_nn=100))
-    
+# Iteration budget of the RANSAC backend when it is not given
+RANSAC_MAX_ITERATION = 100000
+
+class RegistrationError(RuntimeError):
+    """A global registration backend found no usable alignment"""
+
+def _checked(result, backend):
+    """Returns the transformation of a backend result, raises RegistrationError if nothing was aligned"""
+    if result.fitness == 0 or not np.all(np.isfinite(result.transformation)):
+        raise RegistrationError(f"The {backend} global registration found no alignment")
+    return result.transformation
+
+def _ransac_backend(source, target, source_fpfh, target_fpfh, voxel_size, max_iteration=RANSAC_MAX_ITERATION,
+                    confidence=0.999):
+    """
+    RANSAC on the FPFH correspondences: robust, but the slowest backend.
+    """
     result = o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
         source, target, source_fpfh, target_fpfh, True,
         voxel_size * 1.5,
-        o3d.pipelines.registration.TransformationEstimationPointToPoint(False), 3, 
+        o3d.pipelines.registration.TransformationEstimationPointToPoint(False), 3,
         [
             o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
             o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(voxel_size * 1.5)
-        ], o3d.pipelines.registration.RANSACConvergenceCriteria(100000, 0.999))
-    
-    return result.transformation
+        ], o3d.pipelines.registration.RANSACConvergenceCriteria(max_iteration, confidence))
+    return _checked(result, "ransac")
+
+def _fgr_backend(source, target, source_fpfh, target_fpfh, voxel_size):
+    """
+    Fast Global Registration (Zhou et al. 2016): optimizes a robust objective on the
+    FPFH correspondences instead of sampling them, usually an order of magnitude faster than RANSAC.
+    """
+    result = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
+        source, target, source_fpfh, target_fpfh,
+        o3d.pipelines.registration.FastGlobalRegistrationOption(
+            maximum_correspondence_distance=voxel_size * 0.5))
+    return _checked(result, "fgr")
 
-def refine_with_icp(source, target, initial_transformation, threshold):
+# Available global registration backends, selected with config.GLOBAL_REGISTRATION_BACKEND
+GLOBAL_BACKENDS = {
+    "ransac": _ransac_backend,
+    "fgr": _fgr_backend,
+}
+# Backends whose runs are randomized: the only ones worth running several times for hypotheses
+RANDOMIZED_BACKENDS = {"ransac"}
+
+def run_global_registration(source, target, voxel_size, target_fpfh=None, backend="ransac", fallback=None,
+                            **backend_options):
+    """
+    Executes global registration based on FPFH features, with the selected backend.
+    If target_fpfh is given (e.g. from the CAD reference cache), the target must already have normals.
+    """
+    return generate_hypotheses(source, target, voxel_size, target_fpfh, backend, 1, fallback, **backend_options)[0]
+
+def generate_hypotheses(source, target, voxel_size, target_fpfh=None, backend="ransac", count=1, fallback=None,
+                        **backend_options):
+    """
+    Runs the global registration up to `count` times on the same features and returns the distinct
+    transformations found. RANSAC is randomized, so every run can land on a different pose; its iteration
+    budget is split across the runs, so the hypotheses cost about as much as a single registration.
+    A deterministic backend (FGR) would find the same pose every time, it runs once.
+    If the backend fails (raises, e.g. RegistrationError), the fallback backend, with its default options,
+    is used instead for all the runs; without a fallback the error is raised.
+    """
+    for name in (backend, fallback):
+        if name is not None and name not in GLOBAL_BACKENDS:
+            raise ValueError(f"Unknown global registration backend '{name}', expected one of {list(GLOBAL_BACKENDS)}")
+
+    source_fpfh = compute_features(source, voxel_size)
+    if target_fpfh is None:
+        target_fpfh = compute_features(target, voxel_size)
+
+    try:
+        return _run_backend(source, target, source_fpfh, target_fpfh, voxel_size, backend, count, backend_options)
+    except Exception as e:
+        if fallback is None or fallback == backend:
+            raise
+        warnings.warn(f"Global registration with {backend} failed ({e}), falling back to {fallback}", RuntimeWarning)
+        return _run_backend(source, target, source_fpfh, target_fpfh, voxel_size, fallback, count, {})
+
+def _run_backend(source, target, source_fpfh, target_fpfh, voxel_size, backend, count, backend_options):
+    runs = max(count, 1) if backend in RANDOMIZED_BACKENDS else 1
+    if backend == "ransac":
+        budget = backend_options.get('max_iteration', RANSAC_MAX_ITERATION)
+        backend_options = {**backend_options, 'max_iteration': max(budget // runs, 1)}
+
+    hypotheses = []
+    for _ in range(runs):
+        transformation = GLOBAL_BACKENDS[backend](source, target, source_fpfh, target_fpfh, voxel_size, **backend_options)
+        if not any(_same_pose(transformation, other, voxel_size) for other in hypotheses):
+            hypotheses.append(transformation)
+    return hypotheses
+
+def _same_pose(a, b, tolerance):
+    """True if two transformations differ by less than ~1 degree and `tolerance` in translation"""
+    delta = a @ np.linalg.inv(b)
+    cos_angle = (np.trace(delta[:3, :3]) - 1) / 2
+    return cos_angle > 0.9998 and np.linalg.norm(delta[:3, 3]) < tolerance
+
+def _icp_estimation(method):
+    if method == "point_to_plane":
+        # Requires normals on the target
+        return o3d.pipelines.registration.TransformationEstimationPointToPlane()
+    if method == "point_to_point":
+        return o3d.pipelines.registration.TransformationEstimationPointToPoint()
+    raise ValueError(f"Unknown ICP method '{method}', expected 'point_to_point' or 'point_to_plane'")
+
+def refine_with_icp(source, target, initial_transformation, threshold, max_iteration=2000, method="point_to_point"):
     """
     Refines the alignment using ICP (Iterative Closest Point)
     """
     result = o3d.pipelines.registration.registration_icp(
         source, target, threshold, initial_transformation,
-        o3d.pipelines.registration.TransformationEstimationPointToPoint(),
-        o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=2000))
-        
-    return result.transformation
\ No newline at end of file
+        _icp_estimation(method),
+        o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=max_iteration))
+
+    return result.transformation
+
+# Clouds of the hypothesis ICP workers, set once per process by the pool initializer, or in this process
+# for the duration of select_best_hypothesis when it runs without a pool
+_hypothesis_clouds = None
+
+def _init_hypothesis_worker(source_points, target_points, target_normals):
+    global _hypothesis_clouds
+    source = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(source_points))
+    target = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(target_points))
+    if target_normals is not None:
+        target.normals = o3d.utility.Vector3dVector(target_normals)
+    _hypothesis_clouds = (source, target)
+
+def _refine_hypothesis(transformation, threshold, iterations, method):
+    """Runs a few ICP iterations from one hypothesis, returns (transformation, fitness, inlier_rmse)"""
+    source, target = _hypothesis_clouds
+    result = o3d.pipelines.registration.registration_icp(
+        source, target, threshold, transformation,
+        _icp_estimation(method),
+        o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=iterations))
+    return result.transformation, result.fitness, result.inlier_rmse
+
+def select_best_hypothesis(source, target, hypotheses, threshold, iterations=10, method="point_to_point", workers=1):
+    """
+    Refines all the hypotheses with a small ICP budget, keeps the best half by fitness (then RMSE)
+    and repeats until a single one is left (successive halving). Bad hypotheses are dropped
+    after the first round, so only the winner is later refined to convergence.
+    The hypotheses are refined concurrently in a process pool when workers > 1.
+    Returns the refined transformation of the winner.
+    """
+    global _hypothesis_clouds
+    target_normals = np.asarray(target.normals) if target.has_normals() else None
+    initargs = (np.asarray(source.points), np.asarray(target.points), target_normals)
+
+    executor = None
+    if workers > 1 and len(hypotheses) > 1:
+        # Forked workers inherit the clouds, nothing is pickled but the transformations
+        executor = ProcessPoolExecutor(
+            max_workers=min(workers, len(hypotheses)),
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_hypothesis_worker,
+            initargs=initargs
+        )
+    else:
+        _init_hypothesis_worker(*initargs)
+
+    try:
+        candidates = list(hypotheses)
+        while True:
+            args = [(candidate, threshold, iterations, method) for candidate in candidates]
+            if executor:
+                results = list(executor.map(_refine_hypothesis, *zip(*args)))
+            else:
+                results = [_refine_hypothesis(*arg) for arg in args]
+
+            results.sort(key=lambda result: (-result[1], result[2]))
+            if len(results) == 1:
+                return results[0][0]
+            candidates = [result[0] for result in results[:(len(results) + 1) // 2]]
+    finally:
+        if executor:
+            executor.shutdown()
+        # The process is a worker of the pipeline pool: it must not keep the clouds (the whole scan in the
+        # "full" mode) until its next scan
+        _hypothesis_clouds = None
+
+def refine_multiscale_icp(source, target, initial_transformation, voxel_sizes, iterations, threshold, max_iteration=2000,
+                          method="point_to_point"):
+    """
+    Refines the alignment with ICP on a voxel pyramid, from the coarsest to the finest level,
+    then at full resolution. Each level starts from the previous one, so the expensive
+    full resolution ICP only needs a few iterations to converge.
+    """
+    transformation = initial_transformation
+    for voxel_size, level_iterations in zip(voxel_sizes, iterations):
+        source_down = source.voxel_down_sample(voxel_size)
+        target_down = target.voxel_down_sample(voxel_size)
+        # The correspondence distance can't be smaller than the voxel size at the coarse levels
+        transformation = refine_with_icp(
+            source_down, target_down, transformation,
+            max(threshold, voxel_size * 1.5), level_iterations, method)
+
+    return refine_with_icp(source, target, transformation, threshold, max_iteration, method)
@@ -0,0 +1,93 @@
+"""
+Voxel hashing of point clouds with numpy: every point gets the integer key of its voxel, and the occupied
+voxels are the sorted unique keys. Neighbouring voxels are found by adding offsets to the keys and
+looking them up with a binary search, without building a KD-tree.
+"""
+import itertools
+import numpy as np
+
+# Bits per axis in a key: up to 2^21 voxels along each axis
+AXIS_BITS = 21
+
+def voxelize(points, voxel_size):
+    """
+    Returns (keys, inverse, counts): the sorted keys of the occupied voxels, the index of the voxel of
+    each point in keys, and the number of points in each voxel.
+    """
+    points = np.asarray(points)
+    if len(points) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    # One empty voxel of margin on each side, so the neighbours of any voxel have valid keys
+    coords = np.floor((points - points.min(axis=0)) / voxel_size).astype(np.int64) + 1
+    if coords.max() >= 2 ** AXIS_BITS - 1:
+        raise ValueError(f"Voxel size {voxel_size} too small for the extent of the points")
+    keys = (coords[:, 0] << (2 * AXIS_BITS)) | (coords[:, 1] << AXIS_BITS) | coords[:, 2]
+    keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    return keys, inverse.reshape(-1), counts
+
+def neighbor_offsets(radius=1):
+    """Key offsets of the (2 radius + 1)^3 voxels around a voxel, itself included"""
+    steps = range(-radius, radius + 1)
+    return np.array([(dx << (2 * AXIS_BITS)) + (dy << AXIS_BITS) + dz for dx, dy, dz in itertools.product(steps, steps, steps)],
+                    dtype=np.int64)
+
+def lookup(keys, query):
+    """Returns the index of each query key in the sorted keys, -1 where it is not occupied"""
+    index = np.clip(np.searchsorted(keys, query), 0, max(len(keys) - 1, 0))
+    found = keys[index] == query if len(keys) else np.zeros(len(query), dtype=bool)
+    return np.where(found, index, -1)
+
+def neighborhood_counts(keys, counts, radius=1):
+    """Returns, for each occupied voxel, the number of points in the voxels around it (itself included)"""
+    total = np.zeros(len(keys), dtype=np.int64)
+    for offset in neighbor_offsets(radius):
+        index = lookup(keys, keys + offset)
+        found = index >= 0
+        total[found] += counts[index[found]]
+    return total
+
+def centroids(points, inverse, count):
+    """Returns the centroid of the points of each voxel"""
+    points = np.asarray(points, dtype=np.float64)
+    sums = np.zeros((count, 3))
+    np.add.at(sums, inverse, points)
+    return sums / np.bincount(inverse, minlength=count)[:, None]
+
+def connected_components(keys, active=None):
+    """
+    Labels the occupied voxels by connected component, two voxels being connected when they touch
+    (26-neighbourhood). Inactive voxels get -1. The components are found with a vectorized union-find:
+    every root is hooked to the smallest root among its neighbours, then the labels are compressed by
+    pointer jumping, until the labels of all the neighbour pairs agree. The label of a component is the
+    index of its first voxel.
+    """
+    count = len(keys)
+    active = np.ones(count, dtype=bool) if active is None else np.asarray(active, dtype=bool)
+
+    # Each pair of neighbours once: the offsets with a positive key
+    sources, targets = [], []
+    for offset in neighbor_offsets()[neighbor_offsets() > 0]:
+        index = lookup(keys, keys + offset)
+        linked = (index >= 0) & active
+        linked[linked] &= active[index[linked]]
+        sources.append(np.flatnonzero(linked))
+        targets.append(index[linked])
+    sources = np.concatenate(sources) if sources else np.zeros(0, dtype=np.int64)
+    targets = np.concatenate(targets) if targets else np.zeros(0, dtype=np.int64)
+
+    parent = np.arange(count)
+    while True:
+        source_roots, target_roots = parent[sources], parent[targets]
+        if np.array_equal(source_roots, target_roots):
+            break
+        lowest = np.minimum(source_roots, target_roots)
+        np.minimum.at(parent, source_roots, lowest)
+        np.minimum.at(parent, target_roots, lowest)
+        # Pointer jumping, until every voxel points to its root
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+    return np.where(active, parent, -1)
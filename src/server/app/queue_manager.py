@@ -1,67 +1,577 @@
+import os
 import threading
+import multiprocessing
+import time
+import uuid
 from queue import Queue
-from app.worker import pipeline_worker
-from firebase_admin import firestore
-from flask import current_app as app
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from app import app
+from app import worker
+from app import downloads
+from app.pipeline import config as pipeline_config
+from app.scheduler import FairScheduler, estimate_cost
+from app.journal import ScanJournal, FINISHED
+from app.instrumentation import ScanProfile, StageMetrics
+from app.status_writer import flush_status
+
+# Re-analyzed scans whose stats are written together (two documents each, within a Firestore batch)
+REANALYSIS_WRITE_BATCH = 200
+# Finished re-analysis jobs kept for the status route
+REANALYSIS_JOBS_KEPT = 100
+
+# Outcomes of add_scan
+ADDED = 'added'
+# Already queued or in flight: the submission was merged into it
+ALREADY_QUEUED = 'already_queued'
+ALREADY_PROCESSED = 'already_processed'
+# Submitted while shutting down: journaled, processed after the restart
+DEFERRED = 'deferred'
 
 class ScanQueueManager:
-    def __init__(self):
-        self.scan_queue = Queue()
-        self.processing = False
+    """
+    Runs the queued scans through a staged pipeline, so that consecutive scans overlap:
+    while scan N is registering, scan N+1 is downloaded and its STEP file converted,
+    and the heatmap of scan N-1 is uploaded.
+
+      fetch threads    download the inputs (I/O), then convert the STEP file and tune the parameters
+                       in the prepare pool
+      process lanes    one per worker of the process pool, run the registration and the analysis
+      publish threads  upload the heatmap and write the stats (I/O)
+
+    The stages are connected by bounded queues. When a stage falls behind, the previous one
+    blocks on the full queue (back-pressure), so only a few scans are downloaded ahead
+    of the process pool and their temporary files don't pile up on disk.
+    The backlog itself is not FIFO: the scheduler (see scheduler.FairScheduler) orders it by priority,
+    per-user fair share and scan size, the size being probed from the scan URL when the scan is added.
+    On shutdown the stages exit in order, each one after the scans in its input queue (see shutdown).
+    """
+
+    def __init__(self, max_workers=None, journal=None, stage_metrics=None, fetch_workers=None, publish_workers=None,
+                 prefetch=None):
+        self.journal = journal
+        self.stage_metrics = stage_metrics or StageMetrics()
+        self.max_workers = max_workers or app.config.get('PIPELINE_WORKERS') or 1
+        self.fetch_workers = fetch_workers or app.config.get('PIPELINE_FETCH_WORKERS') or 1
+        self.publish_workers = publish_workers or app.config.get('PIPELINE_PUBLISH_WORKERS') or 1
+        prefetch = prefetch or app.config.get('PIPELINE_PREFETCH') or 1
+        # Open3D threads of each pool worker, the cores are shared between the process lanes
+        # (see PIPELINE_WORKER_THREADS)
+        self.worker_threads = app.config.get('PIPELINE_WORKER_THREADS') or (
+            max((os.cpu_count() or 1) // self.max_workers, 1) if self.max_workers > 1 else 0)
+
+        # Scans waiting to be fetched (unbounded, the backlog)
+        self.scan_queue = FairScheduler(app.config.get('SCHEDULER_AGING_SECONDS') or 300.0)
+        # Reads the size of the added scans, for the scheduler
+        self.probe_executor = ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix="pipeline-probe")
+        # Fetched scans waiting for a process lane
+        self.ready_queue = Queue(maxsize=prefetch)
+        # Processed scans waiting to be published
+        self.publish_queue = Queue(maxsize=self.publish_workers)
+
         self.lock = threading.Lock()
-        self.current_scan = None
-        
-    def add_scan(self, scan_data):
-        """Add a scan to the queue"""
-        self.scan_queue.put(scan_data)
-        app.logger.info(f"Added scan {scan_data.get('scan_id')} to queue. Queue size: {self.scan_queue.qsize()}")
-        self._process_next()
-    
-    def _process_next(self):
-        """Process the next scan in the queue if not already processing"""
+        # Makes the check for duplicates and the enqueueing of a submitted scan atomic
+        self.submit_lock = threading.Lock()
+        self.executor = None
+        self.prepare_executor = None
+        self.threads = []
+        # Stage -> threads of the stage still running, see _on_stage_exit
+        self.stage_threads = {}
+        # Set by shutdown: no scan is taken from the queue anymore
+        self.stopping = False
+        # scan_id -> scan_data of the scans currently in one of the stages
+        self.active_scans = {}
+        self.completed_count = 0
+        self.failed_count = 0
+        # scan_id -> broken process pools the scan was in, see _on_pool_broken
+        self.pool_crashes = {}
+        # job_id -> state of the re-analysis jobs, in the order of creation
+        self.jobs = {}
+        # time.monotonic() of the last eviction of the pipeline cache
+        self.last_eviction = None
+
+    def add_scan(self, scan_data, reprocess=False):
+        """
+        Add a scan to the queue and return the outcome (ADDED, ALREADY_QUEUED, ALREADY_PROCESSED or DEFERRED).
+        Submitting a scan again is idempotent: a processed scan is skipped unless reprocess is set, and a scan
+        already queued or in flight is not enqueued twice, it only takes the duplicate's signed URLs if they
+        expire later and its priority if it is higher.
+        """
+        scan_id = scan_data.get('scan_id')
+        with self.submit_lock:
+            if not reprocess and self.journal and self.journal.get_state(scan_id) == FINISHED:
+                app.logger.info(f"Scan {scan_id} was already processed, skipping it")
+                return ALREADY_PROCESSED
+
+            queued = self.scan_queue.find(scan_id)
+            if queued is not None:
+                self.scan_queue.raise_priority(scan_id, scan_data.get('priority', 0))
+                if _take_newer_urls(queued, scan_data) and self.journal:
+                    self.journal.update_scan_data(scan_id, queued)
+                app.logger.info(f"Scan {scan_id} is already in the queue, merged the duplicate submission")
+                return ALREADY_QUEUED
+
+            if self.journal:
+                self.journal.record_enqueued(scan_data)
+            if self.stopping:
+                app.logger.info(f"Shutting down, scan {scan_id} is left in the journal for the next start")
+                return DEFERRED
+            self._enqueue(scan_data)
+        app.logger.info(f"Added scan {scan_id} to queue. Queue size: {self.scan_queue.qsize()}")
+        self._start()
+        return ADDED
+
+    def _enqueue(self, scan_data):
+        """Puts the scan in the scheduler, then probes its size in the background"""
+        scan_id = scan_data['scan_id']
+        self.scan_queue.put(scan_id, scan_data, scan_data.get('user') or 'anonymous', scan_data.get('priority', 0))
+        self.probe_executor.submit(self._probe_scan, scan_id, scan_data['scan_url'])
+
+    def _probe_scan(self, scan_id, scan_url):
+        try:
+            size, points = downloads.probe_scan(scan_url)
+        except Exception as e:
+            # The scan keeps the default cost
+            app.logger.warning(f"Failed to read the size of scan {scan_id}: {e}")
+            return
+        self.scan_queue.update_cost(scan_id, estimate_cost(size, points))
+
+    def resume_from_journal(self):
+        """
+        Re-enqueue the scans that were queued or in-flight when the server stopped.
+        Returns the ids of the resumed scans.
+        """
+        if not self.journal:
+            return set()
+
+        # Scans that were started too many times, e.g. because they crash the server: not resumed again
+        max_attempts = app.config.get('SCAN_MAX_ATTEMPTS') or 3
+        for scan_id in self.journal.fail_exhausted(max_attempts):
+            worker.mark_failed(scan_id, f"Gave up after {max_attempts} attempts")
+
+        pending_scans = self.journal.pending_scans(max_attempts)
+        for scan_data in pending_scans:
+            self._enqueue(scan_data)
+        app.logger.info(f"Resumed {len(pending_scans)} scans from the journal")
+
+        if pending_scans:
+            self._start()
+        return {scan_data['scan_id'] for scan_data in pending_scans}
+
+    def _start(self):
+        """Starts the stage threads on first use, so that importing the app does not start anything"""
+        with self.lock:
+            if self.threads or self.stopping:
+                return
+            self.stage_threads = {'fetch': self.fetch_workers, 'process': self.max_workers}
+            stages = (
+                [self._fetch_loop] * self.fetch_workers
+                + [self._process_loop] * self.max_workers
+                + [self._publish_loop] * self.publish_workers
+            )
+            for target in stages:
+                thread = threading.Thread(target=target, daemon=True, name=f"pipeline-{target.__name__.strip('_')}")
+                thread.start()
+                self.threads.append(thread)
+
+    def _get_executor(self):
+        """Returns the process pool, creating it on first use"""
+        # 'fork' is used because the workers need the already initialized app and Firebase SDK.
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=worker.init_pool_worker,
+                    initargs=(self.worker_threads,)
+                )
+            return self.executor
+
+    def _get_prepare_executor(self):
+        """Returns the process pool of the STEP conversions, separate so they don't wait for a registration"""
+        with self.lock:
+            if self.prepare_executor is None:
+                self.prepare_executor = ProcessPoolExecutor(
+                    max_workers=self.fetch_workers,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=worker.init_pool_worker,
+                    initargs=(self.worker_threads,)
+                )
+            return self.prepare_executor
+
+    def _run_in_pool(self, get_executor, function, *args):
+        """Runs a function in a process pool and waits for its result"""
+        executor = get_executor()
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            self._discard_executor(executor)
+            raise
+
+    def _discard_executor(self, executor):
+        """A worker died (e.g. killed by the OOM killer): replaces the whole pool, its scans are re-queued"""
+        with self.lock:
+            if executor is self.executor:
+                app.logger.error("Process pool is broken, creating a new one")
+                self.executor = None
+            elif executor is self.prepare_executor:
+                app.logger.error("Prepare process pool is broken, creating a new one")
+                self.prepare_executor = None
+
+    def _fetch_loop(self):
+        """Stage 1: downloads the inputs and converts the STEP file, then waits for a free process lane"""
+        while True:
+            scan_data = self.scan_queue.get()
+            if scan_data is None:
+                self._on_stage_exit('fetch', self.ready_queue, self.max_workers)
+                return
+            scan_id = scan_data['scan_id']
+            with self.lock:
+                self.active_scans[scan_id] = scan_data
+            if self.journal:
+                self.journal.record_started(scan_id)
+            app.logger.info(f"Starting processing of scan {scan_id}")
+
+            # The signed URLs may have expired while the scan was waiting
+            self._refresh_urls(scan_data)
+            profile = ScanProfile(scan_id)
+            temp_dir = None
+            try:
+                temp_dir, scan_filename, step_filename = worker.fetch_inputs(
+                    scan_id, scan_data['scan_url'], scan_data['step_url'], profile)
+                parameters, stages = self._run_in_pool(
+                    self._get_prepare_executor, worker.prepare_reference, scan_id, scan_filename, step_filename)
+                profile.stages.extend(stages)
+            except BrokenProcessPool as e:
+                self._on_pool_broken(scan_data, profile, temp_dir, e)
+                continue
+            except Exception as e:
+                self._on_scan_failed(scan_data, profile, temp_dir, e)
+                continue
+
+            # Blocks while the process lanes are all busy and enough scans are already waiting
+            self.ready_queue.put((scan_data, profile, temp_dir, scan_filename, step_filename, parameters))
+
+    def _refresh_urls(self, scan_data):
+        """Re-signs the URLs of the scan that are expired or expire within the refresh margin"""
+        scan_id = scan_data['scan_id']
+        try:
+            urls = worker.refresh_signed_urls(scan_data, app.config.get('SIGNED_URL_REFRESH_MARGIN', 120))
+        except Exception as e:
+            # The download is tried with the old URLs
+            app.logger.error(f"Failed to refresh the signed URLs of scan {scan_id}: {e}")
+            return
+        if urls:
+            with self.submit_lock:
+                scan_data.update(urls)
+                if self.journal:
+                    self.journal.update_scan_data(scan_id, scan_data)
+            app.logger.info(f"Refreshed the expired signed URLs of scan {scan_id}: {', '.join(urls)}")
+
+    def _process_loop(self):
+        """Stage 2: runs the registration and the analysis of one scan at a time in the process pool"""
+        while True:
+            item = self.ready_queue.get()
+            if item is None:
+                self._on_stage_exit('process', self.publish_queue, self.publish_workers)
+                return
+            scan_data, profile, temp_dir, scan_filename, step_filename, parameters = item
+            start = time.perf_counter()
+            try:
+                outputs, metrics, stages = self._run_in_pool(
+                    self._get_executor, worker.process_scan, scan_data['scan_id'], scan_filename, step_filename,
+                    temp_dir, parameters)
+                profile.stages.extend(stages)
+                # The process lanes are the bottleneck, their time per point gives the waiting times
+                self.scan_queue.observe(scan_data['scan_id'], time.perf_counter() - start)
+            except BrokenProcessPool as e:
+                self._on_pool_broken(scan_data, profile, temp_dir, e)
+                continue
+            except Exception as e:
+                self._on_scan_failed(scan_data, profile, temp_dir, e)
+                continue
+
+            # Blocks while the uploads are behind, which keeps this lane from taking a new scan
+            self.publish_queue.put((scan_data, profile, temp_dir, outputs, metrics))
+
+    def _publish_loop(self):
+        """Stage 3: uploads the results"""
+        while True:
+            item = self.publish_queue.get()
+            if item is None:
+                return
+            scan_data, profile, temp_dir, outputs, metrics = item
+            try:
+                worker.publish_results(scan_data['scan_id'], outputs, metrics, profile)
+            except Exception as e:
+                self._on_scan_failed(scan_data, profile, temp_dir, e)
+                continue
+
+            worker.cleanup(scan_data['scan_id'], temp_dir)
+            self._on_scan_complete(scan_data, profile)
+
+    def _on_stage_exit(self, stage, next_queue, next_workers):
+        """
+        Called when a stage thread exits on shutdown. The last one of the stage puts an end marker per thread
+        of the next stage in its queue, after the scans already there, which the next stage still processes.
+        """
+        with self.lock:
+            self.stage_threads[stage] -= 1
+            last = self.stage_threads[stage] == 0
+        if last:
+            for _ in range(next_workers):
+                next_queue.put(None)
+
+    def shutdown(self, wait=True):
+        """
+        Stops taking scans from the queue. The scans in flight go through the remaining stages, the queued ones
+        stay in the journal and are resumed at the next start. With wait, returns once the scans in flight are
+        published or failed, after stopping the process pools. Called by the worker_exit hook of gunicorn.conf.py.
+        """
+        with self.submit_lock:
+            self.stopping = True
+        self.scan_queue.close()
+        self.probe_executor.shutdown(wait=False, cancel_futures=True)
+        if not wait:
+            return
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
+        with self.lock:
+            executors = (self.executor, self.prepare_executor)
+            self.executor = self.prepare_executor = None
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown()
+        # The statuses written by the publish threads, the pool workers flush theirs when they exit
+        flush_status()
+        app.logger.info("Pipeline stopped")
+
+    def _on_pool_broken(self, scan_data, profile, temp_dir, error):
+        """
+        Called when a worker of a process pool died while the scan was in the pool. Every scan in flight
+        in the pool gets the error, not only the one that killed the worker: the scan is queued again,
+        unless it was already in PIPELINE_MAX_POOL_CRASHES broken pools, then it is failed as the likely
+        cause (a poison scan, e.g. one that exhausts the memory) instead of crashing the pool forever.
+        """
+        scan_id = scan_data['scan_id']
+        with self.lock:
+            crashes = self.pool_crashes[scan_id] = self.pool_crashes.get(scan_id, 0) + 1
+        max_crashes = app.config.get('PIPELINE_MAX_POOL_CRASHES') or 2
+        if crashes >= max_crashes:
+            self._on_scan_failed(scan_data, profile, temp_dir,
+                                 RuntimeError(f"Scan was in {crashes} crashed process pools: {error!r}"))
+            return
+
+        app.logger.warning(f"Process pool broke during scan {scan_id} (crash {crashes}/{max_crashes}), re-queueing it")
+        try:
+            worker.cleanup(scan_id, temp_dir)
+        except OSError as cleanup_error:
+            app.logger.error(f"Failed to clean up scan {scan_id}: {cleanup_error}")
+        with self.submit_lock:
+            self.scan_queue.done(scan_id)
+            with self.lock:
+                self.active_scans.pop(scan_id, None)
+            if self.journal:
+                self.journal.record_enqueued(scan_data)
+            # When shutting down, the scan is resumed from the journal at the next start
+            if not self.stopping:
+                self._enqueue(scan_data)
+
+    def _on_scan_complete(self, scan_data, profile):
+        """Called when a scan has been published"""
+        scan_id = scan_data['scan_id']
+        # The journal is terminal before the scan leaves the scheduler, so add_scan skips a duplicate in between
+        with self.submit_lock:
+            if self.journal:
+                self.journal.record_finished(scan_id)
+            self.scan_queue.done(scan_id)
+            with self.lock:
+                self.active_scans.pop(scan_id, None)
+                self.pool_crashes.pop(scan_id, None)
+                self.completed_count += 1
+
+        app.logger.info(f"Successfully completed scan {scan_id}")
+        self.stage_metrics.add(profile.to_dict())
+        self._evict_cache()
+
+    def _evict_cache(self):
+        """Evicts the old entries of the pipeline cache, at most every CACHE_EVICTION_INTERVAL seconds"""
+        now = time.monotonic()
         with self.lock:
-            if self.processing or self.scan_queue.empty():
+            if self.last_eviction is not None and now - self.last_eviction < pipeline_config.CACHE_EVICTION_INTERVAL:
                 return
-            
-            self.processing = True
-            self.current_scan = self.scan_queue.get()
-
-        app.logger.info(f"Starting processing of scan {self.current_scan.get('scan_id')}")
-
-        # Start worker in a new thread
-        worker_thread = threading.Thread(
-            target=self._worker_wrapper,
-            args=(self.current_scan['scan_id'], self.current_scan['scan_url'], self.current_scan['step_url'])
-        )
-        worker_thread.start()
-    
-    def _worker_wrapper(self, scan_id, scan_url, step_url):
-        """Wrapper around pipeline_worker to handle completion and failures"""
+            self.last_eviction = now
+        try:
+            removed, removed_bytes = worker.evict_cache()
+        except OSError as e:
+            app.logger.error(f"Failed to evict the pipeline cache: {e}")
+            return
+        if removed:
+            app.logger.info(f"Evicted {removed} entries ({removed_bytes / 1024 ** 2:.1f} MB) from the pipeline cache")
+
+    def _on_scan_failed(self, scan_data, profile, temp_dir, error):
+        """Called when any stage of a scan fails, the scan is marked as failed and not re-queued"""
+        scan_id = scan_data['scan_id']
+        app.logger.error(f"Failed to process scan {scan_id}: {error}")
+        app.logger.info(f"Profile of the failed scan: {profile.to_dict(failed=True)}")
+        worker.mark_failed(scan_id, error)
+        try:
+            worker.cleanup(scan_id, temp_dir)
+        except OSError as cleanup_error:
+            app.logger.error(f"Failed to clean up scan {scan_id}: {cleanup_error}")
+
+        # As in _on_scan_complete, the failure is journaled before the scan leaves the scheduler
+        with self.submit_lock:
+            if self.journal:
+                self.journal.record_failed(scan_id, error)
+            self.scan_queue.done(scan_id)
+            with self.lock:
+                self.active_scans.pop(scan_id, None)
+                self.pool_crashes.pop(scan_id, None)
+                self.failed_count += 1
+        self.stage_metrics.add(profile.to_dict(failed=True))
+
+    def reanalyze(self, tolerance, scan_ids=None, step_id=None):
+        """
+        Starts a job computing the metrics of already processed scans again with the tolerance (see
+        worker.reanalyze_scan): the given scans, or all the completed scans of the STEP file.
+        Returns the job_id, see get_job.
+        """
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'status': 'queued',
+            'step_id': step_id,
+            'tolerance': tolerance,
+            'total': len(scan_ids) if scan_ids is not None else None,
+            'completed': 0,
+            # scan_id -> error
+            'failed': {},
+            'created_at': time.time(),
+            'finished_at': None,
+        }
+        with self.lock:
+            self.jobs[job['job_id']] = job
+            finished = [job_id for job_id, other in self.jobs.items() if other['finished_at']]
+            for job_id in finished[:max(len(finished) - REANALYSIS_JOBS_KEPT, 0)]:
+                del self.jobs[job_id]
+
+        thread = threading.Thread(target=self._run_reanalysis, args=(job, scan_ids), daemon=True,
+                                  name=f"reanalysis-{job['job_id'][:8]}")
+        thread.start()
+        return job['job_id']
+
+    def get_job(self, job_id):
+        """Returns a copy of the state of the re-analysis job, or None"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return {**job, 'failed': dict(job['failed'])} if job else None
+
+    def _run_reanalysis(self, job, scan_ids):
+        """
+        Runs the scans of a re-analysis job in the process pool, no more at once than there are process lanes,
+        so the new scans get their share of the workers. The stats are written in batches as the scans finish.
+        """
+        job_id = job['job_id']
+        try:
+            if scan_ids is None:
+                scan_ids = worker.scans_of_step(job['step_id'])
+        except Exception as e:
+            app.logger.error(f"Re-analysis {job_id}: failed to list the scans of step {job['step_id']}: {e}")
+            self._update_job(job, status='failed', error=str(e), finished_at=time.time())
+            return
+        self._update_job(job, status='running', total=len(scan_ids))
+        app.logger.info(f"Re-analysis {job_id}: {len(scan_ids)} scans with tolerance {job['tolerance']}")
+
+        remaining = iter(scan_ids)
+        running = {}
+        results = []
+        while True:
+            for scan_id in remaining:
+                executor = self._get_executor()
+                try:
+                    running[executor.submit(worker.reanalyze_scan, scan_id, job['tolerance'])] = (scan_id, executor)
+                except (BrokenProcessPool, RuntimeError) as e:
+                    self._discard_executor(executor)
+                    self._fail_job_scans(job, [scan_id], e)
+                if len(running) >= self.max_workers:
+                    break
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                scan_id, executor = running.pop(future)
+                try:
+                    metrics, _ = future.result()
+                    results.append((scan_id, metrics))
+                except BrokenProcessPool as e:
+                    self._discard_executor(executor)
+                    self._fail_job_scans(job, [scan_id], e)
+                except Exception as e:
+                    self._fail_job_scans(job, [scan_id], e)
+            if len(results) >= REANALYSIS_WRITE_BATCH:
+                self._write_reanalysis(job, results)
+                results = []
+
+        self._write_reanalysis(job, results)
+        self._update_job(job, status='completed', finished_at=time.time())
+        app.logger.info(f"Re-analysis {job_id} completed: {job['completed']} scans updated, "
+                        f"{len(job['failed'])} failed")
+
+    def _write_reanalysis(self, job, results):
+        if not results:
+            return
         try:
-            pipeline_worker(scan_url, step_url, scan_id)
-            app.logger.info(f"Successfully completed scan {scan_id}")
-            self._on_scan_complete(success=True)
+            worker.write_stats(results)
         except Exception as e:
-            app.logger.error(f"Failed to process scan {scan_id}: {e}")
-            self._on_scan_complete(success=False)
-    
-    def _on_scan_complete(self, success):
-        """Called when a scan finishes processing"""
-        #with self.lock:
-            #if not success and self.current_scan:
-                # Re-add failed scan to the end of the queue
-                #print(f"Re-queueing failed scan {self.current_scan.get('scan_id')}")
-                #self.scan_queue.put(self.current_scan)
-            
-            #self.current_scan = None
-            #self.processing = False
-        
-        # Process next scan
-        self._process_next()
-    
+            self._fail_job_scans(job, [scan_id for scan_id, _ in results], e)
+            return
+        with self.lock:
+            job['completed'] += len(results)
+
+    def _update_job(self, job, **fields):
+        with self.lock:
+            job.update(fields)
+
+    def _fail_job_scans(self, job, scan_ids, error):
+        app.logger.error(f"Re-analysis {job['job_id']}: failed for scans {scan_ids}: {error}")
+        with self.lock:
+            job['failed'].update((scan_id, str(error)) for scan_id in scan_ids)
+
     def get_queue_size(self):
         """Get the current queue size"""
         return self.scan_queue.qsize()
 
+    def get_queue_status(self):
+        """Queued and running scans per user, with their estimated waiting times (see FairScheduler.status)"""
+        return {**self.scan_queue.status(self.max_workers), 'workers': self.max_workers}
+
+    def get_active_count(self):
+        """Get the number of scans currently being processed"""
+        with self.lock:
+            return len(self.active_scans)
+
+def _take_newer_urls(scan_data, duplicate):
+    """
+    Gives the scan the signed URLs of a duplicate submission that expire later than its own.
+    Returns True if a URL was replaced.
+    """
+    replaced = False
+    for field in ('scan_url', 'step_url'):
+        url, current = duplicate.get(field), scan_data.get(field)
+        if not url or url == current:
+            continue
+        current_expiry = downloads.signed_url_expiry(current)
+        expiry = downloads.signed_url_expiry(url)
+        if current_expiry is not None and (expiry is None or expiry > current_expiry):
+            scan_data[field] = url
+            replaced = True
+    return replaced
+
 # Global queue manager instance
-queue_manager = ScanQueueManager()
\ No newline at end of file
+queue_manager = ScanQueueManager(
+    journal=ScanJournal(app.config['SCAN_JOURNAL_PATH']),
+    stage_metrics=StageMetrics(app.config['PIPELINE_METRICS_PATH'])
+)
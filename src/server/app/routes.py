@@ -1,7 +1,8 @@
 from flask import request, jsonify, current_app
 from app import app
 from functools import wraps
-from app.queue_manager import queue_manager
+from app.queue_manager import queue_manager, ADDED, ALREADY_QUEUED, ALREADY_PROCESSED, DEFERRED
+from app.pipeline import config as pipeline_config
 
 def require_api_key(f):
     @wraps(f)
@@ -38,16 +39,90 @@ def start_pipeline():
     scan_url = data.get('scan_url')
     step_url = data.get('step_url')
     scan_id = data.get('scan_id')
+    # Scans with a higher priority are processed first, the others share the workers fairly between users
+    priority = data.get('priority', 0)
+    if isinstance(priority, bool) or not isinstance(priority, int):
+        return jsonify({"error": "priority must be an integer"}), 400
+
+    # A processed scan is only processed again when asked explicitly, e.g. when the user re-requests it
+    reprocess = data.get('reprocess', False)
+    if not isinstance(reprocess, bool):
+        return jsonify({"error": "reprocess must be a boolean"}), 400
 
     # Add the scan to the queue instead of starting it immediately
-    queue_manager.add_scan({
+    outcome = queue_manager.add_scan({
         'scan_id': scan_id,
         'scan_url': scan_url,
-        'step_url': step_url
-    })
+        'step_url': step_url,
+        'user': data.get('user'),
+        'priority': priority
+    }, reprocess=reprocess)
+
+    if outcome == ALREADY_PROCESSED:
+        return jsonify({
+            "error": "Scan already processed, submit it with \"reprocess\": true to process it again",
+            "scan_id": scan_id
+        }), 409
 
+    message, status = {
+        ADDED: ("Pipeline added to queue", 202),
+        ALREADY_QUEUED: ("Scan already in the queue", 200),
+        DEFERRED: ("Server is shutting down, the scan will be processed after the restart", 202),
+    }[outcome]
     return jsonify({
-        "message": "Pipeline added to queue",
+        "message": message,
         "scan_id": scan_id,
-        "queue_size": queue_manager.get_queue_size()
-    }), 202
\ No newline at end of file
+        "queue_size": queue_manager.get_queue_size(),
+        "active_scans": queue_manager.get_active_count()
+    }), status
+
+@app.route('/reanalyze', methods=['POST'])
+@require_api_key
+def reanalyze():
+    """
+    Re-scores processed scans, e.g. after a tolerance change, from their cached cleaned clouds and registrations:
+    {"step_id": ...} for all the completed scans of a STEP file, or {"scan_ids": [...]}, with an optional
+    "tolerance" in meters (the configured one by default). Only the stats documents are updated.
+    """
+    data = request.get_json(silent=True)
+    if not data or ('step_id' in data) == ('scan_ids' in data):
+        return jsonify({"error": "Expected either step_id or scan_ids"}), 400
+
+    scan_ids = data.get('scan_ids')
+    if scan_ids is not None and (not isinstance(scan_ids, list) or not all(isinstance(scan_id, str) for scan_id in scan_ids)):
+        return jsonify({"error": "scan_ids must be a list of strings"}), 400
+    tolerance = data.get('tolerance', pipeline_config.ANALYSIS_TOLERANCE_METERS)
+    if isinstance(tolerance, bool) or not isinstance(tolerance, (int, float)) or tolerance <= 0:
+        return jsonify({"error": "tolerance must be a positive number"}), 400
+
+    job_id = queue_manager.reanalyze(float(tolerance), scan_ids=scan_ids, step_id=data.get('step_id'))
+    return jsonify({
+        "message": "Re-analysis started",
+        "job_id": job_id,
+        "status_url": f"/reanalyze/{job_id}"
+    }), 202
+
+@app.route('/reanalyze/<job_id>')
+@require_api_key
+def reanalysis_status(job_id):
+    """Progress of a re-analysis job: scans completed, failed ones with their error"""
+    job = queue_manager.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job), 200
+
+@app.route('/queue/status')
+@require_api_key
+def queue_status():
+    """Queue depth and estimated waiting time of each user, or of the user given with ?user="""
+    status = queue_manager.get_queue_status()
+    user = request.args.get('user')
+    if user is not None:
+        status['users'] = {user: status['users'][user]} if user in status['users'] else {}
+    return jsonify(status), 200
+
+@app.route('/metrics/stages')
+@require_api_key
+def stage_metrics():
+    """Per-stage timing and memory histograms of the processed scans"""
+    return jsonify(queue_manager.stage_metrics.summary()), 200
\ No newline at end of file
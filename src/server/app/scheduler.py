@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import threading
+import time
+
+# Cost of the scans whose size is not known (yet), in points
+DEFAULT_COST = 1000000
+# Processing time per point before any scan has been measured
+DEFAULT_SECONDS_PER_POINT = 1e-5
+# Weight of the last measured scan in the processing time per point
+SPEED_SMOOTHING = 0.2
+# Size of a point in a binary PLY scan (float xyz and uchar rgb), when only the file size is known
+BYTES_PER_POINT = 15
+
+def estimate_cost(size, points):
+    """Cost of a scan in points, from its point count or else its size in bytes, None if neither is known"""
+    if points:
+        return points
+    return size // BYTES_PER_POINT if size else None
+
+class FairScheduler:
+    """
+    Queue of the scans waiting to be fetched, replacing the FIFO queue of the queue manager:
+      priority    the scans with the highest explicit priority go first
+      fair share  among the users with scans of that priority, the one that was given the least work
+                  goes next (start-time fair queueing, the work of a scan being its cost in points),
+                  so a user with 40 scans in the queue doesn't make the others wait for all of them
+      size        among the scans of that user, the smallest goes first. Waiting makes a scan look smaller,
+                  it counts half its cost after aging seconds, so the big ones are not starved
+    A user who had nothing queued starts at the current virtual time, idle users don't save up credit.
+    The dispatched scans are tracked until done(), for the queue status and its time estimates.
+    """
+
+    def __init__(self, aging=300.0, default_cost=DEFAULT_COST, seconds_per_point=DEFAULT_SECONDS_PER_POINT,
+                 timer=time.time):
+        self.aging = aging
+        # Wall clock, replaced by the simulations of the benchmark
+        self.timer = timer
+        self.default_cost = default_cost
+        self.seconds_per_point = seconds_per_point
+        self.condition = threading.Condition()
+        # user -> entries waiting
+        self.pending = {}
+        # key -> entry of the waiting and running scans
+        self.entries = {}
+        # key -> running entry, with its start time
+        self.running = {}
+        # user -> virtual time: the work given to the user so far
+        self.vtime = {}
+        # Virtual time of the last dispatched scan
+        self.virtual_time = 0.0
+        self.sequence = itertools.count()
+        # Set by close(): get() stops handing out the scans
+        self.closed = False
+
+    def put(self, key, item, user, priority=0, cost=None):
+        """Queues an item, cost being the size of the scan in points (None if not known yet)"""
+        entry = {
+            'key': key,
+            'item': item,
+            'user': user,
+            'priority': priority,
+            'cost': cost,
+            'enqueued_at': self.timer(),
+            'sequence': next(self.sequence),
+        }
+        with self.condition:
+            if not self.pending.get(user):
+                self.vtime[user] = max(self.vtime.get(user, 0.0), self.virtual_time)
+            self.pending.setdefault(user, []).append(entry)
+            self.entries[key] = entry
+            self.condition.notify()
+
+    def update_cost(self, key, cost):
+        """Sets the cost of a queued scan, once its size is known"""
+        with self.condition:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry['cost'] = cost
+
+    def find(self, key):
+        """Returns the item of a queued or running scan, or None"""
+        with self.condition:
+            entry = self.entries.get(key)
+            return entry['item'] if entry else None
+
+    def raise_priority(self, key, priority):
+        """Raises the priority of a queued scan, e.g. when it is submitted again with a higher one"""
+        with self.condition:
+            entry = self.entries.get(key)
+            if entry is not None and key not in self.running:
+                entry['priority'] = max(entry['priority'], priority)
+
+    def get(self):
+        """Removes and returns the next item, blocks while the queue is empty. Returns None once closed"""
+        with self.condition:
+            while not self.closed and not any(self.pending.values()):
+                self.condition.wait()
+            if self.closed:
+                return None
+            entry = _pick(self.pending, self.vtime, self.aging, self._cost, self.timer())
+            self.pending[entry['user']].remove(entry)
+            self.virtual_time = self.vtime[entry['user']]
+            self.vtime[entry['user']] += self._cost(entry)
+            entry['started_at'] = self.timer()
+            self.running[entry['key']] = entry
+            return entry['item']
+
+    def observe(self, key, seconds):
+        """Records the processing time of a running scan, to estimate the waiting times"""
+        with self.condition:
+            entry = self.running.get(key)
+            if entry is not None and entry['cost']:
+                speed = seconds / entry['cost']
+                self.seconds_per_point += SPEED_SMOOTHING * (speed - self.seconds_per_point)
+
+    def done(self, key):
+        """Forgets a dispatched scan, once it completed or failed"""
+        with self.condition:
+            entry = self.running.pop(key, None)
+            if entry is not None and self.entries.get(key) is entry:
+                del self.entries[key]
+
+    def close(self):
+        """Wakes up the waiting get() calls, which return None from now on. The queued items stay queued"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def qsize(self):
+        with self.condition:
+            return sum(len(entries) for entries in self.pending.values())
+
+    def status(self, workers):
+        """
+        Returns the queued and running scans of each user, with the estimated time (seconds) until the
+        next and the last scan of the user are processed. The estimate replays the scheduling on a copy of
+        the queue with the measured processing time per point, over the given number of workers.
+        """
+        with self.condition:
+            now = self.timer()
+            pending = {user: list(entries) for user, entries in self.pending.items() if entries}
+            vtime = dict(self.vtime)
+            users = {}
+            # Time at which each worker is free, after the scans already dispatched (being fetched,
+            # waiting for a worker or processed) in the order they were dispatched
+            lanes = [0.0] * workers
+            for entry in sorted(self.running.values(), key=lambda entry: entry['started_at']):
+                user = users.setdefault(entry['user'], _user_status())
+                user['running'] += 1
+                remaining = self._cost(entry) * self.seconds_per_point - (now - entry['started_at'])
+                heapq.heappush(lanes, heapq.heappop(lanes) + max(remaining, 0.0))
+
+            while any(pending.values()):
+                entry = _pick(pending, vtime, self.aging, self._cost, now)
+                pending[entry['user']].remove(entry)
+                vtime[entry['user']] += self._cost(entry)
+                finish = heapq.heappop(lanes) + self._cost(entry) * self.seconds_per_point
+                heapq.heappush(lanes, finish)
+
+                user = users.setdefault(entry['user'], _user_status())
+                user['queued'] += 1
+                user['queued_points'] += self._cost(entry)
+                if user['next_eta_seconds'] is None:
+                    user['next_eta_seconds'] = finish
+                user['eta_seconds'] = max(user['eta_seconds'] or 0.0, finish)
+
+            return {
+                'queued': sum(user['queued'] for user in users.values()),
+                'running': len(self.running),
+                'seconds_per_million_points': self.seconds_per_point * 1e6,
+                'users': users,
+            }
+
+    def _cost(self, entry):
+        return entry['cost'] or self.default_cost
+
+def _user_status():
+    return {'queued': 0, 'running': 0, 'queued_points': 0, 'next_eta_seconds': None, 'eta_seconds': None}
+
+def _pick(pending, vtime, aging, cost, now):
+    """The next entry: highest priority, then the user with the least work, then the smallest aged cost"""
+    priority = max(entry['priority'] for entries in pending.values() for entry in entries)
+    candidates = {user: [entry for entry in entries if entry['priority'] == priority]
+                  for user, entries in pending.items()}
+    user = min((user for user, entries in candidates.items() if entries),
+               key=lambda user: (vtime[user], candidates[user][0]['sequence']))
+    return min(candidates[user],
+               key=lambda entry: (cost(entry) / (1 + (now - entry['enqueued_at']) / aging), entry['sequence']))
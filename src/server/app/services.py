@@ -0,0 +1,72 @@
+import os
+import threading
+import firebase_admin
+import google.auth.credentials
+import google.auth.transport.requests
+from google.cloud import firestore
+from google.cloud import storage
+
+# Long-lived Firestore and Storage clients, created once per process and reused by all the scans.
+# firebase_admin caches its clients on the app object, which forked pool workers inherit along with
+# the parent's gRPC channel and HTTP sockets: each process creates its own clients instead.
+
+_clients = {}
+_lock = threading.Lock()
+
+def _reset_after_fork():
+    # The child must not use (nor close) the parent's connections, and the lock may have been copied while held
+    global _clients, _lock
+    _clients = {}
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _credentials_and_project():
+    """Credentials and project of the default Firebase app (the emulators don't need credentials)"""
+    firebase_app = firebase_admin.get_app()
+    if os.getenv("FIRESTORE_EMULATOR_HOST") or os.getenv("STORAGE_EMULATOR_HOST"):
+        return None, firebase_app.project_id
+    return firebase_app.credential.get_credential(), firebase_app.project_id
+
+def _get_client(name, factory):
+    with _lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+def get_firestore():
+    """Returns the Firestore client of the process"""
+    def create():
+        credentials, project = _credentials_and_project()
+        return firestore.Client(credentials=credentials, project=project)
+    return _get_client('firestore', create)
+
+def get_storage():
+    """Returns the Cloud Storage client of the process"""
+    def create():
+        credentials, project = _credentials_and_project()
+        return storage.Client(credentials=credentials, project=project)
+    return _get_client('storage', create)
+
+def get_bucket(name=None):
+    """Returns the bucket (by default the 'storageBucket' of the Firebase app) on the client of the process"""
+    name = name or firebase_admin.get_app().options.get('storageBucket')
+    if not name:
+        raise ValueError("No storage bucket configured, set FIREBASE_STORAGE_BUCKET")
+    return get_storage().bucket(name)
+
+def sign_url(bucket_name, blob_name, expiration):
+    """
+    Returns a V4 signed GET URL of the blob, valid for expiration (a timedelta). Credentials without a
+    private key (e.g. the metadata server ones on Cloud Run) sign through the IAM signBlob API.
+    """
+    credentials, _ = _credentials_and_project()
+    if credentials is None:
+        raise ValueError("Signed URLs need credentials, they can't be made for the emulators")
+    blob = get_storage().bucket(bucket_name).blob(blob_name)
+    if isinstance(credentials, google.auth.credentials.Signing):
+        return blob.generate_signed_url(version="v4", expiration=expiration, method="GET")
+    credentials.refresh(google.auth.transport.requests.Request())
+    return blob.generate_signed_url(version="v4", expiration=expiration, method="GET",
+                                    service_account_email=credentials.service_account_email,
+                                    access_token=credentials.token)
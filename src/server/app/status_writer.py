@@ -0,0 +1,173 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from multiprocessing import util
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.transforms import Maximum
+
+logger = logging.getLogger(__name__)
+
+# Terminal values of the 'status' field of a scan: completed and failed
+TERMINAL_STATUSES = (2, -1)
+# Firestore limit of writes per batch
+MAX_BATCH_SIZE = 500
+# Attempts to write the updates of a scan before dropping them
+MAX_ATTEMPTS = 3
+
+class StatusWriter:
+    """
+    Writes the status and progress of the scans to Firestore from a background thread, so the pipeline
+    never waits for a round-trip. The updates of each scan are merged until the next flush, which
+    happens at most once per interval with batched writes. Status changes are flushed right away.
+    Each process has its own writer (see get_status_writer), so the updates of a scan made by different
+    processes can land out of order: a progress without a status is written as a server-side maximum,
+    so a late write of an earlier stage can't move the progress back.
+    If a batch fails, its documents are written one by one and only the failing ones are retried (a deleted
+    scan is dropped). Terminal statuses are always written on their own, a bad document can't hold them back.
+    """
+
+    def __init__(self, interval=1.0, collection='scans', db=None):
+        self.interval = interval
+        self.collection = collection
+        # Firestore client, the default app's one if not given
+        self.db = db
+        self.condition = threading.Condition()
+        # Keeps the writes in order when flush() is called while the thread is writing
+        self.write_lock = threading.Lock()
+        # scan_id -> fields to update
+        self.pending = {}
+        self.attempts = {}
+        self.urgent = False
+        self.closed = False
+        self.thread = None
+
+    def update(self, scan_id, fields):
+        """Queues an update of the scan document, returns immediately"""
+        with self.condition:
+            self.pending.setdefault(scan_id, {}).update(fields)
+            if 'status' in fields:
+                self.urgent = True
+                self.condition.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name="status-writer")
+                self.thread.start()
+
+    def flush(self):
+        """Writes the pending updates now, in the calling thread"""
+        with self.write_lock:
+            with self.condition:
+                pending, self.pending = self.pending, {}
+                self.urgent = False
+            if pending:
+                self._write(pending)
+
+    def close(self):
+        """Stops the background thread and writes what is left"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                # The interval bounds the rate of the writes, a terminal status cuts it short
+                deadline = time.monotonic() + self.interval
+                while not (self.urgent or self.closed) and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                if self.closed:
+                    return
+            self.flush()
+
+    def _write(self, pending):
+        if self.db is None:
+            from app import services
+            self.db = services.get_firestore()
+        db = self.db
+        terminal = [(scan_id, fields) for scan_id, fields in pending.items() if fields.get('status') in TERMINAL_STATUSES]
+        others = [(scan_id, fields) for scan_id, fields in pending.items() if fields.get('status') not in TERMINAL_STATUSES]
+        for start in range(0, len(others), MAX_BATCH_SIZE):
+            chunk = others[start:start + MAX_BATCH_SIZE]
+            batch = db.batch()
+            for scan_id, fields in chunk:
+                batch.update(db.collection(self.collection).document(scan_id), _guarded(fields))
+            try:
+                batch.commit()
+                for scan_id, _ in chunk:
+                    self.attempts.pop(scan_id, None)
+            except Exception as e:
+                logger.warning(f"Failed to write the status of {len(chunk)} scans ({e}), writing them one by one")
+                self._write_each(chunk)
+        self._write_each(terminal)
+
+    def _write_each(self, items):
+        """Writes the updates one document at a time, retries the failed ones"""
+        failed = []
+        for scan_id, fields in items:
+            try:
+                self.db.collection(self.collection).document(scan_id).update(_guarded(fields))
+            except NotFound:
+                logger.warning(f"Scan {scan_id} no longer exists, dropping its status update {fields}")
+            except Exception as e:
+                logger.error(f"Failed to write the status of scan {scan_id}: {e}")
+                failed.append((scan_id, fields))
+                continue
+            self.attempts.pop(scan_id, None)
+        if failed:
+            self._requeue(failed)
+
+    def _requeue(self, chunk):
+        """Puts back failed updates under the ones queued since, unless they failed too many times"""
+        with self.condition:
+            for scan_id, fields in chunk:
+                self.attempts[scan_id] = self.attempts.get(scan_id, 0) + 1
+                if self.attempts[scan_id] >= MAX_ATTEMPTS:
+                    logger.error(f"Dropping the status update of scan {scan_id}: {fields}")
+                    self.attempts.pop(scan_id)
+                    continue
+                self.pending[scan_id] = {**fields, **self.pending.get(scan_id, {})}
+                if fields.get('status') in TERMINAL_STATUSES:
+                    self.urgent = True
+
+def _guarded(fields):
+    """A progress without a status only moves forward (see StatusWriter), a status change sets it as is"""
+    if 'progress' in fields and 'status' not in fields:
+        return {**fields, 'progress': Maximum(fields['progress'])}
+    return fields
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def _reset_after_fork():
+    # A forked worker gets its own writer and thread: the parent's thread does not exist
+    # in the child, and the locks may have been copied while held
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def get_status_writer():
+    """Returns the status writer of the process, created on first use"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            from app import app
+            _writer = StatusWriter(app.config.get('STATUS_FLUSH_INTERVAL', 1.0))
+            # atexit runs in the server process, pool workers exit through multiprocessing's finalizers
+            atexit.register(_writer.close)
+            util.Finalize(_writer, _writer.close, exitpriority=10)
+        return _writer
+
+def update_status(scan_id, **fields):
+    """Queues an update of the status/progress of a scan, e.g. update_status(scan_id, progress=40)"""
+    get_status_writer().update(scan_id, fields)
+
+def flush_status():
+    """Writes the queued updates of the process now, e.g. when the server stops"""
+    with _writer_lock:
+        writer = _writer
+    if writer is not None:
+        writer.flush()
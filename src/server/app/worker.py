@@ -1,203 +1,580 @@
 import os
+import json
+import shutil
 import tempfile
-import requests
-from firebase_admin import firestore, storage
-import cadquery as cq
+import time
+from datetime import timedelta
 import numpy as np
 import open3d as o3d
 from app.pipeline import config
+from app.pipeline import reference
 from app.pipeline import preprocess
 from app.pipeline import registration
 from app.pipeline import analysis
-from flask import current_app as app
+from app.pipeline import autotune
+from app.pipeline import artifacts
+from app.pipeline import cache
+from app import app, init_worker_logging
+from app.instrumentation import ScanProfile
+from app import downloads
+from app import services
+from app.status_writer import update_status, MAX_BATCH_SIZE
 
-def pipeline_worker(scan_url, step_url, scan_id):
+# The pipeline of a scan is split in stages, run by the queue manager so that consecutive scans overlap:
+#   fetch_inputs      I/O, in a thread of the server: downloads the scan and the STEP file
+#   prepare_reference CPU, in a process: converts the STEP file into the reference cache, tunes the parameters
+#   process_scan      CPU, in a process: preprocessing, registration, analysis and heatmap files
+#   publish_results   I/O, in a thread of the server: uploads the heatmap files and writes the stats
+
+def init_pool_worker(threads):
+    """
+    Initializer of the forked pipeline workers: logs through the server (see init_worker_logging) and limits
+    Open3D to the given number of threads (0 for no limit), so the workers don't oversubscribe the cores
+    """
+    init_worker_logging()
+    if threads and hasattr(o3d.utility, "set_max_threads"):
+        o3d.utility.set_max_threads(threads)
+
+def fetch_inputs(scan_id, scan_url, step_url, profile):
     """
-    Main pipeline worker function.
-    Downloads files, processes them, uploads results, and updates Firestore.
+    Stage 1: downloads the scan and the STEP file into a new temporary directory.
+    Returns (temp_dir, scan_filename, step_filename). The directory is removed on error.
     """
-    scan_filename = None
-    step_filename = None
-    temp_dir = None
-    
+    update_status(scan_id, status=1, progress=0)
+
+    # Create a temporary directory for this scan
+    temp_dir = tempfile.mkdtemp(prefix=f"scan_{scan_id}_")
+    app.logger.info(f"Temporary directory created: {temp_dir}")
+
     try:
-        db = firestore.client()
-        scan_ref = db.collection('scans').document(scan_id)
-        scan_ref.update({'status': 1, 'progress': 0})
+        with profile.stage('download', thread=True) as stage:
+            # Download scan and step files concurrently
+            scan_filename = os.path.join(temp_dir, "scan.ply")
+            step_filename = os.path.join(temp_dir, "step.step")
+            app.logger.info(f"Downloading scan from {scan_url} and step from {step_url}")
+            downloads.download_files([(scan_url, scan_filename), (step_url, step_filename)])
+            app.logger.info(f"Scan and step downloaded to {temp_dir}")
+            stage['bytes'] = os.path.getsize(scan_filename) + os.path.getsize(step_filename)
+    except Exception:
+        cleanup(scan_id, temp_dir)
+        raise
+
+    # The next stage runs in another process, with its own status writer: the progress only moves forward
+    # whatever the order the writers land in (see status_writer.StatusWriter)
+    update_status(scan_id, progress=10)
+    return temp_dir, scan_filename, step_filename
+
+def prepare_reference(scan_id, scan_filename, step_filename):
+    """
+    Stage 2: tessellates the STEP file, derives the pipeline parameters from the part and the scan
+    (see autotune) and computes the CAD features, or finds them in the cache.
+    The result is only stored in the reference cache, where process_scan loads it from.
+    Returns (parameters, profiled stages).
+    """
+    profile = ScanProfile(scan_id)
+    with profile.stage('step_conversion') as stage:
+        mesh = _load_cad_mesh(step_filename)
+        _, mesh_arrays, stage['cache_hit'] = mesh
+        stage['vertices'] = len(mesh_arrays['vertices'])
+        stage['faces'] = len(mesh_arrays['face_types'])
+
+    with profile.stage('autotune') as stage:
+        parameters = _pipeline_parameters(scan_filename, mesh_arrays['vertices'])
+        stage.update(parameters)
+    app.logger.info(f"Pipeline parameters: {parameters}")
+
+    with profile.stage('cad_features') as stage:
+        cad_reference = _load_cad_reference(step_filename, parameters['voxel_size'], mesh)
+        stage['points'] = len(cad_reference.feature_points)
+        stage['cache_hit'] = cad_reference.from_cache
+
+    update_status(scan_id, progress=20)
+    return parameters, profile.stages
+
+def process_scan(scan_id, scan_filename, step_filename, temp_dir, parameters):
+    """
+    Stage 3: aligns the scan to its (already prepared) CAD reference and writes the heatmap file,
+    with the parameters returned by prepare_reference.
+    The cleaned cloud, the transformations and the results are stored in the artifact cache (see artifacts),
+    so a scan run again only redoes the steps whose inputs or settings changed.
+    Returns (outputs, metrics, profiled stages), outputs being the (local path, storage path) of the heatmap files.
+    """
+    profile = ScanProfile(scan_id)
+
+    try:
+        # Loaded from the reference cache, filled by prepare_reference
+        cad_reference = _load_cad_reference(step_filename, parameters['voxel_size'])
+
+        keys = None
+        if config.ARTIFACT_CACHE:
+            with profile.stage('result_cache') as stage:
+                scan_hash = cache.file_hash(scan_filename)
+                keys = _artifact_keys(scan_hash, cad_reference, parameters)
+                result = artifacts.load_result(config.CACHE_DIR, keys['result'], temp_dir)
+                stage['cache_hit'] = result is not None
+            _write_manifest(scan_id, scan_hash, cad_reference, parameters, keys)
+            if result is not None:
+                app.logger.info("Heatmap and metrics found in the artifact cache")
+                files, metrics = result
+                outputs = [(os.path.join(temp_dir, name), f"comparisons/{scan_id}{suffix}") for name, suffix in files]
+                update_status(scan_id, progress=90)
+                return outputs, metrics, profile.stages
 
-        # Create a temporary directory for this scan
-        temp_dir = tempfile.mkdtemp(prefix=f"scan_{scan_id}_")
-        app.logger.info(f"Temporary directory created: {temp_dir}")
-        
-        # Download scan file
-        scan_filename = os.path.join(temp_dir, "scan.ply")
-        app.logger.info(f"Downloading scan from {scan_url}")
-        _download_file(scan_url, scan_filename)
-        app.logger.info(f"Scan downloaded to {scan_filename}")
-
-        # Download step file
-        step_filename = os.path.join(temp_dir, "step.step")
-        app.logger.info(f"Downloading step from {step_url}")
-        _download_file(step_url, step_filename)
-        
-        scan_ref.update({'progress': 10})
-        
-        # Convert step to ply
-        step_ply_filename = os.path.join(temp_dir, "step.ply")
-        _convert_step_to_ply(step_filename, step_ply_filename, tolerance=config.TOLERANCE)
-        
-        scan_ref.update({'progress': 20})
-        
         # --------------------------------------------------------------------
         # --- BEGINNING OF MAIN PROCESSING LOGIC ---
         # --------------------------------------------------------------------
 
         app.logger.info("Loading point clouds with Open3D...")
-        target_pcd = o3d.io.read_point_cloud(step_ply_filename)
-        source_pcd = o3d.io.read_point_cloud(scan_filename)
-        
+        target_pcd = cad_reference.point_cloud()
+
         # 1. Preprocessing
         app.logger.info("Starting preprocessing...")
-        source_cleaned = preprocess.segment_and_clean(
-            source_pcd,
-            config.PLANE_DISTANCE_THRESHOLD,
-            config.OUTLIER_NB_NEIGHBORS,
-            config.OUTLIER_STD_RATIO
-        )
-        scan_ref.update({'progress': 40})
-
-        # 2. Global Registration
-        app.logger.info("Starting global registration...")
-        initial_transform = registration.run_global_registration(
-            source_cleaned, 
-            target_pcd, 
-            config.VOXEL_SIZE_FEATURES
-        )
-        scan_ref.update({'progress': 60})
+        with profile.stage('segment_and_clean') as stage:
+            source_cleaned = artifacts.load_cleaned(config.CACHE_DIR, keys['cleaned']) if keys else None
+            stage['cache_hit'] = source_cleaned is not None
+            if source_cleaned is None:
+                source_pcd = o3d.io.read_point_cloud(scan_filename)
+                source_cleaned = _clean_scan(source_pcd, parameters, stage)
+                if keys:
+                    artifacts.save_cleaned(config.CACHE_DIR, keys['cleaned'], source_cleaned)
+            stage['points'] = len(source_cleaned.points)
+        update_status(scan_id, progress=40)
 
-        # 3. Local Registration (ICP)
-        app.logger.info("Refining with ICP...")
-        final_transform = registration.refine_with_icp(
-            source_cleaned,
-            target_pcd,
-            initial_transform,
-            config.ICP_THRESHOLD
-        )
-        scan_ref.update({'progress': 80})
+        # 2. and 3. Global and local registration
+        transforms = artifacts.load_registration(config.CACHE_DIR, keys['registration']) if keys else None
+        if transforms is None:
+            transforms = _register(scan_id, source_cleaned, target_pcd, cad_reference, parameters, profile)
+            if keys:
+                artifacts.save_registration(config.CACHE_DIR, keys['registration'], *transforms)
+        else:
+            app.logger.info("Registration found in the artifact cache")
+        initial_transform, final_transform = transforms
+        update_status(scan_id, progress=80)
 
         # 4. Analysis and metrics calculation
         app.logger.info("Calculating metrics...")
-        heatmap_pcd, metrics = analysis.calculate_metrics(
-            source_cleaned,
-            target_pcd,
-            final_transform,
-            config.ANALYSIS_TOLERANCE_METERS # Pass the tolerance from the config file
-        )
-        app.logger.info(f"Calculated metrics: {metrics}")
+        with profile.stage('analysis') as stage:
+            heatmap, metrics = _analyze(source_cleaned, target_pcd, final_transform, cad_reference,
+                                        config.ANALYSIS_TOLERANCE_METERS, stage)
+        app.logger.info(f"Calculated metrics: { {name: value for name, value in metrics.items() if name != 'faces'} }")
 
         # 5. Save the result and prepare for upload
         app.logger.info("Saving heatmap file...")
-        heatmap_ply_path = os.path.join(temp_dir, "heatmap_scan.ply")
-        o3d.io.write_point_cloud(heatmap_ply_path, heatmap_pcd)
+        outputs = []
+        with profile.stage('heatmap_write') as stage:
+            if config.HEATMAP_FORMAT in ("ply", "both"):
+                heatmap_ply_path = os.path.join(temp_dir, "heatmap_scan.ply")
+                heatmap.write_ply(heatmap_ply_path)
+                outputs.append((heatmap_ply_path, f"comparisons/{scan_id}.ply"))
+            if config.HEATMAP_FORMAT in ("compact", "both"):
+                heatmap_compact_path = os.path.join(temp_dir, "heatmap_scan.hmap")
+                heatmap.write_compact(heatmap_compact_path, config.HEATMAP_POSITION_PRECISION, config.HEATMAP_CODEC)
+                outputs.append((heatmap_compact_path, f"comparisons/{scan_id}.hmap"))
+            if not outputs:
+                raise ValueError(f"Unknown heatmap format '{config.HEATMAP_FORMAT}', expected 'ply', 'compact' or 'both'")
+            if config.HEATMAP_LOD:
+                # The index comes last, so it is uploaded after the tiles it references
+                lod_dir = os.path.join(temp_dir, "lod")
+                lod_files = heatmap.write_lod(
+                    lod_dir,
+                    config.LOD_LEVELS,
+                    config.LOD_BASE_RESOLUTION,
+                    config.LOD_TILE_DEPTH,
+                    config.HEATMAP_POSITION_PRECISION,
+                    config.HEATMAP_CODEC
+                )
+                outputs.extend((os.path.join(lod_dir, name), f"comparisons/{scan_id}/lod/{name}") for name in lod_files)
+            stage['bytes'] = sum(os.path.getsize(path) for path, _ in outputs)
         
-        scan_ref.update({'progress': 90})
+        if keys:
+            prefix = f"comparisons/{scan_id}"
+            files = [[os.path.relpath(path, temp_dir), blob_path[len(prefix):]] for path, blob_path in outputs]
+            artifacts.save_result(config.CACHE_DIR, keys['result'], temp_dir, files, metrics)
 
-        # Upload heatmap file to Firebase Storage
-        bucket = storage.bucket()
-        heatmap_blob = bucket.blob(f"comparisons/{scan_id}.ply")
-        heatmap_blob.upload_from_filename(heatmap_ply_path)
+        update_status(scan_id, progress=90)
 
-        # Update the 'stats' document in Firestore with the new metrics
-        stats_doc_ref = db.collection('stats').document(scan_id)
-        stats_doc_ref.set({
-            'std_deviation': metrics['std_deviation'],
-            'min_deviation': metrics['min_deviation'],
-            'max_deviation': metrics['max_deviation'],
-            'avg_deviation': metrics['avg_deviation'],
-            'accuracy': metrics['accuracy_rmse'],
-            'ppwt': metrics['percentage_of_points_within_tolerance'],
-        })
-        
         # --------------------------------------------------------------------
         # --- END OF MAIN PROCESSING LOGIC ---
         # --------------------------------------------------------------------
 
-        app.logger.info(f"Pipeline completed for scan_id: {scan_id}")
+        return outputs, metrics, profile.stages
 
-        scan_ref.update({'status': 2, 'progress': 100})
-        
-    except Exception as e:
-        app.logger.error(f"Error in pipeline for scan_id {scan_id}: {e}")
-        try:
-            db = firestore.client()
-            scan_ref = db.collection('scans').document(scan_id)
-            scan_ref.update({'status': -1})
-        except Exception as db_error:
-            app.logger.error(f"Failed to update Firestore with error status: {db_error}")
-        
-        # Re-raise the exception so queue_manager can handle retry
+    except Exception:
+        app.logger.info(f"Profile of the failed processing: {json.dumps(profile.to_dict(failed=True))}")
         raise
-        
-    finally:
-        # Clean up temporary files
-        app.logger.info(f"Cleaning up temporary files for scan_id: {scan_id}")
-        if temp_dir and os.path.exists(temp_dir):
-            import shutil
-            shutil.rmtree(temp_dir)
 
+def publish_results(scan_id, outputs, metrics, profile):
+    """
+    Stage 4: uploads the heatmap files, writes the stats and marks the scan as completed.
+    """
+    db = services.get_firestore()
+
+    with profile.stage('upload', thread=True):
+        # Upload heatmap files to Firebase Storage, in order
+        bucket = services.get_bucket()
+        for local_path, blob_path in outputs:
+            bucket.blob(blob_path).upload_from_filename(local_path)
+
+        # Update the 'stats' document in Firestore with the new metrics
+        db.collection('stats').document(scan_id).set(_stats_document(metrics))
+
+        # Deviations of each B-rep face of the part, as columns (one entry per face hit by the scan)
+        if 'faces' in metrics:
+            db.collection('face_stats').document(scan_id).set(metrics['faces'])
+
+    app.logger.info(f"Pipeline completed for scan_id: {scan_id}")
+    update_status(scan_id, status=2, progress=100)
 
-def _download_file(url, destination_path):
+def reanalyze_scan(scan_id, tolerance):
     """
-    Download a file from a URL (Firebase Storage signed URL)
+    Computes the metrics of an already processed scan again, e.g. with another tolerance, from its artifacts:
+    the cleaned cloud, the final transformation and the CAD reference found through its manifest.
+    Runs in a process of the pool. The heatmap files are left as they are.
+    Returns (metrics, profiled stages). Raises LookupError if the artifacts are no longer in the cache.
     """
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    
-    with open(destination_path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+    profile = ScanProfile(scan_id)
+    with profile.stage('reanalysis_load'):
+        manifest = artifacts.read_manifest(config.CACHE_DIR, scan_id)
+        if manifest is None:
+            raise LookupError(f"No manifest for scan {scan_id}, it must be processed again")
+        source_cleaned = artifacts.load_cleaned(config.CACHE_DIR, manifest['keys']['cleaned'])
+        transforms = artifacts.load_registration(config.CACHE_DIR, manifest['keys']['registration'])
+        cad_reference = reference.load_cached_reference(config.CACHE_DIR, manifest['mesh_key'],
+                                                        manifest['reference_key'])
+        if source_cleaned is None or transforms is None or cad_reference is None:
+            raise LookupError(f"The artifacts of scan {scan_id} are no longer in the cache, it must be processed again")
 
+    with profile.stage('analysis') as stage:
+        _, metrics = _analyze(source_cleaned, cad_reference.point_cloud(), transforms[1], cad_reference, tolerance,
+                              stage)
+    return metrics, profile.stages
 
-def _convert_step_to_ply(step_path, ply_output_path, tolerance=0.01):
+def scans_of_step(step_id):
+    """Returns the ids of the completed scans of a STEP file"""
+    query = services.get_firestore().collection('scans').where('step', '==', step_id).where('status', '==', 2)
+    return [doc.id for doc in query.stream()]
+
+def write_stats(results):
+    """
+    Replaces the stats (and per-face stats) documents of the scans with batched writes,
+    results being (scan_id, metrics) pairs.
+    """
+    db = services.get_firestore()
+    writes = []
+    for scan_id, metrics in results:
+        writes.append((db.collection('stats').document(scan_id), _stats_document(metrics)))
+        if 'faces' in metrics:
+            writes.append((db.collection('face_stats').document(scan_id), metrics['faces']))
+    for start in range(0, len(writes), MAX_BATCH_SIZE):
+        batch = db.batch()
+        for doc_ref, document in writes[start:start + MAX_BATCH_SIZE]:
+            batch.set(doc_ref, document)
+        batch.commit()
+
+def refresh_signed_urls(scan_data, margin):
+    """
+    Returns new signed URLs ({'scan_url': ...}) for the Cloud Storage URLs of the scan that are expired or
+    expire within margin seconds, signed by the server for SIGNED_URL_EXPIRATION seconds.
+    """
+    urls = {}
+    for field in ('scan_url', 'step_url'):
+        url = scan_data.get(field)
+        expiry = downloads.signed_url_expiry(url) if url else None
+        if expiry is None or expiry > time.time() + margin:
+            continue
+        location = downloads.signed_url_blob(url)
+        if location is None:
+            app.logger.warning(f"The {field} of scan {scan_data['scan_id']} expired and is not a Cloud Storage URL")
+            continue
+        urls[field] = services.sign_url(*location, timedelta(seconds=app.config.get('SIGNED_URL_EXPIRATION', 900)))
+    return urls
+
+def mark_failed(scan_id, error):
+    """Marks the scan as failed in Firestore, after an error in any stage"""
+    app.logger.error(f"Error in pipeline for scan_id {scan_id}: {error}")
+    update_status(scan_id, status=-1)
+
+def cleanup(scan_id, temp_dir):
+    """Removes the temporary files of the scan"""
+    app.logger.info(f"Cleaning up temporary files for scan_id: {scan_id}")
+    if temp_dir and os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+
+def _stats_document(metrics):
+    """The 'stats' document of a scan"""
+    return {
+        'std_deviation': metrics['std_deviation'],
+        'min_deviation': metrics['min_deviation'],
+        'max_deviation': metrics['max_deviation'],
+        'avg_deviation': metrics['avg_deviation'],
+        'accuracy': metrics['accuracy_rmse'],
+        'ppwt': metrics['percentage_of_points_within_tolerance'],
+        'tolerance': metrics['tolerance'],
+        # Distribution of the deviations, so clients can plot it without the heatmap file
+        'histogram': metrics['histogram'],
+        'percentiles': metrics['percentiles'],
+        'color_range': metrics['color_range'],
+    }
+
+def _clean_scan(source_pcd, parameters, stage):
+    """Removes the floor and the background of the scan, then its outliers (step 1 of process_scan)"""
+    # The floor, plus the walls and fixtures with the isolation, only those wider than the part
+    source_segmented, stage['planes'] = preprocess.remove_planes(
+        source_pcd,
+        parameters['plane_distance_threshold'],
+        config.ISOLATION_MAX_PLANES if config.ISOLATION else 1,
+        config.ISOLATION_MIN_PLANE_RATIO,
+        parameters['diagonal']
+    )
+    source_cleaned = preprocess.remove_outliers(
+        source_segmented,
+        config.OUTLIER_METHOD,
+        config.OUTLIER_NB_NEIGHBORS,
+        config.OUTLIER_STD_RATIO,
+        parameters['outlier_voxel_size'],
+        config.OUTLIER_MIN_POINTS
+    )
+    if config.ISOLATION:
+        source_cleaned = preprocess.largest_cluster(
+            source_cleaned,
+            config.CLUSTER_METHOD,
+            parameters['cluster_eps'],
+            config.CLUSTER_MIN_POINTS
+        )
+    stage['points_in'] = len(source_pcd.points)
+    return source_cleaned
+
+
+def _register(scan_id, source_cleaned, target_pcd, cad_reference, parameters, profile):
+    """
+    Aligns the cleaned scan to the CAD reference (steps 2 and 3 of process_scan).
+    Returns the (global, final) transformations.
+    """
+    voxel_size = parameters['voxel_size']
+    icp_threshold = parameters['icp_threshold']
+    multiscale = config.REGISTRATION_MODE == "multiscale"
+    voxel_sizes = [voxel_size * factor for factor in config.VOXEL_PYRAMID_FACTORS]
+
+    # 2. Global Registration (on the coarsest pyramid level in multiscale mode)
+    app.logger.info("Starting global registration...")
+    with profile.stage('global_registration') as stage:
+        source_features = source_cleaned.voxel_down_sample(voxel_sizes[0]) if multiscale else source_cleaned
+        target_features = cad_reference.feature_point_cloud()
+        hypotheses = registration.generate_hypotheses(
+            source_features,
+            target_features,
+            voxel_size,
+            target_fpfh=cad_reference.fpfh_feature(),
+            backend=config.GLOBAL_REGISTRATION_BACKEND,
+            count=config.ICP_HYPOTHESES,
+            fallback=config.GLOBAL_REGISTRATION_FALLBACK,
+            **_global_backend_options()
+        )
+        stage['points'] = len(source_features.points)
+        stage['hypotheses'] = len(hypotheses)
+    app.logger.info(f"Found {len(hypotheses)} distinct global registration hypotheses")
+    update_status(scan_id, progress=60)
+
+    # 3. Local Registration (ICP)
+    app.logger.info("Refining with ICP...")
+    with profile.stage('icp') as stage:
+        # Keep the best hypothesis after a few cheap ICP rounds on the feature clouds
+        initial_transform = registration.select_best_hypothesis(
+            source_features,
+            target_features,
+            hypotheses,
+            max(icp_threshold, voxel_sizes[0] * 1.5) if multiscale else icp_threshold,
+            config.ICP_HYPOTHESIS_ITERATIONS,
+            config.ICP_METHOD,
+            config.ICP_HYPOTHESIS_WORKERS
+        )
+        # Only the winner is refined to convergence
+        if multiscale:
+            final_transform = registration.refine_multiscale_icp(
+                source_cleaned,
+                target_pcd,
+                initial_transform,
+                voxel_sizes,
+                config.ICP_PYRAMID_ITERATIONS,
+                icp_threshold,
+                config.ICP_MAX_ITERATION,
+                config.ICP_METHOD
+            )
+        else:
+            final_transform = registration.refine_with_icp(
+                source_cleaned,
+                target_pcd,
+                initial_transform,
+                icp_threshold,
+                config.ICP_MAX_ITERATION,
+                config.ICP_METHOD
+            )
+        stage['points'] = len(source_cleaned.points)
+    return initial_transform, final_transform
+
+
+def _analyze(source_cleaned, target_pcd, final_transform, cad_reference, tolerance, stage):
+    """Compares the registered scan to the CAD reference (step 4 of process_scan), returns (heatmap, metrics)"""
+    mesh_distances = config.ANALYSIS_DISTANCE_METHOD == "mesh"
+    heatmap, metrics = analysis.calculate_metrics(
+        source_cleaned,
+        target_pcd,
+        final_transform,
+        tolerance,
+        target_mesh=cad_reference.triangle_mesh() if mesh_distances else None,
+        chunk_size=config.ANALYSIS_CHUNK_SIZE,
+        color_range=config.HEATMAP_COLOR_RANGE,
+        color_percentile=config.HEATMAP_COLOR_PERCENTILE,
+        histogram_bins=config.HISTOGRAM_BINS,
+        histogram_extent=config.HISTOGRAM_RANGE_TOLERANCES * tolerance,
+        percentiles=config.STATS_PERCENTILES,
+        # Built once per part in this process
+        scene=cad_reference.raycasting_scene() if mesh_distances else None,
+        face_ids=cad_reference.face_ids if config.ANALYSIS_PER_FACE else None,
+        face_types=cad_reference.face_types
+    )
+    metrics['tolerance'] = tolerance
+    stage['points'] = len(heatmap.points)
+    if 'faces' in metrics:
+        stage['faces'] = len(metrics['faces']['face'])
+    return heatmap, metrics
+
+
+def _artifact_keys(scan_hash, cad_reference, parameters):
+    """Keys of the artifacts of the scan, from the settings that each of them depends on"""
+    preprocessing = {
+        'plane_distance_threshold': parameters['plane_distance_threshold'],
+        'max_planes': config.ISOLATION_MAX_PLANES if config.ISOLATION else 1,
+        'min_plane_ratio': config.ISOLATION_MIN_PLANE_RATIO,
+        'min_plane_extent': parameters['diagonal'],
+        'outlier_method': config.OUTLIER_METHOD,
+        'outlier_neighbors': config.OUTLIER_NB_NEIGHBORS,
+        'outlier_std_ratio': config.OUTLIER_STD_RATIO,
+        'outlier_voxel_size': parameters['outlier_voxel_size'],
+        'outlier_min_points': config.OUTLIER_MIN_POINTS,
+        'cluster': [config.CLUSTER_METHOD, parameters['cluster_eps'], config.CLUSTER_MIN_POINTS] if config.ISOLATION else None,
+    }
+    registration_settings = {
+        'voxel_size': parameters['voxel_size'],
+        'icp_threshold': parameters['icp_threshold'],
+        'mode': config.REGISTRATION_MODE,
+        'backend': config.GLOBAL_REGISTRATION_BACKEND,
+        'fallback': config.GLOBAL_REGISTRATION_FALLBACK,
+        'backend_options': _global_backend_options(),
+        'pyramid_factors': config.VOXEL_PYRAMID_FACTORS,
+        'pyramid_iterations': config.ICP_PYRAMID_ITERATIONS,
+        'max_iteration': config.ICP_MAX_ITERATION,
+        'method': config.ICP_METHOD,
+        'hypotheses': [config.ICP_HYPOTHESES, config.ICP_HYPOTHESIS_ITERATIONS],
+    }
+    analysis_settings = {
+        'tolerance': config.ANALYSIS_TOLERANCE_METERS,
+        'distance_method': config.ANALYSIS_DISTANCE_METHOD,
+        'colors': [config.HEATMAP_COLOR_RANGE, config.HEATMAP_COLOR_PERCENTILE],
+        'per_face': config.ANALYSIS_PER_FACE,
+        'histogram': [config.HISTOGRAM_BINS, config.HISTOGRAM_RANGE_TOLERANCES, config.STATS_PERCENTILES],
+        'format': config.HEATMAP_FORMAT,
+        'codec': config.HEATMAP_CODEC,
+        'precision': config.HEATMAP_POSITION_PRECISION,
+        'lod': [config.LOD_LEVELS, config.LOD_BASE_RESOLUTION, config.LOD_TILE_DEPTH] if config.HEATMAP_LOD else None,
+    }
+    return artifacts.artifact_keys(scan_hash, cad_reference.key, preprocessing, registration_settings,
+                                   analysis_settings)
+
+
+def _write_manifest(scan_id, scan_hash, cad_reference, parameters, keys):
+    """Records the artifacts of the scan, so they can be found from its scan_id"""
+    try:
+        artifacts.write_manifest(config.CACHE_DIR, scan_id, {
+            'scan_id': scan_id,
+            'scan_hash': scan_hash,
+            'mesh_key': cad_reference.mesh_key,
+            'reference_key': cad_reference.key,
+            'parameters': parameters,
+            'keys': keys,
+        })
+    except OSError as e:
+        app.logger.error(f"Failed to write the manifest of scan {scan_id}: {e}")
+
+
+def _global_backend_options():
+    """Returns the config options of the selected global registration backend"""
+    if config.GLOBAL_REGISTRATION_BACKEND == "ransac":
+        return {'max_iteration': config.RANSAC_MAX_ITERATION, 'confidence': config.RANSAC_CONFIDENCE}
+    return {}
+
+
+def evict_cache():
+    """Keeps the pipeline cache within its size and age limits, returns (removed entries, removed bytes)"""
+    return cache.evict(config.CACHE_DIR, config.CACHE_MAX_BYTES, config.CACHE_MAX_AGE_DAYS * 24 * 3600)
+
+
+def _pipeline_parameters(scan_filename, cad_vertices):
     """
-    Convert a STEP file to PLY format using CadQuery
-    
-    Args:
-        step_path: Path to input STEP file
-        ply_output_path: Path to output PLY file
-        tolerance: Meshing tolerance (smaller = more detailed, default 0.01mm)
+    Returns the length parameters of the pipeline: derived from the scan spacing and the part size
+    with AUTOTUNE, the fixed ones of the config otherwise or when the spacing can't be measured.
     """
+    fixed = {
+        # Not a length of the config: the minimum extent of the planes removed by the isolation
+        'diagonal': autotune.bounding_box_diagonal(cad_vertices),
+        'voxel_size': config.VOXEL_SIZE_FEATURES,
+        'icp_threshold': config.ICP_THRESHOLD,
+        'plane_distance_threshold': config.PLANE_DISTANCE_THRESHOLD,
+        'outlier_voxel_size': config.OUTLIER_VOXEL_SIZE,
+        'cluster_eps': config.CLUSTER_EPS,
+    }
+    if not config.AUTOTUNE:
+        return fixed
+
+    # Only a sample of the scan is read, process_scan parses the whole file
+    sample = autotune.sample_ply_points(scan_filename, config.AUTOTUNE_SAMPLE_SIZE)
+    if sample is None:
+        sample = np.asarray(o3d.io.read_point_cloud(scan_filename).points), None
+    scan_points, total = sample
+    spacing = autotune.estimate_spacing(scan_points, config.AUTOTUNE_SAMPLE_SIZE, total=total)
+    if not spacing > 0:
+        app.logger.warning(f"Could not measure the spacing of the scan ({spacing}), using the fixed parameters")
+    return autotune.derive_parameters(
+        spacing,
+        fixed['diagonal'],
+        config.AUTOTUNE_FEATURE_CELLS,
+        config.AUTOTUNE_MIN_SPACING_FACTOR,
+        config.AUTOTUNE_ICP_SPACING_FACTOR,
+        config.AUTOTUNE_PLANE_SPACING_FACTOR,
+        config.AUTOTUNE_OUTLIER_SPACING_FACTOR,
+        config.AUTOTUNE_CLUSTER_SPACING_FACTOR,
+        fallback=fixed
+    )
+
+
+def _load_cad_mesh(step_path):
+    """Returns the tessellated STEP file (see reference.load_mesh), from the cache after the first time"""
     try:
-        # Import the STEP file
-        result = cq.importers.importStep(step_path)
-        
-        # Generate mesh with specified tolerance
-        # The tolerance controls mesh density
-        mesh_data = result.val().tessellate(tolerance)
-        vertices, faces = mesh_data[0], mesh_data[1]
-        
-        # Write PLY file
-        with open(ply_output_path, 'w') as f:
-            # Write header
-            f.write("ply\n")
-            f.write("format ascii 1.0\n")
-            f.write(f"element vertex {len(vertices)}\n")
-            f.write("property float x\n")
-            f.write("property float y\n")
-            f.write("property float z\n")
-            f.write(f"element face {len(faces)}\n")
-            f.write("property list uchar int vertex_indices\n")
-            f.write("end_header\n")
-            
-            # Write vertices
-            for vertex in vertices:
-                f.write(f"{vertex[0]} {vertex[1]} {vertex[2]}\n")
-            
-            # Write faces
-            for face in faces:
-                f.write(f"3 {face[0]} {face[1]} {face[2]}\n")
-
-        app.logger.info(f"STEP successfully converted to PLY with {len(vertices)} vertices and {len(faces)} faces")
+        mesh = reference.load_mesh(step_path, config.TOLERANCE, config.CACHE_DIR)
+    except Exception as e:
+        raise Exception(f"Error converting STEP to PLY: {e}")
+
+    _, arrays, from_cache = mesh
+    source = "loaded from cache" if from_cache else "tessellated"
+    app.logger.info(f"STEP {source} with {len(arrays['vertices'])} vertices, {len(arrays['triangles'])} triangles "
+                    f"and {len(arrays['face_types'])} B-rep faces")
+    return mesh
 
+
+def _load_cad_reference(step_path, voxel_size, mesh=None):
+    """
+    Returns the tessellated STEP file with its normals and FPFH features.
+    The CAD-side work is done only the first time a STEP file is seen, then it comes from the cache.
+    """
+    try:
+        return reference.load_reference(
+            step_path,
+            config.TOLERANCE,
+            voxel_size,
+            config.CACHE_DIR,
+            downsample=config.REGISTRATION_MODE == "multiscale",
+            mesh=mesh,
+            sample_spacing=voxel_size * config.CAD_SAMPLE_SPACING_FACTOR or None
+        )
     except Exception as e:
-        raise Exception(f"Error converting STEP to PLY: {e}")
\ No newline at end of file
+        raise Exception(f"Error converting STEP to PLY: {e}")
@@ -0,0 +1,116 @@
+"""
+Benchmark of the fixed pipeline parameters against the auto-tuned ones (see pipeline/autotune.py)
+on a corpus of the same part at different sizes, scanned on a table.
+Each trial runs the registration path of the worker: plane removal and outlier filtering,
+global registration on the coarsest pyramid level, hypothesis selection and multiscale ICP.
+
+Usage:
+    python benchmarks/bench_autotune.py [part.step] [--scales 0.25 1 4] [--trials 3] [--points 200000]
+Without a STEP file the generated test part (200 x 120 mm) is used, scaled from millimeters to meters.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from common import cad, make_test_part, load_part_mesh, random_transformation, synthetic_scan_on_table, pose_error
+from pipeline import autotune, preprocess, reference, registration
+
+# Fixed parameters of the config, before the auto-tuning, with the tessellation vertices as the target
+FIXED = {'voxel_size': 0.05, 'icp_threshold': 0.02, 'plane_distance_threshold': 0.02, 'sample_spacing_factor': None}
+# Spacing of the target sampled on the CAD surface with the auto-tuned parameters, in voxel sizes
+SAMPLE_SPACING_FACTOR = 0.25
+PYRAMID_FACTORS = [1.0, 0.5, 0.25]
+PYRAMID_ITERATIONS = [50, 30, 20]
+# A trial is a success when the final pose is this close to the ground truth
+SUCCESS_ROTATION_DEG = 1.0
+
+
+def build_target(vertices, triangles, voxel_size, sample_spacing=None):
+    """The CAD reference of the worker: target cloud with normals, and the downsampled feature cloud"""
+    if sample_spacing is not None:
+        vertices = reference.sample_surface(vertices, triangles, sample_spacing)
+    target = cad.to_point_cloud(vertices)
+    target.estimate_normals(registration.o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30))
+    features = target.voxel_down_sample(voxel_size)
+    return target, features, registration.compute_features(features, voxel_size)
+
+
+def align(scan, vertices, triangles, parameters):
+    """Returns the estimated transformation of the scan onto the part"""
+    voxel_size = parameters['voxel_size']
+    factor = parameters['sample_spacing_factor']
+    target, target_features, target_fpfh = build_target(
+        vertices, triangles, voxel_size, voxel_size * factor if factor else None)
+    cleaned = preprocess.segment_and_clean(scan, parameters['plane_distance_threshold'], 20, 2.0)
+    source_features = cleaned.voxel_down_sample(voxel_size)
+    hypotheses = registration.generate_hypotheses(
+        source_features, target_features, voxel_size, target_fpfh=target_fpfh, count=4)
+    initial = registration.select_best_hypothesis(
+        source_features, target_features, hypotheses, max(parameters['icp_threshold'], voxel_size * 1.5))
+    return registration.refine_multiscale_icp(
+        cleaned, target, initial, [voxel_size * factor for factor in PYRAMID_FACTORS], PYRAMID_ITERATIONS,
+        parameters['icp_threshold'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", nargs="?", help="STEP file of the part")
+    parser.add_argument("--scales", type=float, nargs="+", default=[0.25, 1.0, 4.0])
+    parser.add_argument("--trials", type=int, default=3)
+    parser.add_argument("--points", type=int, default=200000)
+    parser.add_argument("--noise", type=float, default=0.0003, help="scan noise at scale 1, in meters")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        step_path = args.step
+        if not step_path:
+            step_path = os.path.join(temp_dir, "part.step")
+            make_test_part(step_path)
+        meshes = {scale: load_part_mesh(step_path, scale=0.001 * scale) for scale in args.scales}
+
+    rows = []
+    for scale, mesh in meshes.items():
+        vertices = np.asarray(mesh.vertices)
+        triangles = np.asarray(mesh.triangles)
+        for trial in range(args.trials):
+            ground_truth = random_transformation(rng, max_translation=0.1 * scale)
+            scan = synthetic_scan_on_table(mesh, args.points, ground_truth, rng, args.noise * scale, 0.01)
+            expected = np.linalg.inv(ground_truth)
+
+            start = time.perf_counter()
+            tuned = autotune.derive_parameters(
+                autotune.estimate_spacing(np.asarray(scan.points)), autotune.bounding_box_diagonal(vertices))
+            tuned['sample_spacing_factor'] = SAMPLE_SPACING_FACTOR
+            tuning_time = time.perf_counter() - start
+
+            for name, parameters in (("fixed", FIXED), ("auto", tuned)):
+                start = time.perf_counter()
+                try:
+                    estimated = align(scan, vertices, triangles, parameters)
+                    rotation_error, translation_error = pose_error(estimated, expected)
+                except RuntimeError as e:
+                    # e.g. no features at all with a voxel larger than the part
+                    print(f"  {name} failed: {e}")
+                    rotation_error, translation_error = 180.0, np.inf
+                elapsed = time.perf_counter() - start + (tuning_time if name == "auto" else 0.0)
+                rows.append((scale, name, elapsed, rotation_error, translation_error / scale))
+                print(f"scale {scale:>5} trial {trial} {name:>5}: voxel {parameters['voxel_size'] * 1000:7.2f} mm  "
+                      f"{elapsed:7.2f}s  rot {rotation_error:8.3f} deg  trans {translation_error * 1000:9.3f} mm")
+
+    print()
+    print(f"{'scale':>6} {'params':>6} {'median time':>12} {'median rot':>11} {'median trans/scale':>19} {'success':>8}")
+    for scale in args.scales:
+        for name in ("fixed", "auto"):
+            selected = np.array([row[2:] for row in rows if row[0] == scale and row[1] == name])
+            success = np.mean(selected[:, 1] < SUCCESS_ROTATION_DEG) * 100
+            print(f"{scale:>6} {name:>6} {np.median(selected[:, 0]):>11.2f}s {np.median(selected[:, 1]):>7.3f} deg "
+                  f"{np.median(selected[:, 2]) * 1000:>16.3f} mm {success:>7.0f}%")
+
+
+if __name__ == "__main__":
+    main()
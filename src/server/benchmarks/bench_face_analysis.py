@@ -0,0 +1,71 @@
+"""
+Benchmark of the analysis of a registered scan with per-face statistics (analysis.FaceStats), on parts with
+more and more B-rep faces. Reports, for a scan already aligned to the part:
+    - the build of the raycasting scene (BVH), done once per part and process (CadReference.raycasting_scene),
+      which the analysis of every scan paid before
+    - the analysis with the scene of the previous scan, without and with the per-face statistics
+
+Usage:
+    python benchmarks/bench_face_analysis.py [--holes 12x7 28x18] [--points 1000000] [--tolerance 0.1]
+The generated test part is used, with the given grids of holes (two faces per hole).
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from common import make_test_part, synthetic_scan
+from pipeline import analysis, reference
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--holes", nargs="+", default=["12x7", "28x18"])
+    parser.add_argument("--points", type=int, nargs="+", default=[200000, 1000000])
+    parser.add_argument("--tolerance", type=float, default=0.1, help="STEP tessellation tolerance")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'faces':>6} {'triangles':>10} {'points':>9} {'scene build':>12} {'analysis':>9} {'+ per face':>11} "
+          f"{'faces hit':>10}")
+    for holes in args.holes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            step_path = os.path.join(temp_dir, "part.step")
+            make_test_part(step_path, tuple(int(value) for value in holes.split("x")))
+            _, arrays, _ = reference.load_mesh(step_path, args.tolerance, temp_dir)
+            cad_reference = reference.CadReference(
+                "bench", arrays['vertices'], arrays['triangles'], arrays['vertices'], None, None, None, None,
+                mesh_key=holes, face_ids=arrays['face_ids'], face_types=arrays['face_types'])
+
+        mesh = cad_reference.triangle_mesh()
+        for n_points in args.points:
+            _run(cad_reference, mesh, synthetic_scan(mesh, n_points, np.eye(4), rng, noise=0.03))
+
+
+def _run(cad_reference, mesh, scan):
+    start = time.perf_counter()
+    scene = cad_reference.raycasting_scene()
+    # Embree builds the BVH on the first query
+    analysis.compute_mesh_distances(np.asarray(scan.points)[:1], mesh, scene)
+    build = time.perf_counter() - start
+
+    timings = []
+    for face_ids in (None, cad_reference.face_ids):
+        start = time.perf_counter()
+        _, metrics = analysis.calculate_metrics(scan, None, np.eye(4), 0.05, target_mesh=mesh,
+                                                scene=cad_reference.raycasting_scene(), face_ids=face_ids,
+                                                face_types=cad_reference.face_types)
+        timings.append(time.perf_counter() - start)
+    assert cad_reference.raycasting_scene() is scene
+    # Measure the build again with the next scan
+    reference._scenes.clear()
+
+    print(f"{len(cad_reference.face_types):>6} {len(cad_reference.triangles):>10} {len(scan.points):>9} "
+          f"{build:>11.2f}s {timings[0]:>8.2f}s {timings[1]:>10.2f}s {len(metrics['faces']['face']):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark of the global registration backends on synthetic scans of a CAD part.
+Each trial moves a noisy sampled copy of the part by a random rigid transformation,
+runs every backend on the same features and reports wall time and pose error.
+
+Usage:
+    python benchmarks/bench_global_registration.py [part.step] [--trials 10] [--points 200000] [--voxel 0.005]
+Without a STEP file the generated test part is used. The part is scaled from millimeters to meters.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from common import make_test_part, load_part_mesh, random_transformation, synthetic_scan, pose_error
+from pipeline import registration
+
+# A trial is a success when the estimate is close enough for ICP to converge
+SUCCESS_ROTATION_DEG = 5.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", nargs="?", help="STEP file of the part")
+    parser.add_argument("--trials", type=int, default=10)
+    parser.add_argument("--points", type=int, default=200000)
+    parser.add_argument("--voxel", type=float, default=0.005)
+    parser.add_argument("--noise", type=float, default=0.0003)
+    parser.add_argument("--outliers", type=float, default=0.02, help="ratio of uniform outliers added to the scan")
+    parser.add_argument("--backends", nargs="+", default=list(registration.GLOBAL_BACKENDS))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        step_path = args.step
+        if not step_path:
+            step_path = os.path.join(temp_dir, "part.step")
+            make_test_part(step_path)
+        mesh = load_part_mesh(step_path)
+
+    target = mesh.sample_points_uniformly(args.points).voxel_down_sample(args.voxel)
+    target_fpfh = registration.compute_features(target, args.voxel)
+
+    results = {backend: [] for backend in args.backends}
+    for trial in range(args.trials):
+        ground_truth = random_transformation(rng)
+        scan = synthetic_scan(mesh, args.points, ground_truth, rng, args.noise, args.outliers)
+        source = scan.voxel_down_sample(args.voxel)
+        # The scan is moved onto the part, so the expected result is the inverse of the perturbation
+        expected = np.linalg.inv(ground_truth)
+
+        for backend in args.backends:
+            start = time.perf_counter()
+            try:
+                estimated = registration.run_global_registration(
+                    source, target, args.voxel, target_fpfh=target_fpfh, backend=backend)
+            except registration.RegistrationError:
+                # No alignment at all, counted as a failed trial
+                estimated = None
+            elapsed = time.perf_counter() - start
+            rotation_error, translation_error = (pose_error(estimated, expected) if estimated is not None
+                                                 else (np.inf, np.inf))
+            results[backend].append((elapsed, rotation_error, translation_error))
+            print(f"trial {trial:>3} {backend:>8}: {elapsed:7.3f}s  rot {rotation_error:8.3f} deg  "
+                  f"trans {translation_error * 1000:8.2f} mm")
+
+    print()
+    print(f"{'backend':>8} {'median time':>12} {'median rot':>11} {'median trans':>13} {'success':>8}")
+    for backend, rows in results.items():
+        rows = np.array(rows)
+        success = np.mean(rows[:, 1] < SUCCESS_ROTATION_DEG) * 100
+        print(f"{backend:>8} {np.median(rows[:, 0]):>11.3f}s {np.median(rows[:, 1]):>7.3f} deg "
+              f"{np.median(rows[:, 2]) * 1000:>10.2f} mm {success:>7.0f}%")
+
+
+if __name__ == "__main__":
+    main()
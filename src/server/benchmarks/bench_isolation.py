@@ -0,0 +1,106 @@
+"""
+Benchmark of the object isolation of the worker (preprocess.remove_planes and preprocess.largest_cluster)
+on a synthetic scene: the part on a table, in front of a wall, next to a smaller box, with uniform outliers.
+Compares the clustering backends:
+    - dbscan  Open3D DBSCAN
+    - voxel   connected components of a voxel grid (pipeline/voxels.py)
+and the single plane removal of the previous pipeline, by the share of the kept points that belong to the part
+(precision) and the share of the part points that are kept (recall).
+
+Usage:
+    python benchmarks/bench_isolation.py [part.step] [--points 200000 1000000] [--outliers 0.01]
+Without a STEP file the generated test part (200 x 120 mm) is used.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import open3d as o3d
+
+from common import make_test_part, load_part_mesh, synthetic_scan
+from pipeline import autotune, preprocess
+
+PLANE_SPACING_FACTOR = 3.0
+OUTLIER_SPACING_FACTOR = 3.0
+CLUSTER_SPACING_FACTOR = 5.0
+MAX_PLANES = 3
+MIN_PLANE_RATIO = 0.05
+MIN_POINTS = 10
+
+
+def make_scene(mesh, n_points, rng, noise, outlier_ratio):
+    """Returns the scene points and a mask of the part points"""
+    low, high = mesh.get_min_bound(), mesh.get_max_bound()
+    size = high - low
+    part = np.asarray(synthetic_scan(mesh, n_points, np.eye(4), rng, noise).points)
+
+    def rectangle(count, origin, u, v):
+        a, b = rng.uniform(0, 1, (2, count, 1))
+        normal = np.cross(u, v) / np.linalg.norm(np.cross(u, v))
+        return origin + a * u + b * v + rng.normal(0, noise, (count, 1)) * normal
+
+    table = rectangle(n_points, low - [size[0], size[1], 0], np.array([3 * size[0], 0, 0]), np.array([0, 3 * size[1], 0]))
+    wall = rectangle(n_points // 2, [low[0] - size[0], high[1] + size[1], low[2]], np.array([3 * size[0], 0, 0]),
+                     np.array([0, 0, size[0]]))
+    box = o3d.geometry.TriangleMesh.create_box(*(size * [0.3, 0.3, 2]))
+    box.translate([high[0] + 0.3 * size[0], low[1], low[2]])
+    clutter = np.asarray(box.sample_points_uniformly(n_points // 4).points)
+
+    scene = np.vstack([part, table, wall, clutter])
+    scene_low, scene_high = scene.min(axis=0), scene.max(axis=0)
+    outliers = rng.uniform(scene_low, scene_high, (int(len(scene) * outlier_ratio), 3))
+    is_part = np.zeros(len(scene) + len(outliers), dtype=bool)
+    is_part[:len(part)] = True
+    return np.vstack([scene, outliers]), is_part
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", nargs="?", help="STEP file of the part")
+    parser.add_argument("--points", type=int, nargs="+", default=[200000, 1000000])
+    parser.add_argument("--noise", type=float, default=0.0003)
+    parser.add_argument("--outliers", type=float, default=0.01, help="uniform outliers, as a fraction of the points")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        step_path = args.step
+        if not step_path:
+            step_path = os.path.join(temp_dir, "part.step")
+            make_test_part(step_path)
+        mesh = load_part_mesh(step_path)
+    diagonal = autotune.bounding_box_diagonal(np.asarray(mesh.vertices))
+
+    print(f"{'part pts':>9} {'scene pts':>10} {'isolation':>16} {'planes':>7} {'cluster time':>13} "
+          f"{'total time':>11} {'kept':>8} {'precision':>10} {'recall':>7}")
+    for n_points in args.points:
+        points, is_part = make_scene(mesh, n_points, rng, args.noise, args.outliers)
+        # Point indices travel as a fourth coordinate-free attribute: the colors
+        scene = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+        scene.colors = o3d.utility.Vector3dVector(np.column_stack([np.arange(len(points)), np.zeros((len(points), 2))]))
+        spacing = autotune.estimate_spacing(points)
+
+        for name, max_planes, method in (("single plane", 1, None), ("planes + dbscan", MAX_PLANES, "dbscan"),
+                                         ("planes + voxel", MAX_PLANES, "voxel")):
+            start = time.perf_counter()
+            segmented, planes = preprocess.remove_planes(
+                scene, spacing * PLANE_SPACING_FACTOR, max_planes, MIN_PLANE_RATIO, diagonal)
+            cleaned = preprocess.remove_outliers(
+                segmented, "radius_voxel", voxel_size=spacing * OUTLIER_SPACING_FACTOR, min_points=8)
+            cluster_start = time.perf_counter()
+            if method:
+                cleaned = preprocess.largest_cluster(cleaned, method, spacing * CLUSTER_SPACING_FACTOR, MIN_POINTS)
+            end = time.perf_counter()
+
+            kept = np.asarray(cleaned.colors)[:, 0].round().astype(np.int64)
+            precision = is_part[kept].mean() * 100 if len(kept) else 0.0
+            recall = len(kept[is_part[kept]]) / is_part.sum() * 100
+            print(f"{n_points:>9} {len(points):>10} {name:>16} {planes:>7} {end - cluster_start:>12.2f}s "
+                  f"{end - start:>10.2f}s {len(kept):>8} {precision:>9.1f}% {recall:>6.1f}%")
+
+
+if __name__ == "__main__":
+    main()
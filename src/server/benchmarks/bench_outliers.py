@@ -0,0 +1,77 @@
+"""
+Benchmark of the outlier filters of preprocess.segment_and_clean on scans of growing density:
+    - statistical        Open3D's statistical outlier removal, k-NN on every point
+    - voxel_statistical  the same statistics on the voxel centroids, points classified by their voxel
+    - radius_voxel       count of the points in the 3 x 3 x 3 voxels around each point
+The scans are sampled on the part with noise plus uniform outliers in its bounding box, so the removed points
+can be split between outliers (wanted) and surface points (lost). The voxel size is a multiple of the scan
+spacing (see autotune.estimate_spacing), like in the worker.
+
+Usage:
+    python benchmarks/bench_outliers.py [part.step] [--points 200000 1000000 4000000] [--outliers 0.01]
+Without a STEP file the generated test part (200 x 120 mm) is used.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from common import make_test_part, load_part_mesh, synthetic_scan
+from pipeline import autotune, preprocess
+
+NB_NEIGHBORS = 20
+STD_RATIO = 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", nargs="?", help="STEP file of the part")
+    parser.add_argument("--points", type=int, nargs="+", default=[200000, 1000000, 4000000])
+    parser.add_argument("--outliers", type=float, default=0.01, help="uniform outliers, as a fraction of the points")
+    parser.add_argument("--voxel-factor", type=float, default=3.0, help="voxel size, in scan spacings")
+    parser.add_argument("--min-points", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        step_path = args.step
+        if not step_path:
+            step_path = os.path.join(temp_dir, "part.step")
+            make_test_part(step_path)
+        mesh = load_part_mesh(step_path)
+
+    print(f"{'points':>9} {'filter':>18} {'time':>8} {'speedup':>8} {'removed':>8} {'outliers':>9} {'surface':>8}")
+    for n_points in args.points:
+        scan = synthetic_scan(mesh, n_points, np.eye(4), rng, outlier_ratio=args.outliers)
+        points = np.asarray(scan.points)
+        is_outlier = np.arange(len(points)) >= n_points
+        voxel_size = autotune.estimate_spacing(points) * args.voxel_factor
+
+        filters = {
+            "statistical": lambda: _statistical_inliers(scan),
+            "voxel_statistical": lambda: preprocess.voxel_statistical_inliers(points, voxel_size, NB_NEIGHBORS, STD_RATIO),
+            "radius_voxel": lambda: preprocess.radius_voxel_inliers(points, voxel_size, args.min_points),
+        }
+        baseline = None
+        for name, run in filters.items():
+            start = time.perf_counter()
+            kept = run()
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            removed = ~kept
+            print(f"{n_points:>9} {name:>18} {elapsed:>7.2f}s {baseline / elapsed:>7.1f}x {removed.sum():>8} "
+                  f"{removed[is_outlier].mean() * 100:>8.1f}% {removed[~is_outlier].mean() * 100:>7.2f}%")
+
+
+def _statistical_inliers(scan):
+    _, indices = scan.remove_statistical_outlier(nb_neighbors=NB_NEIGHBORS, std_ratio=STD_RATIO)
+    kept = np.zeros(len(scan.points), dtype=bool)
+    kept[indices] = True
+    return kept
+
+
+if __name__ == "__main__":
+    main()
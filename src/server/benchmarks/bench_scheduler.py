@@ -0,0 +1,102 @@
+"""
+Benchmark of the scheduling of the scan queue (scheduler.FairScheduler) against the previous FIFO queue,
+on a simulated workload: one user uploads a batch of big scans, the other users a few small scans each
+while the batch is being processed. The processing time of a scan is proportional to its points.
+Reports the turnaround (arrival to end of processing) of the scans of each kind of user.
+
+Usage:
+    python benchmarks/bench_scheduler.py [--workers 4] [--batch 40] [--users 6]
+"""
+import argparse
+import heapq
+import os
+import sys
+from collections import deque
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from scheduler import FairScheduler
+
+SECONDS_PER_POINT = 5e-6
+
+
+class FifoQueue:
+    """The previous queue: first in, first out"""
+
+    def __init__(self):
+        self.items = deque()
+
+    def put(self, key, item, user, priority=0, cost=None):
+        self.items.append(item)
+
+    def get(self):
+        return self.items.popleft()
+
+    def qsize(self):
+        return len(self.items)
+
+    def observe(self, key, seconds):
+        pass
+
+    def done(self, key):
+        pass
+
+
+def make_workload(rng, batch, users, window):
+    """Returns the scans (arrival, user, key, points), in arrival order"""
+    scans = [(rng.uniform(0, 10), "batch", f"batch-{i}", int(rng.uniform(1e6, 3e6))) for i in range(batch)]
+    for user in range(users):
+        for i in range(3):
+            scans.append((rng.uniform(0, window), f"user-{user}", f"user-{user}-{i}", int(rng.uniform(1e5, 1e6))))
+    return sorted(scans)
+
+
+def simulate(queue, scans, workers, clock):
+    """Runs the scans through the queue and the workers, returns key -> turnaround (seconds)"""
+    arrivals = deque(scans)
+    details = {key: (arrival, points) for arrival, _, key, points in scans}
+    # (end time, key) of the scans being processed
+    running = []
+    turnaround = {}
+    while arrivals or queue.qsize() or running:
+        if running and (not arrivals or running[0][0] <= arrivals[0][0]) and (len(running) == workers or not queue.qsize()):
+            clock[0], key = heapq.heappop(running)
+            queue.observe(key, details[key][1] * SECONDS_PER_POINT)
+            queue.done(key)
+            turnaround[key] = clock[0] - details[key][0]
+        elif len(running) < workers and queue.qsize():
+            key = queue.get()
+            heapq.heappush(running, (clock[0] + details[key][1] * SECONDS_PER_POINT, key))
+        else:
+            arrival, user, key, points = arrivals.popleft()
+            clock[0] = arrival
+            queue.put(key, key, user, cost=points)
+    return turnaround
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=40, help="big scans uploaded at once by one user")
+    parser.add_argument("--users", type=int, default=6, help="other users, with 3 small scans each")
+    parser.add_argument("--window", type=float, default=120.0, help="seconds over which the small scans arrive")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    scans = make_workload(np.random.default_rng(args.seed), args.batch, args.users, args.window)
+    print(f"{len(scans)} scans, {sum(scan[3] for scan in scans) / 1e6:.0f}M points, {args.workers} workers")
+    print(f"{'queue':>6} {'user':>6} {'scans':>6} {'mean turnaround':>16} {'p95':>8} {'max':>8} {'last end':>9}")
+    for name in ("fifo", "fair"):
+        clock = [0.0]
+        queue = FifoQueue() if name == "fifo" else FairScheduler(seconds_per_point=SECONDS_PER_POINT,
+                                                                 timer=lambda: clock[0])
+        turnaround = simulate(queue, scans, args.workers, clock)
+        for kind in ("batch", "user"):
+            times = np.array([seconds for key, seconds in turnaround.items() if key.startswith(kind)])
+            print(f"{name:>6} {kind:>6} {len(times):>6} {times.mean():>15.1f}s {np.percentile(times, 95):>7.1f}s "
+                  f"{times.max():>7.1f}s {clock[0]:>8.1f}s")
+
+
+if __name__ == "__main__":
+    main()
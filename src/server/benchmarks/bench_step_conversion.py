@@ -0,0 +1,80 @@
+"""
+Benchmark of the STEP tessellation output paths:
+    - legacy ASCII PLY written element by element, then parsed by Open3D
+    - binary little-endian PLY written from NumPy arrays, then parsed by Open3D
+    - arrays handed to Open3D in memory, no file at all
+
+Usage:
+    python benchmarks/bench_step_conversion.py [part.step] [--tolerance 0.01 0.005 ...]
+Without a STEP file a filleted plate with many holes is generated with CadQuery.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import open3d as o3d
+
+from common import cad, make_test_part
+
+
+def write_ascii_ply(ply_path, vertices, triangles):
+    """Legacy writer, kept here only as a reference for the benchmark"""
+    with open(ply_path, 'w') as f:
+        f.write("ply\n")
+        f.write("format ascii 1.0\n")
+        f.write(f"element vertex {len(vertices)}\n")
+        f.write("property float x\n")
+        f.write("property float y\n")
+        f.write("property float z\n")
+        f.write(f"element face {len(triangles)}\n")
+        f.write("property list uchar int vertex_indices\n")
+        f.write("end_header\n")
+        for vertex in vertices:
+            f.write(f"{vertex[0]} {vertex[1]} {vertex[2]}\n")
+        for face in triangles:
+            f.write(f"3 {face[0]} {face[1]} {face[2]}\n")
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", nargs="?", help="STEP file to tessellate")
+    parser.add_argument("--tolerance", type=float, nargs="+", default=[0.1, 0.05, 0.01])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        step_path = args.step
+        if not step_path:
+            step_path = os.path.join(temp_dir, "part.step")
+            make_test_part(step_path)
+
+        print(f"{'tolerance':>10} {'vertices':>10} {'faces':>10} {'tessellate':>11} "
+              f"{'ascii':>9} {'binary':>9} {'memory':>9} {'speedup':>8}")
+        for tolerance in args.tolerance:
+            (vertices, triangles), t_tess = timed(lambda: cad.tessellate_step(step_path, tolerance))
+
+            ascii_path = os.path.join(temp_dir, "ascii.ply")
+            binary_path = os.path.join(temp_dir, "binary.ply")
+
+            _, t_ascii = timed(lambda: (
+                write_ascii_ply(ascii_path, vertices, triangles),
+                o3d.io.read_point_cloud(ascii_path)
+            ))
+            _, t_binary = timed(lambda: (
+                cad.write_ply(binary_path, vertices, triangles),
+                o3d.io.read_point_cloud(binary_path)
+            ))
+            _, t_memory = timed(lambda: cad.to_point_cloud(vertices))
+
+            print(f"{tolerance:>10g} {len(vertices):>10} {len(triangles):>10} {t_tess:>10.3f}s "
+                  f"{t_ascii:>8.3f}s {t_binary:>8.3f}s {t_memory:>8.3f}s {t_ascii / max(t_binary, 1e-9):>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Helpers shared by the benchmarks: test parts, synthetic scans and pose errors.
+The pipeline package is imported without the Flask app, so no Firebase setup is needed.
+"""
+import os
+import sys
+
+import cadquery as cq
+import numpy as np
+import open3d as o3d
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from pipeline import cad
+
+
+def make_test_part(step_path, holes=(12, 7)):
+    """
+    Exports a part with many curved faces, so fine tolerances produce large meshes.
+    The boss and the notch break the symmetries of the plate, so the registration has a unique solution.
+    Each of the (columns, rows) filleted holes adds two B-rep faces (193 faces with the default 12 x 7).
+    """
+    columns, rows = holes
+    pitch = min(180 / columns, 105 / rows)
+    part = (
+        cq.Workplane("XY").box(200, 120, 20)
+        .edges("|Z").fillet(10)
+        .faces(">Z").workplane()
+        .rarray(pitch, pitch, columns, rows).hole(pitch * 8 / 15)
+        .edges(">Z").fillet(pitch / 15)
+    )
+    boss = cq.Workplane("XY").workplane(offset=10).center(-70, 35).circle(18).extrude(40)
+    notch = cq.Workplane("XY").center(95, -55).box(40, 30, 30)
+    cq.exporters.export(part.union(boss).cut(notch), step_path)
+
+
+def load_part_mesh(step_path, tolerance=0.1, scale=0.001):
+    """Tessellates a STEP file and scales it (by default from millimeters to meters)"""
+    vertices, triangles = cad.tessellate_step(step_path, tolerance)
+    return cad.to_triangle_mesh(vertices * scale, triangles)
+
+
+def random_transformation(rng, max_translation=0.1):
+    """Returns a random rigid transformation (uniform rotation, bounded translation)"""
+    q = rng.normal(size=4)
+    q /= np.linalg.norm(q)
+    transformation = np.eye(4)
+    transformation[:3, :3] = o3d.geometry.get_rotation_matrix_from_quaternion(q)
+    transformation[:3, 3] = rng.uniform(-max_translation, max_translation, 3)
+    return transformation
+
+
+def synthetic_scan(mesh, n_points, transformation, rng, noise=0.0003, outlier_ratio=0.0):
+    """Samples a noisy scan of the mesh, moved by the transformation, with optional uniform outliers"""
+    scan = mesh.sample_points_uniformly(n_points)
+    points = np.asarray(scan.points) + rng.normal(0, noise, (n_points, 3))
+    n_outliers = int(n_points * outlier_ratio)
+    if n_outliers:
+        low, high = points.min(axis=0), points.max(axis=0)
+        points = np.vstack([points, rng.uniform(low, high, (n_outliers, 3))])
+    scan.points = o3d.utility.Vector3dVector(points)
+    return scan.transform(transformation)
+
+
+def pose_error(estimated, ground_truth):
+    """Returns the rotation error in degrees and the translation error between two transformations"""
+    delta = estimated @ np.linalg.inv(ground_truth)
+    cos_angle = np.clip((np.trace(delta[:3, :3]) - 1) / 2, -1.0, 1.0)
+    return np.degrees(np.arccos(cos_angle)), np.linalg.norm(delta[:3, 3])
+
+
+def synthetic_scan_on_table(mesh, n_points, transformation, rng, noise=0.0003, outlier_ratio=0.0, table_ratio=1.0):
+    """
+    Like synthetic_scan, plus a table: a rectangle twice as large as the part under its lowest face,
+    with table_ratio * n_points points. The table is moved with the part.
+    """
+    scan = synthetic_scan(mesh, n_points, np.eye(4), rng, noise, outlier_ratio)
+    low, high = mesh.get_min_bound(), mesh.get_max_bound()
+    center, size = (low + high) / 2, high - low
+    n_table = int(n_points * table_ratio)
+    table = np.column_stack([
+        rng.uniform(center[0] - size[0], center[0] + size[0], n_table),
+        rng.uniform(center[1] - size[1], center[1] + size[1], n_table),
+        low[2] + rng.normal(0, noise, n_table),
+    ])
+    scan.points = o3d.utility.Vector3dVector(np.vstack([np.asarray(scan.points), table]))
+    return scan.transform(transformation)
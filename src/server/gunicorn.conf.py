@@ -0,0 +1,16 @@
+import os
+import sys
+
+# Loaded by gunicorn from the working directory (see the Dockerfile)
+
+# On SIGTERM the worker finishes the scans in flight before exiting (see worker_exit), the arbiter kills it
+# after this many seconds. The stop_grace_period of the docker-compose files must be longer
+graceful_timeout = int(os.getenv("PIPELINE_SHUTDOWN_TIMEOUT", "600"))
+
+
+def worker_exit(server, worker):
+    """Runs in the worker process once it stopped serving requests: drains the pipeline of the scans in flight"""
+    # Not imported here: a worker that failed to boot has no pipeline to stop
+    queue_manager = sys.modules.get("app.queue_manager")
+    if queue_manager is not None:
+        queue_manager.queue_manager.shutdown()
@@ -0,0 +1,26 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# The tested modules are imported without the 'app' package, whose import starts the Flask app,
+# initializes Firebase and resumes the scan queue.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+
+@pytest.fixture
+def heatmap():
+    """Points of a small part with their deviations (float32, like the heatmap files)"""
+    rng = np.random.default_rng(0)
+    points = rng.uniform([-0.1, -0.06, 0.0], [0.1, 0.06, 0.03], (50000, 3)).astype(np.float32)
+    deviations = rng.normal(0, 0.0005, len(points)).astype(np.float32)
+    return points, deviations
+
+
+@pytest.fixture
+def box_step(request, tmp_path):
+    """STEP file of a box centered on the origin, 20 mm wide unless parametrized with its (x, y, z) sizes"""
+    cq = pytest.importorskip("cadquery")
+    path = str(tmp_path / "box.step")
+    cq.exporters.export(cq.Workplane("XY").box(*getattr(request, "param", (20, 20, 20))), path)
+    return path
@@ -0,0 +1,172 @@
+import numpy as np
+import open3d as o3d
+import pytest
+from pipeline import analysis
+
+
+def test_lut_matches_the_jet_formula():
+    values = np.random.default_rng(0).uniform(-0.2, 1.2, 10000)
+    colors = np.empty((len(values), 3), dtype=np.uint8)
+    analysis.apply_jet_colormap(values, colors)
+
+    clipped = np.clip(values, 0.0, 1.0)[:, None]
+    expected = np.clip(1.5 - np.abs(4.0 * clipped - np.array([3.0, 2.0, 1.0])), 0.0, 1.0) * 255
+    # One LUT level is 1/255 of the range, a jet channel changes by at most 4 levels per level
+    assert np.abs(colors.astype(int) - expected).max() <= 4
+    assert list(colors[np.argmin(values)]) == [0, 0, 128]
+    assert list(colors[np.argmax(values)]) == [128, 0, 0]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096, 50000])
+def test_streaming_stats_match_numpy(chunk_size):
+    rng = np.random.default_rng(chunk_size)
+    deviations = np.abs(rng.normal(0, 0.002, 50000))
+    # Shifted so the mean is much larger than the spread, where a naive sum of squares loses digits
+    values = 1000.0 + deviations
+    tolerance = 1000.001
+
+    stats = analysis.StreamingStats(tolerance)
+    histogram = analysis.DeviationHistogram(0.01, bins=20, signed=False)
+    for start in range(0, len(values), chunk_size):
+        stats.update(values[start:start + chunk_size])
+        histogram.update(deviations[start:start + chunk_size])
+    metrics = stats.metrics()
+
+    assert metrics['avg_deviation'] == pytest.approx(np.mean(values), rel=1e-12)
+    assert metrics['std_deviation'] == pytest.approx(np.std(values), rel=1e-6)
+    assert metrics['accuracy_rmse'] == pytest.approx(np.sqrt(np.mean(values ** 2)), rel=1e-12)
+    assert metrics['min_deviation'] == values.min() and metrics['max_deviation'] == values.max()
+    assert metrics['percentage_of_points_within_tolerance'] == pytest.approx(np.mean(values <= tolerance) * 100)
+
+    # The percentiles are interpolated within the fine bins of the histogram
+    step = 0.01 / histogram.fine_bins
+    qs = [1, 25, 50, 90, 99]
+    np.testing.assert_allclose(histogram.percentiles(qs), np.percentile(deviations, qs), atol=step)
+
+
+def test_streaming_stats_of_no_points():
+    stats = analysis.StreamingStats(0.001)
+    stats.update(np.array([]))
+    assert stats.metrics()['avg_deviation'] == 0.0 and stats.metrics()['percentage_of_points_within_tolerance'] == 0
+
+
+@pytest.mark.parametrize("signed", [True, False])
+def test_histogram_percentiles(signed):
+    rng = np.random.default_rng(0)
+    values = rng.normal(0, 0.002, 200000)
+    if not signed:
+        values = np.abs(values)
+    # A few far outliers, outside the range of the histogram
+    values[:100] = 0.5
+
+    histogram = analysis.DeviationHistogram(0.01, bins=20, signed=signed)
+    for chunk in np.array_split(values, 7):
+        histogram.update(chunk)
+
+    exported = histogram.histogram()
+    assert len(exported['counts']) == 20
+    assert sum(exported['counts']) + exported['below'] + exported['above'] == len(values)
+    assert exported['above'] >= 100
+
+    qs = [1, 25, 50, 75, 99]
+    assert histogram.percentiles(qs) == pytest.approx(np.percentile(values, qs), abs=2e-5)
+    assert histogram.percentiles(qs, absolute=True) == pytest.approx(np.percentile(np.abs(values), qs), abs=2e-5)
+    assert histogram.percentiles([100]) == pytest.approx([0.5])
+
+
+def test_colors_are_not_flattened_by_an_outlier():
+    rng = np.random.default_rng(0)
+    target = rng.uniform(0, 1, (20000, 3))
+    source = target + rng.normal(0, 0.001, target.shape)
+    source[0] += 10.0
+    source_pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(source))
+    target_pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(target))
+
+    heatmap, metrics = analysis.calculate_metrics(source_pcd, target_pcd, np.eye(4), 0.001, color_percentile=99)
+    assert metrics['max_deviation'] > 9
+    assert metrics['color_range'][1] < 0.01
+    assert metrics['percentiles']['p50'] == pytest.approx(np.median(heatmap.deviations), rel=0.05)
+    # The colors span the colormap instead of all being blue
+    assert heatmap.colors[:, 0].max() > 200
+
+    heatmap, metrics = analysis.calculate_metrics(source_pcd, target_pcd, np.eye(4), 0.001, color_percentile=100)
+    assert metrics['color_range'][1] == metrics['max_deviation']
+    assert np.count_nonzero(heatmap.colors[:, 0]) == 1
+
+
+def test_mesh_distances_are_signed_by_the_normals():
+    # Unit cube [0, 1]^3, with outward triangle normals
+    mesh = o3d.geometry.TriangleMesh.create_box()
+    points = np.array([
+        [0.5, 0.5, 1.25],   # above the top face: excess material
+        [0.5, 0.5, 0.9],    # just inside the top face: missing material
+        [0.5, 0.5, 0.5],    # center, 0.5 from every face
+        [-0.2, 0.3, 0.6],   # in front of the x = 0 face
+        [1.3, 0.5, 1.4],    # beyond the edge x = 1, z = 1: closest point on the edge
+        [0.5, 0.5, 0.0],    # on the bottom face
+    ])
+    distances, triangles = analysis.compute_mesh_distances(points, mesh, with_triangles=True)
+
+    np.testing.assert_allclose(distances, [0.25, -0.1, -0.5, 0.2, 0.5, 0.0], atol=1e-6)
+    normals = np.asarray(mesh.compute_triangle_normals().triangle_normals)[triangles]
+    np.testing.assert_allclose(normals[0], [0, 0, 1])
+    np.testing.assert_allclose(normals[3], [-1, 0, 0])
+    # The same scene can be queried chunk by chunk
+    scene = analysis.build_raycasting_scene(mesh)
+    np.testing.assert_allclose(np.concatenate([analysis.compute_mesh_distances(chunk, mesh, scene)
+                                               for chunk in np.array_split(points, 3)]), distances)
+
+
+def test_face_stats_match_a_group_by():
+    rng = np.random.default_rng(0)
+    faces = rng.integers(0, 10, 50000)
+    faces[faces == 3] = 4  # face 3 is never hit
+    deviations = rng.normal(0, 0.01, len(faces))
+
+    stats = analysis.FaceStats(10, 0.005)
+    for chunk in np.array_split(np.arange(len(faces)), 3):
+        stats.update(faces[chunk], deviations[chunk])
+    columns = stats.metrics(np.array([f"TYPE{face}" for face in range(10)]))
+
+    assert columns['face'] == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    for i, face in enumerate(columns['face']):
+        values = deviations[faces == face]
+        assert columns['points'][i] == len(values)
+        assert columns['type'][i] == f"TYPE{face}"
+        assert columns['avg_deviation'][i] == pytest.approx(np.mean(np.abs(values)))
+        assert columns['avg_signed_deviation'][i] == pytest.approx(np.mean(values))
+        assert columns['accuracy_rmse'][i] == pytest.approx(np.sqrt(np.mean(values ** 2)))
+        assert columns['min_deviation'][i] == values.min()
+        assert columns['max_deviation'][i] == values.max()
+        assert columns['percentage_of_points_within_tolerance'][i] == pytest.approx(np.mean(np.abs(values) <= 0.005) * 100)
+
+
+def test_points_are_attributed_to_the_faces_of_a_box(tmp_path):
+    import cadquery as cq
+    from pipeline import reference
+    step_path = str(tmp_path / "box.step")
+    cq.exporters.export(cq.Workplane("XY").box(2, 2, 2), step_path)
+    key, arrays, from_cache = reference.load_mesh(step_path, 0.1, str(tmp_path))
+    assert not from_cache and len(arrays['face_types']) == 6 and set(arrays['face_types']) == {"PLANE"}
+    assert reference.load_mesh(step_path, 0.1, str(tmp_path))[2]
+
+    cad_reference = reference.CadReference(key, arrays['vertices'], arrays['triangles'], arrays['vertices'], None,
+                                           None, None, None, mesh_key=key, face_ids=arrays['face_ids'],
+                                           face_types=arrays['face_types'])
+    mesh = cad_reference.triangle_mesh()
+    # 100 points 0.1 above the top face, 50 points 0.2 inside the bottom one
+    rng = np.random.default_rng(0)
+    top = np.column_stack([rng.uniform(-0.9, 0.9, (100, 2)), np.full(100, 1.1)])
+    bottom = np.column_stack([rng.uniform(-0.5, 0.5, (50, 2)), np.full(50, -0.8)])
+    scan = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.vstack([top, bottom])))
+
+    _, metrics = analysis.calculate_metrics(scan, None, np.eye(4), 0.15, target_mesh=mesh,
+                                            scene=cad_reference.raycasting_scene(), face_ids=cad_reference.face_ids)
+    faces = metrics['faces']
+    assert sorted(faces['points']) == [50, 100]
+    by_points = {points: i for i, points in enumerate(faces['points'])}
+    assert faces['avg_signed_deviation'][by_points[100]] == pytest.approx(0.1, abs=1e-5)
+    assert faces['avg_signed_deviation'][by_points[50]] == pytest.approx(-0.2, abs=1e-5)
+    assert faces['percentage_of_points_within_tolerance'][by_points[50]] == 0
+    # The scene is kept for the next scans of the part
+    assert cad_reference.raycasting_scene() is cad_reference.raycasting_scene()
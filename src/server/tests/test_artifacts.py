@@ -0,0 +1,151 @@
+import os
+import time
+import numpy as np
+import open3d as o3d
+from pipeline import artifacts, cache
+
+
+def keys(**changes):
+    settings = {'scan_hash': 'scan', 'reference_key': 'cad', 'preprocessing': {'plane': 0.002},
+                'registration': {'voxel_size': 0.01}, 'analysis': {'tolerance': 0.001}}
+    settings.update(changes)
+    return artifacts.artifact_keys(**settings)
+
+
+def test_keys_invalidate_the_later_steps_only():
+    base = keys()
+    assert keys() == base
+
+    tolerance = keys(analysis={'tolerance': 0.002})
+    assert tolerance['cleaned'] == base['cleaned']
+    assert tolerance['registration'] == base['registration']
+    assert tolerance['result'] != base['result']
+
+    cad = keys(reference_key='other')
+    assert cad['cleaned'] == base['cleaned']
+    assert cad['registration'] != base['registration'] and cad['result'] != base['result']
+
+    scan = keys(scan_hash='other')
+    assert all(scan[name] != base[name] for name in base)
+
+
+def test_cleaned_and_registration_round_trip(tmp_path):
+    cache_dir = str(tmp_path)
+    assert artifacts.load_cleaned(cache_dir, 'k' * 64) is None
+    assert artifacts.load_registration(cache_dir, 'k' * 64) is None
+
+    points = np.random.default_rng(0).random((100, 3))
+    artifacts.save_cleaned(cache_dir, 'k' * 64, o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points)))
+    # Stored in float32
+    np.testing.assert_array_equal(np.asarray(artifacts.load_cleaned(cache_dir, 'k' * 64).points),
+                                  points.astype(np.float32))
+
+    initial, final = np.eye(4), np.eye(4)
+    final[:3, 3] = [1, 2, 3]
+    artifacts.save_registration(cache_dir, 'k' * 64, initial, final)
+    loaded_initial, loaded_final = artifacts.load_registration(cache_dir, 'k' * 64)
+    np.testing.assert_array_equal(loaded_initial, initial)
+    np.testing.assert_array_equal(loaded_final, final)
+
+
+def test_result_files_are_restored_into_a_new_directory(tmp_path):
+    cache_dir, first, second = str(tmp_path / "cache"), tmp_path / "first", tmp_path / "second"
+    (first / "lod").mkdir(parents=True)
+    (first / "heatmap_scan.ply").write_bytes(b"ply")
+    (first / "lod" / "index.json").write_text("{}")
+    outputs = [["heatmap_scan.ply", ".ply"], ["lod/index.json", "/lod/index.json"]]
+
+    assert artifacts.load_result(cache_dir, 'r' * 64, str(second)) is None
+    artifacts.save_result(cache_dir, 'r' * 64, str(first), outputs, {'avg_deviation': np.float64(0.5)})
+    # A second worker finishing the same scan keeps the first entry
+    artifacts.save_result(cache_dir, 'r' * 64, str(first), outputs, {'avg_deviation': 0.5})
+
+    files, metrics = artifacts.load_result(cache_dir, 'r' * 64, str(second))
+    assert files == outputs
+    assert metrics == {'avg_deviation': 0.5}
+    assert (second / "heatmap_scan.ply").read_bytes() == b"ply"
+    assert (second / "lod" / "index.json").read_text() == "{}"
+    assert not [name for name in os.listdir(tmp_path / "cache" / "results" / "rr") if name.endswith('.tmp')]
+
+
+def test_manifest(tmp_path):
+    assert artifacts.read_manifest(str(tmp_path), 'scan-1') is None
+    artifacts.write_manifest(str(tmp_path), 'scan-1', {'keys': {'result': 'a'}})
+    artifacts.write_manifest(str(tmp_path), 'scan-1', {'keys': {'result': 'b'}})
+    assert artifacts.read_manifest(str(tmp_path), 'scan-1') == {'keys': {'result': 'b'}}
+
+
+def test_result_key_of_another_tolerance():
+    base = keys()
+    assert artifacts.result_key(base['registration'], {'tolerance': 0.001}) == base['result']
+    assert artifacts.result_key(base['registration'], {'tolerance': 0.002}) == keys(analysis={'tolerance': 0.002})['result']
+
+
+def test_reference_found_from_the_manifest_keys(tmp_path):
+    import cadquery as cq
+    from pipeline import reference
+    step_path = str(tmp_path / "box.step")
+    cq.exporters.export(cq.Workplane("XY").box(20, 20, 20), step_path)
+    cache_dir = str(tmp_path / "cache")
+    assert reference.load_cached_reference(cache_dir, 'm' * 64, 'r' * 64) is None
+
+    built = reference.load_reference(step_path, 0.1, 2.0, cache_dir)
+    # Without the STEP file, e.g. to re-analyze a scan whose files are gone
+    os.remove(step_path)
+    loaded = reference.load_cached_reference(cache_dir, built.mesh_key, built.key)
+    assert loaded.from_cache and loaded.key == built.key
+    np.testing.assert_array_equal(loaded.triangles, built.triangles)
+    np.testing.assert_array_equal(loaded.points, built.points)
+    np.testing.assert_array_equal(loaded.face_ids, built.face_ids)
+    assert list(loaded.face_types) == list(built.face_types)
+
+
+def test_evict_removes_the_expired_then_the_least_recently_used_entries(tmp_path):
+    cache_dir = str(tmp_path)
+    now = time.time()
+    for age, key in ((100, 'a'), (50, 'b'), (10, 'c'), (5, 'd')):
+        cache.save_arrays(cache_dir, 'cleaned', key * 64, points=np.zeros(1000))
+        os.utime(cache._entry_path(cache_dir, 'cleaned', key * 64), (now - age, now - age))
+    size = os.path.getsize(cache._entry_path(cache_dir, 'cleaned', 'a' * 64))
+    # A load marks 'b' as the most recently used entry
+    assert cache.load_arrays(cache_dir, 'cleaned', 'b' * 64) is not None
+
+    assert cache.evict(cache_dir, max_age=60) == (1, size)
+    assert cache.evict(cache_dir, max_bytes=2 * size) == (1, size)
+    assert cache.load_arrays(cache_dir, 'cleaned', 'c' * 64) is None
+    assert cache.load_arrays(cache_dir, 'cleaned', 'd' * 64) is not None
+    assert cache.load_arrays(cache_dir, 'cleaned', 'b' * 64) is not None
+    assert cache.evict(cache_dir, max_bytes=2 * size, max_age=60) == (0, 0)
+
+
+def test_evict_removes_whole_result_directories(tmp_path):
+    directory = tmp_path / "outputs"
+    directory.mkdir()
+    (directory / "heatmap_scan.ply").write_bytes(b"x" * 100)
+    cache_dir = str(tmp_path / "cache")
+    artifacts.save_result(cache_dir, 'r' * 64, str(directory), [["heatmap_scan.ply", ".ply"]], {})
+
+    removed, removed_bytes = cache.evict(cache_dir, max_bytes=0)
+    assert removed == 1 and removed_bytes > 100
+    assert os.listdir(os.path.join(cache_dir, 'results', 'rr')) == []
+
+
+def test_evict_ages_out_the_manifests(tmp_path):
+    cache_dir = str(tmp_path)
+    now = time.time()
+    for scan_id in ("old", "read", "new"):
+        artifacts.write_manifest(cache_dir, scan_id, {'keys': {'result': scan_id}})
+    for scan_id in ("old", "read"):
+        path = os.path.join(cache_dir, 'manifests', f"{scan_id}.json")
+        os.utime(path, (now - 100, now - 100))
+    # A read marks the manifest as used, like the loads of the artifacts
+    assert artifacts.read_manifest(cache_dir, "read") is not None
+
+    removed, _ = cache.evict(cache_dir, max_age=60)
+    assert removed == 1
+    assert artifacts.read_manifest(cache_dir, "old") is None
+    assert artifacts.read_manifest(cache_dir, "read") is not None
+    assert artifacts.read_manifest(cache_dir, "new") is not None
+    # And by the size limit
+    assert cache.evict(cache_dir, max_bytes=0)[0] == 2
+    assert os.listdir(os.path.join(cache_dir, 'manifests')) == []
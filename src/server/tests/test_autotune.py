@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from pipeline import autotune
+
+
+def grid(spacing, size=300):
+    """Points of a flat square grid with the given spacing"""
+    x, y = np.meshgrid(np.arange(size) * spacing, np.arange(size) * spacing)
+    return np.column_stack([x.ravel(), y.ravel(), np.zeros(x.size)])
+
+
+@pytest.mark.parametrize("spacing", [0.0002, 0.001, 0.01])
+def test_estimate_spacing(spacing):
+    # 90000 points, more than the sample: the estimate is corrected for the sampling
+    assert autotune.estimate_spacing(grid(spacing), sample_size=20000) == pytest.approx(spacing, rel=0.15)
+
+
+def test_snap_log2():
+    assert autotune.snap_log2(0.0059) == 2 ** -7
+    assert autotune.snap_log2(0.25) == 0.25
+
+
+def test_parameters_scale_with_the_part():
+    small = autotune.derive_parameters(0.0001, 0.06)
+    large = autotune.derive_parameters(0.0016, 0.96)
+    for name in ('voxel_size', 'icp_threshold', 'plane_distance_threshold'):
+        assert large[name] == pytest.approx(small[name] * 16)
+
+
+def test_voxel_size_holds_several_points():
+    # A sparse scan of a small part: the voxel size is bounded by the spacing, not by the part
+    parameters = autotune.derive_parameters(0.004, 0.06)
+    assert parameters['voxel_size'] >= 0.008
+    assert parameters['fpfh_radius'] == parameters['voxel_size'] * 5
+
+
+def test_duplicated_points_fall_back_to_the_fixed_parameters():
+    # A scan of one point repeated: no spacing, every length derived from it would be 0
+    spacing = autotune.estimate_spacing(np.zeros((1000, 3)))
+    assert spacing == 0
+    fixed = {'diagonal': 0.06, 'voxel_size': 0.05, 'icp_threshold': 0.02, 'plane_distance_threshold': 0.02,
+             'outlier_voxel_size': 0.002, 'cluster_eps': 0.02}
+    assert autotune.derive_parameters(spacing, 0.06, fallback=fixed) == fixed
+    assert autotune.derive_parameters(0.001, 0.0, fallback=fixed) == fixed
+    with pytest.raises(ValueError):
+        autotune.derive_parameters(spacing, 0.06)
+
+
+def test_surface_samples_match_the_spacing():
+    # Unit square as two triangles: the samples have the requested spacing, whatever the tessellation
+    from pipeline import reference
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]], dtype=float)
+    triangles = np.array([[0, 1, 2], [0, 2, 3]])
+    samples = reference.sample_surface(vertices, triangles, 0.01)
+    assert len(samples) == 10000
+    assert autotune.estimate_spacing(samples) == pytest.approx(0.01, rel=0.15)
+
+
+def test_spacing_from_a_sample_of_the_ply_file(tmp_path):
+    import open3d as o3d
+    points = grid(0.001)
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    pcd.colors = o3d.utility.Vector3dVector(np.full_like(points, 0.5))
+    path = str(tmp_path / "scan.ply")
+    o3d.io.write_point_cloud(path, pcd, write_ascii=False)
+
+    sample, total = autotune.sample_ply_points(path, sample_size=20000)
+    assert total == len(points) and sample.shape == (20000, 3)
+    # The sampled rows are points of the scan
+    assert np.isin(np.rint(sample[:, 0] / 0.001), np.arange(300)).all()
+    assert autotune.estimate_spacing(sample, 20000, total=total) == pytest.approx(0.001, rel=0.15)
+
+    # Small scans are read entirely
+    small_path = str(tmp_path / "small.ply")
+    o3d.io.write_point_cloud(small_path, o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points[:100])))
+    sample, total = autotune.sample_ply_points(small_path, sample_size=20000)
+    np.testing.assert_allclose(sample, points[:100])
+
+
+def test_ascii_ply_files_are_not_sampled(tmp_path):
+    import open3d as o3d
+    path = str(tmp_path / "scan.ply")
+    o3d.io.write_point_cloud(path, o3d.geometry.PointCloud(o3d.utility.Vector3dVector(grid(0.001, 10))),
+                             write_ascii=True)
+    assert autotune.sample_ply_points(path) is None
@@ -0,0 +1,38 @@
+import numpy as np
+import open3d as o3d
+import pytest
+from pipeline import cad
+
+
+@pytest.mark.parametrize("box_step", [(20, 10, 5)], indirect=True)
+def test_tessellation_in_memory(box_step):
+    vertices, triangles, face_ids, face_types = cad.tessellate_step(box_step, 0.1, with_faces=True)
+
+    assert vertices.dtype == np.float64 and triangles.dtype == np.int32
+    np.testing.assert_allclose(vertices.min(axis=0), [-10, -5, -2.5])
+    np.testing.assert_allclose(vertices.max(axis=0), [10, 5, 2.5])
+    assert triangles.min() >= 0 and triangles.max() < len(vertices)
+    # Two triangles per face of the box, each face attributed to its triangles
+    assert list(face_types) == ["PLANE"] * 6
+    np.testing.assert_array_equal(np.bincount(face_ids), [2] * 6)
+
+    # The faces don't share their vertices, the surface is the one of the box
+    mesh = cad.to_triangle_mesh(vertices, triangles)
+    assert mesh.get_surface_area() == pytest.approx(2 * (20 * 10 + 20 * 5 + 10 * 5))
+    assert len(cad.to_point_cloud(vertices).points) == len(vertices)
+
+
+def test_write_ply_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    vertices = rng.uniform(-1, 1, (1000, 3))
+    triangles = rng.integers(0, len(vertices), (500, 3), dtype=np.int32)
+    path = str(tmp_path / "mesh.ply")
+    cad.write_ply(path, vertices, triangles)
+
+    mesh = o3d.io.read_triangle_mesh(path)
+    np.testing.assert_array_equal(np.asarray(mesh.vertices), vertices.astype(np.float32))
+    np.testing.assert_array_equal(np.asarray(mesh.triangles), triangles)
+
+    cad.write_ply(path, vertices)
+    cloud = o3d.io.read_point_cloud(path)
+    np.testing.assert_array_equal(np.asarray(cloud.points), vertices.astype(np.float32))
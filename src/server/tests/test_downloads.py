@@ -0,0 +1,166 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+import downloads
+
+
+class FakeStorage:
+    """Local stand-in of Cloud Storage signed URLs: serves files with Range support and x-goog-hash"""
+
+    def __init__(self):
+        self.files = {}
+        # md5 sent instead of the real one, per path
+        self.wrong_md5 = {}
+        self.requests = []
+        # Number of responses to cut in the middle, per path
+        self.drops = {}
+        self.status = {}
+
+    def add(self, path, content, md5=None):
+        self.files[path] = content
+        if md5:
+            self.wrong_md5[path] = md5
+
+
+@pytest.fixture
+def no_retry_sleep(monkeypatch):
+    """Makes the retry backoffs of the downloads instant"""
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+
+
+@pytest.fixture
+def storage(no_retry_sleep):
+    fake = FakeStorage()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            fake.requests.append((self.path, self.headers.get('Range')))
+            if self.path in fake.status:
+                self.send_response(fake.status[self.path])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            content = fake.files[self.path]
+            md5 = fake.wrong_md5.get(self.path) or base64.b64encode(hashlib.md5(content).digest()).decode()
+            start, end = 0, len(content) - 1
+            if self.headers.get('Range'):
+                first, _, last = self.headers['Range'].split('=')[1].partition('-')
+                start, end = int(first), min(int(last), end) if last else end
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{len(content)}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end + 1 - start))
+            self.send_header('x-goog-hash', f'crc32c=AAAAAA==,md5={md5}')
+            self.end_headers()
+
+            body = content[start:end + 1]
+            if fake.drops.get(self.path):
+                # Send half of the body, then drop the connection
+                fake.drops[self.path] -= 1
+                self.wfile.write(body[:len(body) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    fake.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield fake
+    server.shutdown()
+
+
+def test_download_file(storage, tmp_path):
+    """A plain download is written to disk and verified against the md5 of x-goog-hash"""
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    storage.add('/scan.ply', content)
+
+    destination = tmp_path / "scan.ply"
+    downloads.download_file(f"{storage.url}/scan.ply", str(destination))
+
+    assert destination.read_bytes() == content
+    assert storage.requests == [('/scan.ply', None)]
+
+
+def test_download_resumes_after_dropped_connection(storage, tmp_path):
+    """A dropped connection is resumed with a Range request instead of restarting"""
+    content = os.urandom(4 * 1024 * 1024)
+    storage.add('/scan.ply', content)
+    storage.drops['/scan.ply'] = 1
+
+    destination = tmp_path / "scan.ply"
+    downloads.download_file(f"{storage.url}/scan.ply", str(destination))
+
+    assert destination.read_bytes() == content
+    assert len(storage.requests) == 2
+    resumed_range = storage.requests[1][1]
+    assert resumed_range is not None and resumed_range != 'bytes=0-'
+
+
+def test_download_checksum_mismatch(storage, tmp_path):
+    """A file that does not match the server checksum is rejected"""
+    storage.add('/step.step', b"solid part", md5=base64.b64encode(hashlib.md5(b"other").digest()).decode())
+
+    with pytest.raises(downloads.DownloadError):
+        downloads.download_file(f"{storage.url}/step.step", str(tmp_path / "step.step"))
+
+
+def test_client_error_is_not_retried(storage, tmp_path):
+    """An expired signed URL (403) fails immediately"""
+    storage.status['/expired.ply'] = 403
+
+    with pytest.raises(requests.HTTPError):
+        downloads.download_file(f"{storage.url}/expired.ply", str(tmp_path / "scan.ply"))
+    assert len(storage.requests) == 1
+
+
+def test_download_files_concurrently(storage, tmp_path):
+    """Scan and step are fetched concurrently over the same pooled session"""
+    scan, step = os.urandom(1024 * 1024), os.urandom(2048)
+    storage.add('/scan.ply', scan)
+    storage.add('/step.step', step)
+
+    downloads.download_files([
+        (f"{storage.url}/scan.ply", str(tmp_path / "scan.ply")),
+        (f"{storage.url}/step.step", str(tmp_path / "step.step")),
+    ])
+
+    assert (tmp_path / "scan.ply").read_bytes() == scan
+    assert (tmp_path / "step.step").read_bytes() == step
+
+
+def test_probe_scan(storage):
+    """The size and the point count of a scan are read from its first bytes"""
+    header = b"ply\nformat binary_little_endian 1.0\nelement vertex 250000\nproperty float x\nend_header\n"
+    storage.add('/scan.ply', header + os.urandom(200000))
+    storage.add('/other.bin', os.urandom(100))
+
+    assert downloads.probe_scan(f"{storage.url}/scan.ply", header_bytes=1024) == (len(header) + 200000, 250000)
+    assert storage.requests == [('/scan.ply', 'bytes=0-1023')]
+    assert downloads.probe_scan(f"{storage.url}/other.bin") == (100, None)
+
+
+def test_signed_url_expiry():
+    v4 = ("https://storage.googleapis.com/bucket/scans/a%20b.ply?X-Goog-Algorithm=GOOG4-RSA-SHA256"
+          "&X-Goog-Date=20260101T120000Z&X-Goog-Expires=900&X-Goog-SignedHeaders=host&X-Goog-Signature=ab")
+    assert downloads.signed_url_expiry(v4) == 1767268800 + 900
+    assert downloads.signed_url_blob(v4) == ("bucket", "scans/a b.ply")
+
+    v2 = "https://bucket.storage.googleapis.com/steps/part.step?GoogleAccessId=sa&Expires=1767270600&Signature=ab"
+    assert downloads.signed_url_expiry(v2) == 1767270600
+    assert downloads.signed_url_blob(v2) == ("bucket", "steps/part.step")
+
+    assert downloads.signed_url_expiry("http://127.0.0.1/scan.ply") is None
+    assert downloads.signed_url_expiry("https://x/scan.ply?X-Goog-Date=garbage&X-Goog-Expires=900") is None
+    assert downloads.signed_url_blob("http://127.0.0.1/scan.ply") is None
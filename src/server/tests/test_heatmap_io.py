@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from pipeline import heatmap_io
+
+
+def _sorted_rows(points):
+    return points[np.lexsort(points.T[::-1])]
+
+
+@pytest.mark.parametrize("codec", ["none", "zlib", "zstd"])
+def test_roundtrip(heatmap, codec):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    points, deviations = heatmap
+    data = heatmap_io.encode_heatmap(points, deviations, (-0.002, 0.002), precision=0.0001, codec=codec)
+    # No fallback to another codec
+    assert heatmap_io.HEADER.unpack_from(data)[2] == heatmap_io.CODECS[codec]
+    decoded_points, decoded_deviations, color_range = heatmap_io.decode_heatmap(data)
+
+    assert color_range == pytest.approx((-0.002, 0.002))
+    # The points are reordered along the Z-order curve, compare the point sets
+    order = np.lexsort(decoded_points.T[::-1])
+    expected = np.lexsort(np.rint((points - points.min(axis=0)) / 0.0001).T[::-1])
+    assert np.abs(decoded_points[order] - points[expected]).max() <= 0.0001 / 2 + 1e-6
+    assert np.allclose(decoded_deviations[order], deviations[expected], rtol=1e-3, atol=1e-7)
+
+
+def test_smaller_than_ply(heatmap):
+    points, deviations = heatmap
+    data = heatmap_io.encode_heatmap(points, deviations, (0.0, 0.002), codec="zlib")
+    # The binary PLY has 15 bytes per point
+    assert len(data) < len(points) * 15 / 2
+
+
+def test_precision_is_capped_by_uint16(heatmap):
+    points, deviations = heatmap
+    points = points * 1000  # 200 m wide: a 0.1 mm step would need more than 16 bits
+    decoded_points, _, _ = heatmap_io.decode_heatmap(heatmap_io.encode_heatmap(points, deviations, (0.0, 1.0)))
+    assert decoded_points.min(axis=0) == pytest.approx(points.min(axis=0), abs=0.01)
+    assert decoded_points.max(axis=0) == pytest.approx(points.max(axis=0), abs=0.01)
+
+
+def test_empty_heatmap():
+    data = heatmap_io.encode_heatmap(np.empty((0, 3)), np.empty(0), (0.0, 1.0))
+    points, deviations, _ = heatmap_io.decode_heatmap(data)
+    assert points.shape == (0, 3) and deviations.shape == (0,)
+
+
+def test_rejects_other_files():
+    with pytest.raises(ValueError):
+        heatmap_io.decode_heatmap(b"ply\nformat binary_little_endian 1.0\n" + bytes(64))
@@ -0,0 +1,86 @@
+import json
+import threading
+import time
+import pytest
+from instrumentation import ScanProfile, StageMetrics, HISTOGRAM_BUCKETS
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_stage_records_the_times_and_the_failures():
+    profile = ScanProfile("scan-1")
+    with profile.stage('analysis') as stage:
+        spin(0.05)
+        stage['points'] = 10
+    with pytest.raises(ValueError):
+        with profile.stage('upload'):
+            raise ValueError("network")
+
+    analysis, upload = profile.stages
+    assert analysis['stage'] == 'analysis' and analysis['points'] == 10 and 'failed' not in analysis
+    assert analysis['wall_time'] >= 0.05 and analysis['cpu_time'] > 0.02
+    assert analysis['peak_rss_mb'] > 0
+    assert upload['failed']
+
+    result = profile.to_dict(failed=True)
+    assert result['failed'] and result['scan_id'] == "scan-1"
+    assert result['total_wall_time'] == analysis['wall_time'] + upload['wall_time']
+
+
+def test_thread_stage_counts_its_own_thread_only():
+    stop = threading.Event()
+    # Another scan keeping the server busy during the stage
+    busy = threading.Thread(target=lambda: [spin(0.01) for _ in iter(stop.is_set, True)])
+    busy.start()
+    profile = ScanProfile("scan-1")
+    try:
+        with profile.stage('download', thread=True):
+            # Waiting like a download
+            time.sleep(0.2)
+    finally:
+        stop.set()
+        busy.join()
+
+    download, = profile.stages
+    assert download['wall_time'] >= 0.2
+    assert download['cpu_time'] < 0.05
+    # The peak RSS is the one of the whole server, not reported
+    assert download['peak_rss_mb'] is None
+
+
+def record(stage, wall_time, failed=False):
+    result = {'stage': stage, 'wall_time': wall_time, 'cpu_time': wall_time / 2, 'peak_rss_mb': None}
+    if failed:
+        result['failed'] = True
+    return result
+
+
+def test_metrics_aggregate_processed_and_failed_scans(tmp_path):
+    path = tmp_path / "logs" / "metrics.jsonl"
+    metrics = StageMetrics(str(path))
+    metrics.add({'scan_id': "a", 'failed': False, 'stages': [
+        record('download', 0.5), dict(record('analysis', 30.0), peak_rss_mb=800.0)]})
+    metrics.add({'scan_id': "b", 'failed': True, 'stages': [record('download', 2000.0, failed=True)]})
+
+    summary = metrics.summary()
+    assert summary['scans'] == 2 and summary['failed_scans'] == 1
+    # Sorted by total wall time
+    assert list(summary['stages']) == ['download', 'analysis']
+
+    download = summary['stages']['download']
+    assert download['count'] == 2 and download['failed'] == 1
+    assert download['wall_time_avg'] == pytest.approx(1000.25)
+    assert download['cpu_time_avg'] == pytest.approx(500.125)
+    assert download['wall_time_max'] == 2000.0
+    assert download['peak_rss_mb_max'] == 0.0
+    assert download['wall_time_buckets']['0.5'] == 1 and download['wall_time_buckets']['+Inf'] == 1
+    assert len(download['wall_time_buckets']) == len(HISTOGRAM_BUCKETS) + 1
+    assert summary['stages']['analysis']['peak_rss_mb_max'] == 800.0
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line['scan_id'] for line in lines] == ["a", "b"]
+    assert lines[1]['failed']
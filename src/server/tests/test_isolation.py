@@ -0,0 +1,65 @@
+import numpy as np
+import open3d as o3d
+import pytest
+from pipeline import preprocess, voxels
+
+
+def rectangle(rng, count, origin, u, v):
+    a, b = rng.uniform(0, 1, (2, count, 1))
+    return np.asarray(origin) + a * np.asarray(u) + b * np.asarray(v)
+
+
+def cloud(*parts):
+    return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.vstack(parts)))
+
+
+def test_connected_components():
+    # Two touching voxels (diagonal neighbours), one isolated voxel, one inactive voxel between groups
+    points = np.array([[0.5, 0.5, 0.5], [1.5, 1.5, 1.5], [5.5, 0.5, 0.5], [3.5, 0.5, 0.5], [4.5, 0.5, 0.5]])
+    keys, inverse, _ = voxels.voxelize(points, 1.0)
+    labels = voxels.connected_components(keys)[inverse]
+    assert labels[0] == labels[1]
+    assert labels[2] == labels[3] == labels[4] != labels[0]
+
+    active = np.ones(len(keys), dtype=bool)
+    active[inverse[4]] = False
+    labels = voxels.connected_components(keys, active)[inverse]
+    assert labels[4] == -1
+    assert len({labels[0], labels[2], labels[3]}) == 3
+
+
+def test_connected_components_of_a_long_chain():
+    # The worst case of label propagation: one voxel wide, 10000 voxels long
+    points = np.column_stack([np.arange(10000) + 0.5, np.full(10000, 0.5), np.full(10000, 0.5)])
+    keys, _, _ = voxels.voxelize(points, 1.0)
+    assert np.all(voxels.connected_components(keys) == 0)
+
+
+@pytest.mark.parametrize("method", ["voxel", "dbscan"])
+def test_largest_cluster(method):
+    rng = np.random.default_rng(0)
+    big = rng.uniform(0, 0.1, (4000, 3))
+    small = rng.uniform(0.3, 0.35, (1000, 3))
+    noise = rng.uniform(-1, 1, (20, 3))
+    kept = np.asarray(preprocess.largest_cluster(cloud(big, small, noise), method, 0.01, 5).points)
+    assert 3900 <= len(kept) <= 4010
+    assert np.all(kept.max(axis=0) < 0.15)
+
+
+def test_remove_planes_keeps_the_faces_of_the_part():
+    rng = np.random.default_rng(0)
+    # A 10 cm cube on a 1 m table, in front of a 1 m wall, all sampled every 5 mm or less
+    table = rectangle(rng, 40000, [-0.5, -0.5, 0], [1, 0, 0], [0, 1, 0])
+    wall = rectangle(rng, 20000, [-0.5, 0.5, 0], [1, 0, 0], [0, 0, 0.5])
+    top = rectangle(rng, 3000, [0, 0, 0.1], [0.1, 0, 0], [0, 0.1, 0])
+    side = rectangle(rng, 3000, [0, 0, 0], [0.1, 0, 0], [0, 0, 0.1])
+    scene = cloud(table, wall, top, side)
+
+    remaining, planes = preprocess.remove_planes(scene, 0.01, max_planes=4, min_ratio=0.01, min_extent=0.18)
+    assert planes == 2
+    # The bottom centimeter of the side goes with the table
+    assert len(remaining.points) == pytest.approx(5700, abs=100)
+
+    # Without the extent check, the faces of the cube go too
+    _, planes = preprocess.remove_planes(scene, 0.01, max_planes=4, min_ratio=0.01)
+    assert planes == 4
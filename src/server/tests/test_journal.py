@@ -0,0 +1,56 @@
+from journal import ScanJournal, QUEUED, STARTED, FINISHED, FAILED
+
+
+def scan(scan_id):
+    return {'scan_id': scan_id, 'scan_url': f"https://storage/{scan_id}.ply", 'step_url': "https://storage/part.step"}
+
+
+def test_queued_and_started_scans_are_resumed_after_a_restart(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    journal = ScanJournal(path)
+    for scan_id in ("a", "b", "c"):
+        journal.record_enqueued(scan(scan_id))
+    journal.record_started("b")
+    journal.conn.close()
+
+    journal = ScanJournal(path)
+    assert journal.pending_scans() == [scan("a"), scan("b"), scan("c")]
+    assert journal.get_state("b") == STARTED and journal.get_attempts("b") == 1
+    assert journal.get_state("unknown") is None and journal.get_attempts("unknown") == 0
+
+
+def test_finished_and_failed_scans_are_not_resumed(tmp_path):
+    journal = ScanJournal(str(tmp_path / "journal.sqlite3"))
+    for scan_id in ("done", "broken", "waiting"):
+        journal.record_enqueued(scan(scan_id))
+        journal.record_started(scan_id)
+    journal.record_finished("done")
+    journal.record_failed("broken", ValueError("bad scan"))
+
+    assert journal.pending_scans() == [scan("waiting")]
+    assert journal.get_state("done") == FINISHED
+    assert journal.get_state("broken") == FAILED
+    # Submitted again, a failed or finished scan starts over with no attempts
+    journal.record_enqueued(scan("broken"))
+    journal.record_enqueued(scan("done"))
+    assert journal.get_state("broken") == QUEUED and journal.get_attempts("broken") == 0
+    assert journal.get_state("done") == QUEUED and journal.get_attempts("done") == 0
+    assert journal.pending_scans() == [scan("waiting"), scan("broken"), scan("done")]
+    # Re-queued while in flight (after a crash of the pool), the scan keeps its attempts
+    journal.record_enqueued(scan("waiting"))
+    assert journal.get_attempts("waiting") == 1
+
+
+def test_scans_started_too_many_times_are_failed_instead_of_resumed(tmp_path):
+    journal = ScanJournal(str(tmp_path / "journal.sqlite3"))
+    journal.record_enqueued(scan("crashing"))
+    journal.record_enqueued(scan("other"))
+    for _ in range(3):
+        journal.record_started("crashing")
+    journal.record_started("other")
+
+    assert journal.pending_scans(max_attempts=3) == [scan("other")]
+    assert journal.fail_exhausted(3) == ["crashing"]
+    assert journal.get_state("crashing") == FAILED
+    assert journal.fail_exhausted(3) == []
+    assert journal.pending_scans() == [scan("other")]
@@ -0,0 +1,54 @@
+import json
+import os
+import numpy as np
+from pipeline import heatmap_io
+from pipeline import lod
+
+
+def test_levels_partition_the_points(heatmap):
+    points, _ = heatmap
+    levels = lod.build_levels(points, levels=4, base_resolution=16)
+
+    assert len(levels) == 4
+    all_indices = np.concatenate(levels)
+    assert len(all_indices) == len(points)
+    assert len(np.unique(all_indices)) == len(points)
+    # Coarse levels are small, most of the points are in the last one
+    assert len(levels[0]) < len(levels[1]) < len(levels[2]) < len(levels[3])
+
+
+def test_level_zero_covers_the_whole_part(heatmap):
+    points, _ = heatmap
+    coarse = points[lod.build_levels(points, levels=3, base_resolution=8)[0]]
+    assert np.all(coarse.min(axis=0) - points.min(axis=0) < 0.2 / 8)
+    assert np.all(points.max(axis=0) - coarse.max(axis=0) < 0.2 / 8)
+
+
+def test_write_lod(tmp_path, heatmap):
+    points, _ = heatmap
+    # Deviations derived from the positions, to check that the tiles keep them together
+    deviations = (points[:, 0] * 0.01).astype(np.float32)
+    files = lod.write_lod(str(tmp_path), points, deviations, (-0.001, 0.001), levels=3, base_resolution=16,
+                          tile_depth=1, codec="zlib")
+
+    assert files[-1] == "index.json"
+    with open(tmp_path / "index.json") as f:
+        index = json.load(f)
+    assert index["points"] == len(points)
+    assert [level["level"] for level in index["levels"]] == [0, 1, 2]
+    assert len(index["levels"][0]["tiles"]) == 1
+    assert 1 < len(index["levels"][1]["tiles"]) <= 8
+
+    total = 0
+    for level in index["levels"]:
+        assert sum(tile["points"] for tile in level["tiles"]) == level["points"]
+        for tile in level["tiles"]:
+            tile_points, tile_deviations, color_range = heatmap_io.read_heatmap(str(tmp_path / tile["path"]))
+            assert len(tile_points) == tile["points"]
+            assert np.all(tile_points >= np.array(tile["bbox"]["min"]) - 1e-4)
+            assert np.all(tile_points <= np.array(tile["bbox"]["max"]) + 1e-4)
+            # The deviations still match the positions
+            assert np.allclose(tile_deviations, tile_points[:, 0] * 0.01, atol=2e-6)
+            total += len(tile_points)
+    assert total == len(points)
+    assert sorted(files) == sorted(os.listdir(tmp_path))
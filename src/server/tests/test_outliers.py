@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from pipeline import preprocess, voxels
+
+
+def plane_with_outliers(rng, spacing=0.001, size=100, outliers=50):
+    """A noisy square grid at z = 0, followed by isolated points above it"""
+    x, y = np.meshgrid(np.arange(size) * spacing, np.arange(size) * spacing)
+    surface = np.column_stack([x.ravel(), y.ravel(), rng.normal(0, spacing / 10, x.size)])
+    extent = size * spacing
+    far = np.column_stack([rng.uniform(0, extent, (outliers, 2)), rng.uniform(extent / 4, extent, outliers)])
+    return np.vstack([surface, far]), len(surface)
+
+
+def test_voxelize_counts_the_points():
+    points = np.array([[0.1, 0.1, 0.1], [0.2, 0.2, 0.2], [1.5, 0.1, 0.1], [5.5, 5.5, 5.5]])
+    keys, inverse, counts = voxels.voxelize(points, 1.0)
+    assert len(keys) == 3
+    assert inverse[0] == inverse[1] != inverse[2]
+    assert sorted(counts) == [1, 1, 2]
+    # The first two voxels are neighbours, the last one is alone
+    assert sorted(voxels.neighborhood_counts(keys, counts)) == [1, 3, 3]
+
+
+def test_lookup_of_missing_keys():
+    keys = np.array([3, 7, 11])
+    assert list(voxels.lookup(keys, np.array([7, 8, 0, 11, 12]))) == [1, -1, -1, 2, -1]
+
+
+def test_centroids():
+    points = np.array([[0.0, 0, 0], [0.5, 0.5, 0.5], [2.5, 2.5, 2.5]])
+    keys, inverse, _ = voxels.voxelize(points, 1.0)
+    assert voxels.centroids(points, inverse, len(keys))[inverse[0]] == pytest.approx([0.25, 0.25, 0.25])
+
+
+@pytest.mark.parametrize("method", ["statistical", "voxel_statistical", "radius_voxel"])
+def test_filters_keep_the_surface(method):
+    rng = np.random.default_rng(0)
+    points, n_surface = plane_with_outliers(rng)
+    if method == "statistical":
+        import open3d as o3d
+        _, indices = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points)).remove_statistical_outlier(20, 2.0)
+        kept = np.zeros(len(points), dtype=bool)
+        kept[indices] = True
+    elif method == "voxel_statistical":
+        kept = preprocess.voxel_statistical_inliers(points, 0.003, 20, 2.0)
+    else:
+        kept = preprocess.radius_voxel_inliers(points, 0.003, 8)
+    assert kept[:n_surface].mean() > 0.99
+    assert kept[n_surface:].mean() < 0.1
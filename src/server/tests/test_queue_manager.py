@@ -0,0 +1,255 @@
+import multiprocessing
+import os
+import runpy
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+from journal import FINISHED, FAILED
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_DIR = os.path.join(SERVER_DIR, "app")
+
+# Stages run in the forked process pools: module-level so they are pickled by reference
+
+
+def prepare_reference(scan_id, scan_filename, step_filename):
+    if scan_id == "bad-step":
+        raise ValueError("not a STEP file")
+    return {'voxel_size': 1.0}, [{'stage': 'prepare', 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss_mb': None}]
+
+
+def process_scan(scan_id, scan_filename, step_filename, temp_dir, parameters):
+    if scan_id == "no-overlap":
+        raise RuntimeError("registration failed")
+    if scan_id == "out-of-memory":
+        # Killed like by the OOM killer: the pool breaks
+        os._exit(1)
+    return {'heatmap': os.path.join(temp_dir, "heatmap.ply")}, {'scan_id': scan_id}, []
+
+
+@pytest.fixture(scope="module")
+def queue_manager(tmp_path_factory):
+    """
+    The queue_manager module, imported from an 'app' package without its __init__, which would start
+    the Flask app, initialize Firebase and fetch the pending scans
+    """
+    from flask import Flask
+    flask_app = Flask("test")
+    flask_app.config.update(SCAN_JOURNAL_PATH=str(tmp_path_factory.mktemp("journal") / "journal.sqlite3"),
+                            PIPELINE_METRICS_PATH=None)
+    package = types.ModuleType("app")
+    package.__path__ = [APP_DIR]
+    package.app = flask_app
+    package.init_worker_logging = lambda: None
+
+    saved = {name: module for name, module in sys.modules.items() if name == "app" or name.startswith("app.")}
+    sys.modules["app"] = package
+    try:
+        from app import queue_manager
+        yield queue_manager
+    finally:
+        for name in [name for name in sys.modules if name == "app" or name.startswith("app.")]:
+            del sys.modules[name]
+        sys.modules.update(saved)
+
+
+@pytest.fixture
+def pipeline(queue_manager, monkeypatch, tmp_path):
+    """Replaces the stages of the worker, returns what reached the server side of the pipeline"""
+    from app import downloads, worker
+    calls = {'fetched': [], 'published': [], 'failed': {}, 'cleaned': []}
+    # Set by the tests to hold the scans in the I/O stages
+    calls['fetch_gate'] = calls['publish_gate'] = None
+
+    def fetch_inputs(scan_id, scan_url, step_url, profile):
+        calls['fetched'].append(scan_id)
+        if calls['fetch_gate'] is not None:
+            calls['fetch_gate'].wait()
+        if scan_id == "bad-download":
+            raise ConnectionError("download failed")
+        temp_dir = str(tmp_path / scan_id)
+        os.makedirs(temp_dir, exist_ok=True)
+        return temp_dir, os.path.join(temp_dir, "scan.ply"), os.path.join(temp_dir, "part.step")
+
+    def publish_results(scan_id, outputs, metrics, profile):
+        if calls['publish_gate'] is not None:
+            calls['publish_gate'].wait()
+        if scan_id == "bad-upload":
+            raise ConnectionError("upload failed")
+        assert metrics == {'scan_id': scan_id}
+        calls['published'].append(scan_id)
+
+    monkeypatch.setattr(worker, "fetch_inputs", fetch_inputs)
+    monkeypatch.setattr(worker, "prepare_reference", prepare_reference)
+    monkeypatch.setattr(worker, "process_scan", process_scan)
+    monkeypatch.setattr(worker, "publish_results", publish_results)
+    monkeypatch.setattr(worker, "mark_failed", lambda scan_id, error: calls['failed'].__setitem__(scan_id, error))
+    monkeypatch.setattr(worker, "cleanup", lambda scan_id, temp_dir: calls['cleaned'].append(scan_id))
+    monkeypatch.setattr(worker, "refresh_signed_urls", lambda scan_data, margin: {})
+    monkeypatch.setattr(worker, "evict_cache", lambda: (0, 0))
+    monkeypatch.setattr(downloads, "probe_scan", lambda url: (None, None))
+    return calls
+
+
+def make_manager(queue_manager, tmp_path, **options):
+    journal = queue_manager.ScanJournal(str(tmp_path / "journal.sqlite3"))
+    return queue_manager.ScanQueueManager(journal=journal, **options)
+
+
+def scan(scan_id):
+    return {'scan_id': scan_id, 'scan_url': f"https://storage/{scan_id}.ply", 'step_url': "https://storage/part.step"}
+
+
+def wait_until(condition, timeout=30):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.02)
+
+
+def shutdown(manager):
+    stopping = threading.Thread(target=manager.shutdown)
+    stopping.start()
+    stopping.join(timeout=30)
+    assert not stopping.is_alive(), "shutdown is stuck"
+    assert not any(thread.is_alive() for thread in manager.threads)
+
+
+def test_errors_of_every_stage_fail_their_scan_only(queue_manager, pipeline, tmp_path):
+    # A single process lane, so that the crash of the pool only hits the scan that causes it
+    manager = make_manager(queue_manager, tmp_path, max_workers=1, fetch_workers=2, publish_workers=1, prefetch=1)
+    failing = ["bad-download", "bad-step", "no-overlap", "out-of-memory", "bad-upload"]
+    scan_ids = ["a", *failing[:3], "b", *failing[3:], "c"]
+    for scan_id in scan_ids:
+        manager.add_scan(scan(scan_id))
+
+    wait_until(lambda: manager.completed_count + manager.failed_count == len(scan_ids))
+    shutdown(manager)
+
+    assert sorted(pipeline['published']) == ["a", "b", "c"]
+    assert sorted(pipeline['failed']) == sorted(failing)
+    assert str(pipeline['failed']["no-overlap"]) == "registration failed"
+    assert "2 crashed process pools" in str(pipeline['failed']["out-of-memory"])
+    # The crashing scan was tried again once before failing
+    assert pipeline['fetched'].count("out-of-memory") == 2
+    assert (manager.completed_count, manager.failed_count) == (3, 5)
+    assert manager.get_active_count() == 0 and manager.get_queue_status()['running'] == 0
+    assert set(pipeline['cleaned']) == set(scan_ids)
+    for scan_id in scan_ids:
+        assert manager.journal.get_state(scan_id) == (FAILED if scan_id in failing else FINISHED)
+    assert manager.stage_metrics.summary()['failed_scans'] == 5
+
+
+def test_bounded_queues_hold_back_the_downloads(queue_manager, pipeline, tmp_path):
+    manager = make_manager(queue_manager, tmp_path, max_workers=1, fetch_workers=1, publish_workers=1, prefetch=1)
+    pipeline['publish_gate'] = gate = threading.Event()
+    scan_ids = [f"scan-{i}" for i in range(8)]
+    for scan_id in scan_ids:
+        manager.add_scan(scan(scan_id))
+
+    # One scan uploading, then one in each queue and one held by the stage before it: the process lane
+    # and the fetch thread, whose next scans stay in the backlog
+    wait_until(lambda: len(pipeline['fetched']) == 5)
+    time.sleep(0.3)
+    assert len(pipeline['fetched']) == 5 and manager.get_queue_size() == 3
+    assert manager.ready_queue.full() and manager.publish_queue.full()
+
+    gate.set()
+    wait_until(lambda: manager.completed_count == len(scan_ids))
+    assert pipeline['published'] == scan_ids
+    shutdown(manager)
+
+
+def test_shutdown_finishes_the_scans_in_flight_and_keeps_the_queued_ones(queue_manager, pipeline, tmp_path):
+    manager = make_manager(queue_manager, tmp_path, max_workers=1, fetch_workers=1, publish_workers=2, prefetch=1)
+    pipeline['fetch_gate'] = gate = threading.Event()
+    manager.add_scan(scan("in-flight"))
+    wait_until(lambda: pipeline['fetched'] == ["in-flight"])
+    for scan_id in ("queued-1", "queued-2"):
+        manager.add_scan(scan(scan_id))
+
+    manager.shutdown(wait=False)
+    # Submitted while shutting down: only journaled
+    manager.add_scan(scan("late"))
+    gate.set()
+    shutdown(manager)
+
+    assert pipeline['published'] == ["in-flight"] and pipeline['failed'] == {}
+    assert manager.journal.get_state("in-flight") == FINISHED
+    assert [scan_data['scan_id'] for scan_data in manager.journal.pending_scans()] == ["queued-1", "queued-2", "late"]
+    assert manager.executor is None and manager.prepare_executor is None
+
+
+def test_scans_leave_the_scheduler_once_journaled(queue_manager, pipeline, tmp_path):
+    manager = make_manager(queue_manager, tmp_path, max_workers=1, fetch_workers=1, publish_workers=1, prefetch=1)
+    states = {}
+    done = manager.scan_queue.done
+
+    def record_done(scan_id):
+        # A duplicate submitted from here on is neither in the scheduler nor still pending in the journal
+        states[scan_id] = manager.journal.get_state(scan_id)
+        done(scan_id)
+
+    manager.scan_queue.done = record_done
+    for scan_id in ("a", "no-overlap"):
+        manager.add_scan(scan(scan_id))
+    wait_until(lambda: manager.completed_count + manager.failed_count == 2)
+    shutdown(manager)
+
+    assert states == {"a": FINISHED, "no-overlap": FAILED}
+
+
+def test_submissions_report_their_outcome(queue_manager, pipeline, tmp_path):
+    manager = make_manager(queue_manager, tmp_path, max_workers=1, fetch_workers=1, publish_workers=1, prefetch=1)
+    pipeline['fetch_gate'] = gate = threading.Event()
+    assert manager.add_scan(scan("a")) == queue_manager.ADDED
+    assert manager.add_scan(scan("a")) == queue_manager.ALREADY_QUEUED
+    gate.set()
+    wait_until(lambda: manager.completed_count == 1)
+
+    assert manager.add_scan(scan("a")) == queue_manager.ALREADY_PROCESSED
+    # Re-requested explicitly, the processed scan runs again
+    assert manager.add_scan(scan("a"), reprocess=True) == queue_manager.ADDED
+    wait_until(lambda: manager.completed_count == 2)
+    assert pipeline['published'] == ["a", "a"]
+
+    manager.shutdown()
+    assert manager.add_scan(scan("b")) == queue_manager.DEFERRED
+
+
+def test_gunicorn_worker_exit_drains_the_pipeline(queue_manager, pipeline, tmp_path, monkeypatch):
+    manager = make_manager(queue_manager, tmp_path, max_workers=1, fetch_workers=1, publish_workers=1, prefetch=1)
+    monkeypatch.setattr(queue_manager, "queue_manager", manager)
+    pipeline['publish_gate'] = gate = threading.Event()
+    for scan_id in ("in-flight", "next"):
+        manager.add_scan(scan(scan_id))
+    wait_until(lambda: pipeline['fetched'] == ["in-flight", "next"])
+    gate.set()
+
+    hooks = runpy.run_path(os.path.join(SERVER_DIR, "gunicorn.conf.py"))
+    hooks['worker_exit'](None, None)
+    assert not any(thread.is_alive() for thread in manager.threads)
+    assert pipeline['published'] == ["in-flight", "next"]
+    assert hooks['graceful_timeout'] > 0
+
+
+def max_threads():
+    import open3d as o3d
+    return o3d.utility.get_max_threads()
+
+
+def test_pool_workers_share_the_cores(queue_manager, pipeline, tmp_path, monkeypatch):
+    from app import worker
+    monkeypatch.setattr(queue_manager.os, "cpu_count", lambda: 8)
+    assert make_manager(queue_manager, tmp_path, max_workers=4).worker_threads == 2
+    assert make_manager(queue_manager, tmp_path, max_workers=16).worker_threads == 1
+    # A single worker keeps the default of Open3D
+    assert make_manager(queue_manager, tmp_path, max_workers=1).worker_threads == 0
+
+    pool = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('fork'),
+                               initializer=worker.init_pool_worker, initargs=(1,))
+    with pool:
+        assert pool.submit(max_threads).result() == 1
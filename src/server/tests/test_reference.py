@@ -0,0 +1,47 @@
+import shutil
+import numpy as np
+from pipeline import cad, reference
+
+
+def test_reference_cache_hits_and_misses(box_step, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    tessellations = []
+    tessellate_step = cad.tessellate_step
+    monkeypatch.setattr(cad, "tessellate_step", lambda *args, **kwargs: tessellations.append(args) or
+                        tessellate_step(*args, **kwargs))
+
+    built = reference.load_reference(box_step, 0.1, 2.0, cache_dir)
+    assert not built.from_cache and len(tessellations) == 1
+
+    loaded = reference.load_reference(box_step, 0.1, 2.0, cache_dir)
+    assert loaded.from_cache and loaded.key == built.key and loaded.mesh_key == built.mesh_key
+    np.testing.assert_array_equal(loaded.points, built.points)
+    np.testing.assert_array_equal(loaded.fpfh, built.fpfh)
+
+    # Keyed by the content: the same file under another name (another signed URL or step_id) hits
+    copy = str(tmp_path / "copy.step")
+    shutil.copyfile(box_step, copy)
+    assert reference.load_reference(copy, 0.1, 2.0, cache_dir).key == built.key
+    assert len(tessellations) == 1
+
+    # Another voxel size reuses the tessellation, but not the features
+    coarser = reference.load_reference(box_step, 0.1, 4.0, cache_dir)
+    assert not coarser.from_cache
+    assert coarser.mesh_key == built.mesh_key and coarser.key != built.key
+    assert len(tessellations) == 1
+
+    # Another tessellation tolerance invalidates both
+    finer = reference.load_reference(box_step, 0.05, 2.0, cache_dir)
+    assert not finer.from_cache
+    assert finer.mesh_key != built.mesh_key and finer.key != built.key
+    assert len(tessellations) == 2
+
+
+def test_another_file_misses(box_step, tmp_path):
+    import cadquery as cq
+    cache_dir = str(tmp_path / "cache")
+    other = str(tmp_path / "other.step")
+    cq.exporters.export(cq.Workplane("XY").box(20, 20, 10), other)
+
+    built = reference.load_reference(box_step, 0.1, 2.0, cache_dir)
+    assert reference.load_reference(other, 0.1, 2.0, cache_dir).mesh_key != built.mesh_key
@@ -0,0 +1,135 @@
+import numpy as np
+import open3d as o3d
+import pytest
+from pipeline import registration
+
+
+def rotation(axis, degrees):
+    return o3d.geometry.get_rotation_matrix_from_axis_angle(np.asarray(axis, dtype=float) * np.radians(degrees))
+
+
+def pose(axis, degrees, translation):
+    transformation = np.eye(4)
+    transformation[:3, :3] = rotation(axis, degrees)
+    transformation[:3, 3] = translation
+    return transformation
+
+
+def asymmetric_part(rng, count=3000):
+    """Points on an L-shaped bracket with a peg, without rotational symmetries"""
+    plate = rng.uniform([0, 0, 0], [0.4, 0.2, 0.02], (count // 2, 3))
+    wall = rng.uniform([0, 0, 0], [0.02, 0.2, 0.25], (count // 3, 3))
+    peg = rng.uniform([0.3, 0.05, 0.02], [0.34, 0.09, 0.1], (count - count // 2 - count // 3, 3))
+    return np.vstack([plate, wall, peg])
+
+
+def test_select_best_hypothesis_recovers_the_ground_truth_pose():
+    rng = np.random.default_rng(0)
+    points = asymmetric_part(rng)
+    truth = pose([1, 2, 3], 25, [0.05, -0.02, 0.1])
+    # The scan is the part moved by the inverse of the ground truth, which registers it back
+    source = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(
+        (points - truth[:3, 3]) @ truth[:3, :3]))
+    target = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+
+    hypotheses = [
+        np.eye(4),
+        pose([0, 0, 1], 180, [0, 0, 0]) @ truth,
+        pose([1, 0, 0], 90, [0.1, 0, 0]) @ truth,
+        # Close to the truth, within reach of ICP
+        pose([0, 1, 0], 3, [0.005, 0.005, 0]) @ truth,
+    ]
+    best = registration.select_best_hypothesis(source, target, hypotheses, threshold=0.02, iterations=10)
+    np.testing.assert_allclose(best, truth, atol=1e-3)
+    # The clouds are released once the hypotheses are refined
+    assert registration._hypothesis_clouds is None
+
+
+def test_hypotheses_share_the_ransac_budget(monkeypatch):
+    calls = []
+    poses = iter([pose([0, 0, 1], angle, [0, 0, 0]) for angle in (0, 90, 0.1, 180)])
+
+    def backend(source, target, source_fpfh, target_fpfh, voxel_size, **options):
+        calls.append(options)
+        return next(poses)
+
+    monkeypatch.setitem(registration.GLOBAL_BACKENDS, "ransac", backend)
+    monkeypatch.setattr(registration, "compute_features", lambda pcd, voxel_size: None)
+    hypotheses = registration.generate_hypotheses(None, None, 0.01, backend="ransac", count=4,
+                                                  max_iteration=100000, confidence=0.999)
+    assert calls == [{'max_iteration': 25000, 'confidence': 0.999}] * 4
+    # The run that found (almost) the same pose as the first one adds no hypothesis
+    assert len(hypotheses) == 3
+
+
+def test_deterministic_backend_runs_once(monkeypatch):
+    calls = []
+    monkeypatch.setitem(registration.GLOBAL_BACKENDS, "fgr", lambda *args, **options: calls.append(options) or np.eye(4))
+    monkeypatch.setattr(registration, "compute_features", lambda pcd, voxel_size: None)
+    assert len(registration.generate_hypotheses(None, None, 0.01, backend="fgr", count=4)) == 1
+    assert len(calls) == 1
+
+
+def test_multiscale_icp_converges_from_a_rough_pose():
+    rng = np.random.default_rng(1)
+    points = asymmetric_part(rng, 20000)
+    truth = pose([1, -1, 2], 8, [0.03, 0.02, -0.02])
+    source = o3d.geometry.PointCloud(o3d.utility.Vector3dVector((points - truth[:3, 3]) @ truth[:3, :3]))
+    target = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+
+    # The final threshold is much smaller than the initial error: ICP at full resolution alone gets stuck
+    single = registration.refine_with_icp(source, target, np.eye(4), 0.005, max_iteration=150)
+    assert np.abs(single - truth).max() > 0.01
+
+    # The coarse levels bridge it
+    result = registration.refine_multiscale_icp(source, target, np.eye(4), [0.04, 0.02, 0.01], [50, 30, 20],
+                                                threshold=0.005, max_iteration=50)
+    np.testing.assert_allclose(result, truth, atol=1e-3)
+
+
+def recording_backend(calls, name, result):
+    def backend(source, target, source_fpfh, target_fpfh, voxel_size, **options):
+        calls.append((name, options))
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return backend
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    calls = []
+    monkeypatch.setattr(registration, "compute_features", lambda pcd, voxel_size: None)
+    monkeypatch.setitem(registration.GLOBAL_BACKENDS, "ransac", recording_backend(calls, "ransac", np.eye(4)))
+    monkeypatch.setitem(registration.GLOBAL_BACKENDS, "fgr", recording_backend(
+        calls, "fgr", registration.RegistrationError("no correspondence")))
+    return calls
+
+
+def test_backend_selection(backends):
+    registration.run_global_registration(None, None, 0.01, backend="ransac", max_iteration=10)
+    assert backends == [("ransac", {'max_iteration': 10})]
+    with pytest.raises(ValueError, match="Unknown global registration backend"):
+        registration.run_global_registration(None, None, 0.01, backend="teaser")
+    with pytest.raises(ValueError, match="Unknown global registration backend"):
+        registration.run_global_registration(None, None, 0.01, backend="fgr", fallback="teaser")
+
+
+def test_failed_backend_falls_back(backends):
+    with pytest.warns(RuntimeWarning, match="falling back to ransac"):
+        hypotheses = registration.generate_hypotheses(None, None, 0.01, backend="fgr", count=2, fallback="ransac")
+    # The fallback runs with its own default options and the hypotheses budget
+    assert backends == [("fgr", {})] + [("ransac", {'max_iteration': registration.RANSAC_MAX_ITERATION // 2})] * 2
+    assert len(hypotheses) == 1
+
+    with pytest.raises(registration.RegistrationError):
+        registration.run_global_registration(None, None, 0.01, backend="fgr")
+
+
+def test_backend_without_alignment_raises():
+    rng = np.random.default_rng(0)
+    source = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(rng.random((500, 3))))
+    target = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(rng.random((500, 3))))
+    # Correspondences farther apart than the checkers allow: RANSAC finds no inlier
+    with pytest.raises(registration.RegistrationError):
+        registration.run_global_registration(source, target, 0.0001, backend="ransac", max_iteration=100)
@@ -0,0 +1,132 @@
+import threading
+import pytest
+from scheduler import FairScheduler, estimate_cost
+
+
+def drain(scheduler):
+    order = []
+    while scheduler.qsize():
+        order.append(scheduler.get())
+    return order
+
+
+def test_fair_share_between_users():
+    scheduler = FairScheduler()
+    for i in range(40):
+        scheduler.put(f"a{i}", f"a{i}", "alice", cost=100)
+    scheduler.put("b0", "b0", "bob", cost=100)
+    scheduler.put("b1", "b1", "bob", cost=100)
+
+    order = drain(scheduler)
+    # Bob's scans alternate with Alice's instead of waiting for her 40 scans
+    assert order.index("b0") <= 2 and order.index("b1") <= 4
+    assert [key for key in order if key.startswith("a")] == [f"a{i}" for i in range(40)]
+
+
+def test_fair_share_counts_the_work():
+    scheduler = FairScheduler()
+    scheduler.put("big", "big", "alice", cost=1000)
+    scheduler.put("a1", "a1", "alice", cost=1000)
+    for i in range(5):
+        scheduler.put(f"b{i}", f"b{i}", "bob", cost=100)
+
+    # One big scan of Alice is worth the five small ones of Bob
+    assert drain(scheduler) == ["big", "b0", "b1", "b2", "b3", "b4", "a1"]
+
+
+def test_idle_users_do_not_save_up_credit():
+    scheduler = FairScheduler()
+    for i in range(3):
+        scheduler.put(f"a{i}", f"a{i}", "alice", cost=100)
+    assert scheduler.get() == "a0" and scheduler.get() == "a1"
+    # Bob arrives late and starts at the virtual time of Alice's last scan, not at 0:
+    # he gets ahead of her by one scan, not by all of his
+    scheduler.put("b0", "b0", "bob", cost=100)
+    scheduler.put("b1", "b1", "bob", cost=100)
+    assert drain(scheduler) == ["b0", "a2", "b1"]
+
+
+def test_priority_and_size():
+    scheduler = FairScheduler()
+    scheduler.put("huge", "huge", "alice", cost=5000000)
+    scheduler.put("tiny", "tiny", "alice", cost=1000)
+    scheduler.put("unknown", "unknown", "alice")
+    scheduler.put("urgent", "urgent", "bob", priority=1, cost=5000000)
+    scheduler.update_cost("unknown", 2000000)
+
+    assert drain(scheduler) == ["urgent", "tiny", "unknown", "huge"]
+
+
+def test_duplicates_are_found_until_done():
+    scheduler = FairScheduler()
+    scan = {'scan_id': 's1', 'scan_url': 'old'}
+    scheduler.put("s1", scan, "alice", cost=100)
+    scheduler.put("s2", {'scan_id': 's2'}, "bob", priority=1, cost=100)
+    assert scheduler.find("s1") is scan and scheduler.find("s3") is None
+
+    scheduler.raise_priority("s1", 2)
+    scheduler.raise_priority("s1", 0)
+    assert scheduler.get() is scan
+    assert scheduler.find("s1") is scan
+    scheduler.done("s1")
+    assert scheduler.find("s1") is None
+
+
+def test_big_scans_age():
+    now = [1000.0]
+    scheduler = FairScheduler(aging=10.0, timer=lambda: now[0])
+    scheduler.put("big", "big", "alice", cost=300)
+    now[0] += 30
+    scheduler.put("small", "small", "alice", cost=100)
+    # After 3 aging periods the big scan counts as 300 / 4 < 100
+    assert scheduler.get() == "big"
+
+
+def test_status_estimates_the_waiting_times():
+    now = [1000.0]
+    scheduler = FairScheduler(seconds_per_point=0.01, timer=lambda: now[0])
+    scheduler.put("a0", "a0", "alice", cost=1000)
+    scheduler.put("a1", "a1", "alice", cost=1000)
+    scheduler.put("b0", "b0", "bob", cost=500)
+    assert scheduler.get() == "a0"
+    now[0] += 4
+    scheduler.observe("a0", 20.0)
+    # 0.8 * 0.01 + 0.2 * 0.02
+    assert scheduler.seconds_per_point == pytest.approx(0.012)
+
+    status = scheduler.status(workers=2)
+    assert status['queued'] == 2 and status['running'] == 1
+    # a0 keeps a worker 12 - 4 s more, b0 goes on the free one, then a1 after b0
+    assert status['users']['bob'] == {'queued': 1, 'running': 0, 'queued_points': 500,
+                                      'next_eta_seconds': pytest.approx(6), 'eta_seconds': pytest.approx(6)}
+    assert status['users']['alice']['running'] == 1
+    assert status['users']['alice']['eta_seconds'] == pytest.approx(6 + 12)
+
+    scheduler.done("a0")
+    assert scheduler.status(workers=2)['running'] == 0
+
+
+def test_close_wakes_up_the_waiting_consumers():
+    scheduler = FairScheduler()
+    results = []
+    consumers = [threading.Thread(target=lambda: results.append(scheduler.get())) for _ in range(3)]
+    for consumer in consumers:
+        consumer.start()
+    scheduler.put("a0", "a0", "alice")
+    scheduler.close()
+    for consumer in consumers:
+        consumer.join(timeout=5)
+        assert not consumer.is_alive()
+
+    # The scan put before the close may have been handed out, the other consumers got None
+    assert sorted(results, key=str) in (["a0", None, None], [None, None, None])
+    scheduler.put("a1", "a1", "alice")
+    assert scheduler.get() is None
+    # The queued scans are kept, e.g. for the journal of a server shutting down
+    assert scheduler.qsize() == (1 if "a0" in results else 2)
+
+
+def test_estimate_cost():
+    assert estimate_cost(1500, 200) == 200
+    assert estimate_cost(1500, None) == 100
+    assert estimate_cost(None, None) is None
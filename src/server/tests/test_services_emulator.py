@@ -0,0 +1,100 @@
+"""
+Integration tests of the service clients against the Firebase emulators (see src/firebase/firebase.json):
+
+    cd src/firebase && firebase emulators:start --only firestore,storage
+    FIRESTORE_EMULATOR_HOST=127.0.0.1:8080 STORAGE_EMULATOR_HOST=http://127.0.0.1:9199 \
+        python -m pytest -s tests/test_services_emulator.py
+
+They are skipped when the emulators are not configured.
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+
+firebase_admin = pytest.importorskip("firebase_admin")
+from google.cloud import firestore
+import services
+
+PROJECT_ID = "demo-pmds"
+BUCKET = f"{PROJECT_ID}.appspot.com"
+SCANS = 20
+
+pytestmark = pytest.mark.skipif(not os.getenv("FIRESTORE_EMULATOR_HOST"), reason="Firestore emulator not configured")
+needs_storage = pytest.mark.skipif(not os.getenv("STORAGE_EMULATOR_HOST"), reason="Storage emulator not configured")
+
+
+@pytest.fixture(scope="module", autouse=True)
+def firebase_app():
+    app = firebase_admin.initialize_app(options={'projectId': PROJECT_ID, 'storageBucket': BUCKET})
+    yield app
+    firebase_admin.delete_app(app)
+
+
+def _simulate_scan(db, scan_id):
+    """The Firestore writes of one scan: status, progress of the stages, stats"""
+    scan_ref = db.collection('scans').document(scan_id)
+    scan_ref.set({'status': 1, 'progress': 0})
+    for progress in (10, 20, 40, 60, 80, 90):
+        scan_ref.update({'progress': progress})
+    db.collection('stats').document(scan_id).set({'avg_deviation': 0.001})
+    scan_ref.update({'status': 2, 'progress': 100})
+
+
+def _write_from_child(scan_id):
+    fresh = 'firestore' not in services._clients
+    _simulate_scan(services.get_firestore(), scan_id)
+    return os.getpid(), fresh
+
+
+def test_client_is_created_once_per_process():
+    assert services.get_firestore() is services.get_firestore()
+    assert services.get_bucket().client is services.get_bucket().client
+
+
+def test_forked_workers_create_their_own_client():
+    # The parent's client has an open channel when the pool forks
+    _simulate_scan(services.get_firestore(), 'fork-parent')
+
+    with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('fork')) as executor:
+        results = list(executor.map(_write_from_child, ['fork-child-1', 'fork-child-2'], timeout=60))
+
+    assert all(pid != os.getpid() for pid, _ in results)
+    assert all(fresh for _, fresh in results)
+    for scan_id in ('fork-parent', 'fork-child-1', 'fork-child-2'):
+        assert services.get_firestore().collection('scans').document(scan_id).get().to_dict()['status'] == 2
+
+
+def test_per_scan_client_overhead():
+    # Before: a new client (and channel) per scan
+    start = time.perf_counter()
+    for i in range(SCANS):
+        db = firestore.Client(project=PROJECT_ID)
+        _simulate_scan(db, f"overhead-fresh-{i}")
+        db.close()
+    fresh = (time.perf_counter() - start) / SCANS
+
+    # After: the client of the process
+    services.get_firestore()
+    start = time.perf_counter()
+    for i in range(SCANS):
+        _simulate_scan(services.get_firestore(), f"overhead-reused-{i}")
+    reused = (time.perf_counter() - start) / SCANS
+
+    print(f"\nFirestore per scan: {fresh * 1000:.1f} ms with a new client, {reused * 1000:.1f} ms reusing it")
+    assert reused < fresh
+
+
+@needs_storage
+def test_upload_with_the_process_bucket(tmp_path):
+    path = tmp_path / "heatmap.ply"
+    path.write_bytes(b"ply\n" + os.urandom(1024))
+
+    start = time.perf_counter()
+    for i in range(SCANS):
+        services.get_bucket().blob(f"comparisons/overhead-{i}.ply").upload_from_filename(str(path))
+    reused = (time.perf_counter() - start) / SCANS
+
+    print(f"\nStorage upload per scan: {reused * 1000:.1f} ms reusing the client")
+    assert services.get_bucket().blob(f"comparisons/overhead-0.ply").download_as_bytes() == path.read_bytes()
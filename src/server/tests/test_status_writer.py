@@ -0,0 +1,167 @@
+import threading
+import time
+import pytest
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.transforms import Maximum
+import status_writer
+from status_writer import StatusWriter
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.updates = []
+
+    def update(self, ref, fields):
+        self.updates.append((ref, dict(fields)))
+
+    def commit(self):
+        self.db.commit(self.updates)
+
+
+class FakeFirestore:
+    """
+    Records the writes, batched or not, as lists of updates. Document references are (collection, id) pairs.
+    A write fails while there are failures left, or with NotFound if it updates a missing document.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commits = []
+        self.committed = threading.Event()
+        self.failures = 0
+        self.missing = set()
+
+    def commit(self, updates):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("unavailable")
+            if any(ref in self.missing for ref, _ in updates):
+                raise NotFound("No document to update")
+            self.commits.append(updates)
+            self.committed.set()
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def collection(self, name):
+        return _Collection(self, name)
+
+
+class _Collection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def document(self, document_id):
+        return _Document(self.db, (self.name, document_id))
+
+
+class _Document(tuple):
+    def __new__(cls, db, ref):
+        document = super().__new__(cls, ref)
+        document.db = db
+        return document
+
+    def update(self, fields):
+        self.db.commit([(self, dict(fields))])
+
+
+@pytest.fixture
+def db():
+    return FakeFirestore()
+
+
+def test_updates_are_coalesced_per_scan(db):
+    writer = StatusWriter(interval=60, db=db)
+    writer.update('a', {'status': 1, 'progress': 0})
+    writer.update('a', {'progress': 40})
+    writer.update('b', {'progress': 10})
+    assert db.commits == []
+
+    writer.flush()
+    # Without a status, the progress is a server-side maximum
+    assert db.commits == [[(('scans', 'a'), {'status': 1, 'progress': 40}), (('scans', 'b'), {'progress': Maximum(10)})]]
+
+
+def test_flush_is_rate_limited(db):
+    writer = StatusWriter(interval=0.2, db=db)
+    start = time.monotonic()
+    writer.update('a', {'progress': 10})
+    assert db.committed.wait(5)
+    assert time.monotonic() - start >= 0.15
+    writer.close()
+
+
+def test_terminal_status_is_written_right_away(db):
+    writer = StatusWriter(interval=60, db=db)
+    writer.update('a', {'progress': 90})
+    writer.update('a', {'status': 2, 'progress': 100})
+    assert db.committed.wait(5)
+    assert db.commits == [[(('scans', 'a'), {'status': 2, 'progress': 100})]]
+    writer.close()
+
+
+def test_failed_writes_are_retried_under_newer_updates(db):
+    # The batch, then the write of the document alone
+    db.failures = 2
+    writer = StatusWriter(interval=60, db=db)
+    writer.update('a', {'status': 1, 'progress': 10})
+    writer.flush()
+    writer.update('a', {'progress': 20})
+    writer.flush()
+    assert db.commits == [[(('scans', 'a'), {'status': 1, 'progress': 20})]]
+
+
+def test_updates_are_dropped_after_too_many_failures(db):
+    db.failures = 10
+    writer = StatusWriter(interval=60, db=db)
+    writer.update('a', {'progress': 10})
+    for _ in range(5):
+        writer.flush()
+    assert writer.pending == {}
+
+
+def test_close_writes_what_is_left(db):
+    writer = StatusWriter(interval=60, db=db)
+    writer.update('a', {'progress': 10})
+    writer.close()
+    assert db.commits == [[(('scans', 'a'), {'progress': Maximum(10)})]]
+
+
+def test_flush_status_writes_the_updates_of_the_process(db, monkeypatch):
+    # Nothing to flush in a process that never wrote a status: no writer (nor client) is created
+    monkeypatch.setattr(status_writer, "_writer", None)
+    status_writer.flush_status()
+    assert status_writer._writer is None
+
+    writer = StatusWriter(interval=60, db=db)
+    monkeypatch.setattr(status_writer, "_writer", writer)
+    writer.update('a', {'progress': 90})
+    status_writer.flush_status()
+    assert db.commits == [[(('scans', 'a'), {'progress': Maximum(90)})]]
+
+
+def test_a_bad_document_does_not_fail_the_others(db):
+    db.missing.add(('scans', 'deleted'))
+    writer = StatusWriter(interval=60, db=db)
+    writer.update('a', {'progress': 40})
+    writer.update('deleted', {'progress': 40})
+    writer.update('b', {'progress': 60})
+    writer.flush()
+    assert db.commits == [[(('scans', 'a'), {'progress': Maximum(40)})], [(('scans', 'b'), {'progress': Maximum(60)})]]
+    # The deleted scan is dropped, not retried
+    assert writer.pending == {}
+
+
+def test_terminal_statuses_are_written_on_their_own(db):
+    db.missing.add(('scans', 'deleted'))
+    writer = StatusWriter(interval=60, db=db)
+    writer.update('deleted', {'status': -1})
+    writer.update('a', {'status': 2, 'progress': 100})
+    writer.update('b', {'progress': 10})
+    writer.flush()
+    assert [(('scans', 'a'), {'status': 2, 'progress': 100})] in db.commits
+    assert [(('scans', 'b'), {'progress': Maximum(10)})] in db.commits
+    writer.close()